@@ -5,6 +5,9 @@ del get_versions
 import threading  # noqa
 
 from . import globals  # noqa
+from .util.histogram import PhaseHistograms  # noqa
+from .util.metrics import Metrics  # noqa
+from .util.tokenbucket import TokenBucket  # noqa
 
 
 class Settings:
@@ -25,12 +28,23 @@ class Settings:
             if setting.isupper():
                 setattr(self, setting, getattr(globals, setting))
         self.end_event = threading.Event()
+        # TokenBucket shared by all the measurements, if the scanner
+        # bandwidth_budget is set.
+        self.bandwidth_budget = None
+        # Time spent in every phase of the measurements.
+        self.phase_histograms = PhaseHistograms()
+        # Counters and gauges of the running scanner.
+        self.metrics = Metrics()
+        self.metrics.phase_histograms = self.phase_histograms
 
     def init_http_headers(self, nickname, uuid, tor_version):
         self.HTTP_HEADERS['Tor-Bandwidth-Scanner-Nickname'] = nickname
         self.HTTP_HEADERS['Tor-Bandwidth-Scanner-UUID'] = uuid
         self.HTTP_HEADERS['User-Agent'] += tor_version
 
+    def init_bandwidth_budget(self, rate):
+        self.bandwidth_budget = TokenBucket(rate) if rate else None
+
     def set_end_event(self):
         self.end_event.set()
 
@@ -132,7 +132,7 @@ def _clean_result_files(args, conf):
 
     # first delete so that the files to be deleted are not compressed first
     files_to_delete = _get_files_mtime_older_than(
-        datadir, delete_after_days, ['.txt', '.gz'])
+        datadir, delete_after_days, ['.txt', '.db', '.gz', '.bz2', '.xz'])
     _delete_files(datadir, files_to_delete, dry_run=args.dry_run)
 
     # when dry_run is true, compress will also show all the files that
@@ -4,33 +4,23 @@ from sbws.globals import (fail_hard, SBWS_SCALE_CONSTANT, TORFLOW_SCALING,
                           SBWS_SCALING, TORFLOW_BW_MARGIN, PROP276_ROUND_DIG,
                           DAY_SECS, NUM_MIN_RESULTS, GENERATE_PERIOD)
 from sbws.lib.v3bwfile import V3BWFile
-from sbws.lib.resultdump import load_recent_results_in_datadir
-from argparse import ArgumentDefaultsHelpFormatter
+from sbws.lib.resultdump import (load_recent_results_in_datadir,
+                                 load_results_snapshot,
+                                 trim_results_ip_changed)
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import os
 import logging
+from threading import Thread
+from sbws import settings
 from sbws.util.timestamp import now_fname
 from sbws.lib import destination
 
 log = logging.getLogger(__name__)
 
 
-def gen_parser(sub):
-    d = 'Generate a v3bw file based on recent results. A v3bw file is the '\
-        'file Tor directory authorities want to read and base their '\
-        'bandwidth votes on. '\
-        'To avoid inconsistent reads, configure tor with '\
-        '"V3BandwidthsFile /path/to/latest.v3bw". '\
-        '(latest.v3bw is an atomically created symlink in the same '\
-        'directory as output.) '\
-        'If the file is transferred to another host, it should be written to '\
-        'a temporary path, then renamed to the V3BandwidthsFile path.\n'\
-        'The default scaling method is torflow\'s one. To use different'\
-        'scaling methods or no scaling, see the options.'
-    p = sub.add_parser('generate', description=d,
-                       formatter_class=ArgumentDefaultsHelpFormatter)
-    p.add_argument('--output', default=None, type=str,
-                   help='If specified, write the v3bw here instead of what is'
-                   'specified in the configuration')
+def add_bw_file_args(p):
+    """Add to the parser **p** the arguments to create the bandwidth files
+    that are common to the commands that generate them."""
     # The reason for --scale-constant defaulting to 7500 is because at one
     # time, torflow happened to generate output that averaged to 7500 bw units
     # per relay. We wanted the ability to try to be like torflow. See
@@ -58,22 +48,145 @@ def gen_parser(sub):
     p.add_argument('-r', '--round-digs', '--torflow-round-digs',
                    default=PROP276_ROUND_DIG, type=int,
                    help="Number of most significant digits to round bw.")
-    p.add_argument('-p', '--secs-recent', default=None, type=int,
-                   help="How many secs in the past are results being "
-                        "still considered. Default is {} secs. If not scaling "
-                        "as Torflow the default is data_period in the "
-                        "configuration.".format(GENERATE_PERIOD))
     p.add_argument('-a', '--secs-away', default=DAY_SECS, type=int,
                    help="How many secs results have to be away from each "
                         "other.")
     p.add_argument('-n', '--min-num', default=NUM_MIN_RESULTS, type=int,
                    help="Mininum number of a results to consider them.")
+
+
+def gen_parser(sub):
+    d = 'Generate a v3bw file based on recent results. A v3bw file is the '\
+        'file Tor directory authorities want to read and base their '\
+        'bandwidth votes on. '\
+        'To avoid inconsistent reads, configure tor with '\
+        '"V3BandwidthsFile /path/to/latest.v3bw". '\
+        '(latest.v3bw is an atomically created symlink in the same '\
+        'directory as output.) '\
+        'If the file is transferred to another host, it should be written to '\
+        'a temporary path, then renamed to the V3BandwidthsFile path.\n'\
+        'The default scaling method is torflow\'s one. To use different'\
+        'scaling methods or no scaling, see the options.'
+    p = sub.add_parser('generate', description=d,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('--output', default=None, type=str,
+                   help='If specified, write the v3bw here instead of what is'
+                   'specified in the configuration')
+    add_bw_file_args(p)
+    p.add_argument('-p', '--secs-recent', default=None, type=int,
+                   help="How many secs in the past are results being "
+                        "still considered. Default is {} secs. If not scaling "
+                        "as Torflow the default is data_period in the "
+                        "configuration.".format(GENERATE_PERIOD))
+    p.add_argument('-j', '--jobs', default=1, type=int,
+                   help="Number of processes to create the bandwidth lines "
+                        "of the relays with.")
     return p
 
 
-def main(args, conf):
+def _scaling_method(args):
+    if args.scale_sbws:
+        return SBWS_SCALING
+    if args.raw:
+        return None
+    # sbws will scale as torflow until we have a better algorithm for
+    # scaling (#XXX)
+    return TORFLOW_SCALING
+
+
+def default_args():
+    """Return the arguments of ``sbws generate`` with their default values,
+    to generate the bandwidth files from the scanner as the command does."""
+    parser = ArgumentParser()
+    gen_parser(parser.add_subparsers())
+    return parser.parse_args(['generate'])
+
+
+def bw_file_from_results(args, conf, results, **kwargs):
+    """Create the bandwidth file from **results** with the arguments of
+    ``sbws generate``.
+
+    **kwargs** replace the arguments of ``V3BWFile.from_results`` obtained
+    from **args** and **conf**.
+    """
+    # Accept None as scanner_country to be compatible with older versions.
+    from_results_kwargs = dict(
+        scanner_country=conf['scanner'].get('country'),
+        destinations_countries=destination.parse_destinations_countries(
+            conf),
+        state_fpath=conf.getpath('paths', 'state_fname'),
+        scale_constant=args.scale_constant,
+        scaling_method=_scaling_method(args),
+        torflow_cap=args.torflow_bw_margin,
+        round_digs=args.round_digs,
+        secs_recent=args.secs_recent,
+        secs_away=args.secs_away,
+        min_num=args.min_num,
+        consensus_path=os.path.join(conf.getpath('tor', 'datadir'),
+                                    "cached-consensus"),
+        consensus_cache_fname=conf.getpath('paths', 'consensus_cache_fname'),
+        processes=args.jobs)
+    from_results_kwargs.update(kwargs)
+    return V3BWFile.from_results(results, **from_results_kwargs)
+
+
+def write_bw_file(args, conf, results):
+    """Create the bandwidth file from **results** with the arguments of
+    ``sbws generate`` and write it."""
     os.makedirs(conf.getpath('paths', 'v3bw_dname'), exist_ok=True)
+    bw_file = bw_file_from_results(args, conf, results)
+    output = args.output or \
+        conf.getpath('paths', 'v3bw_fname').format(now_fname())
+    bw_file.write(output)
+    bw_file.info_stats
+
+
+class BwFileGenerator:
+    """Generate a bandwidth file every **interval** seconds in a thread, from
+    the results kept in memory by **result_dump**, with the default
+    arguments of ``sbws generate``.
+
+    The thread stops when ``settings.end_event`` is set.
+    """
+    def __init__(self, conf, result_dump, interval):
+        self.conf = conf
+        self.result_dump = result_dump
+        self.interval = interval
+        self.args = default_args()
+        self.reset_bw_ipv4_changes = conf.getboolean(
+            'general', 'reset_bw_ipv4_changes')
+        self.reset_bw_ipv6_changes = conf.getboolean(
+            'general', 'reset_bw_ipv6_changes')
+        self.thread = Thread(target=self.enter, name='BwFileGenerator')
+
+    def start(self):
+        self.thread.start()
+
+    def generate(self):
+        results = self.result_dump.generate_results()
+        if results is None:
+            log.info('Not generating a bandwidth file until the results are '
+                     'loaded.')
+            return
+        results = trim_results_ip_changed(
+            results, on_changed_ipv4=self.reset_bw_ipv4_changes,
+            on_changed_ipv6=self.reset_bw_ipv6_changes)
+        if len(results) < 1:
+            log.warning('No recent results, so not generating anything.')
+            return
+        write_bw_file(self.args, self.conf, results)
+
+    def enter(self):
+        while not settings.end_event.wait(self.interval):
+            try:
+                self.generate()
+            # The scanner must keep measuring if a bandwidth file can not be
+            # generated.
+            except Exception as e:
+                log.exception('Could not generate the bandwidth file: %s', e)
+
 
+def main(args, conf):
     datadir = conf.getpath('paths', 'datadir')
     if not os.path.isdir(datadir):
         fail_hard('%s does not exist', datadir)
@@ -81,14 +194,9 @@ def main(args, conf):
         fail_hard('--scale-constant must be positive')
     if args.torflow_bw_margin < 0:
         fail_hard('toflow-bw-margin must be major than 0.')
-    if args.scale_sbws:
-        scaling_method = SBWS_SCALING
-    elif args.raw:
-        scaling_method = None
-    else:
-        # sbws will scale as torflow until we have a better algorithm for
-        # scaling (#XXX)
-        scaling_method = TORFLOW_SCALING
+    if args.jobs < 1:
+        fail_hard('--jobs must be positive')
+    scaling_method = _scaling_method(args)
     if args.secs_recent:
         fresh_days = ceil(args.secs_recent / 24 / 60 / 60)
     elif scaling_method == TORFLOW_SCALING:
@@ -97,31 +205,27 @@ def main(args, conf):
         fresh_days = conf.getint('general', 'data_period')
     reset_bw_ipv4_changes = conf.getboolean('general', 'reset_bw_ipv4_changes')
     reset_bw_ipv6_changes = conf.getboolean('general', 'reset_bw_ipv6_changes')
-    results = load_recent_results_in_datadir(
-        fresh_days, datadir,
-        on_changed_ipv4=reset_bw_ipv4_changes,
-        on_changed_ipv6=reset_bw_ipv6_changes)
+    results = None
+    # The scanner writes the results of the generate period to a snapshot,
+    # so that only the results written after it need to be read.
+    if conf.getint('scanner', 'generate_snapshot_interval'):
+        snapshot_fname = conf.getpath('paths', 'generate_snapshot_fname')
+        results = load_results_snapshot(snapshot_fname, fresh_days, datadir)
+        if results is None:
+            log.info('Not using the generate snapshot %s, reading all the '
+                     'results files.', snapshot_fname)
+        else:
+            results = trim_results_ip_changed(
+                results, on_changed_ipv4=reset_bw_ipv4_changes,
+                on_changed_ipv6=reset_bw_ipv6_changes)
+    if results is None:
+        results = load_recent_results_in_datadir(
+            fresh_days, datadir,
+            on_changed_ipv4=reset_bw_ipv4_changes,
+            on_changed_ipv6=reset_bw_ipv6_changes,
+            processes=conf.getint('general', 'load_results_processes'))
     if len(results) < 1:
         log.warning('No recent results, so not generating anything. (Have you '
                     'ran sbws scanner recently?)')
         return
-    state_fpath = conf.getpath('paths', 'state_fname')
-    consensus_path = os.path.join(conf.getpath('tor', 'datadir'),
-                                  "cached-consensus")
-    # Accept None as scanner_country to be compatible with older versions.
-    scanner_country = conf['scanner'].get('country')
-    destinations_countries = destination.parse_destinations_countries(conf)
-    bw_file = V3BWFile.from_results(results, scanner_country,
-                                    destinations_countries, state_fpath,
-                                    args.scale_constant, scaling_method,
-                                    torflow_cap=args.torflow_bw_margin,
-                                    round_digs=args.round_digs,
-                                    secs_recent=args.secs_recent,
-                                    secs_away=args.secs_away,
-                                    min_num=args.min_num,
-                                    consensus_path=consensus_path)
-
-    output = args.output or \
-        conf.getpath('paths', 'v3bw_fname').format(now_fname())
-    bw_file.write(output)
-    bw_file.info_stats
+    write_bw_file(args, conf, results)
@@ -0,0 +1,270 @@
+"""Generate the bandwidth files that would have been generated at every step
+of a period in the past, from the results in the data directory."""
+from argparse import ArgumentDefaultsHelpFormatter
+from bisect import bisect_right
+import calendar
+import collections
+from datetime import datetime, timedelta
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from math import ceil
+
+from sbws.globals import fail_hard, GENERATE_PERIOD
+from sbws.core.generate import add_bw_file_args, bw_file_from_results
+from sbws.lib.consensus import read_valid_after
+from sbws.lib.resultdump import (load_recent_results_in_datadir,
+                                 trim_results_ip_changed)
+from sbws.util.timestamp import (dt_obj_to_isodt_str, isostr_to_dt_obj,
+                                 unixts_to_dt_obj)
+
+log = logging.getLogger(__name__)
+
+#: Format of the names of the bandwidth files, the same as ``now_fname``.
+REPLAY_FNAME_FORMAT = "%Y%m%d_%H%M%S.v3bw"
+
+
+def gen_parser(sub):
+    d = 'Generate the v3bw files that sbws generate would have generated at '\
+        'every step of a period in the past, from the results in the data '\
+        'directory. The results are loaded once and every step only adds '\
+        'and removes the results that enter and leave the window of recent '\
+        'results. With a directory of archived consensuses, every step uses '\
+        'the consensus that was valid at that time.'
+    p = sub.add_parser('replay', description=d,
+                       formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('--start', default=None, type=str,
+                   help='Time of the first step, as YYYY-MM-DDTHH:MM:SS in '
+                   'UTC. Default is data_period days before the end.')
+    p.add_argument('--end', default=None, type=str,
+                   help='Time of the last step, as YYYY-MM-DDTHH:MM:SS in '
+                   'UTC. Default is the start of the current step.')
+    p.add_argument('-s', '--step', default=60 * 60, type=int,
+                   help='Seconds between the steps.')
+    p.add_argument('--output-dir', default=None, type=str,
+                   help='Directory where to write the v3bw files, named by '
+                   'the time of their step. Default is the replay directory '
+                   'in v3bw_dname.')
+    p.add_argument('--consensus-dir', default=None, type=str,
+                   help='Directory with archived consensuses. Without it, '
+                   'the v3bw files are generated without consensus.')
+    add_bw_file_args(p)
+    p.add_argument('-p', '--secs-recent', default=GENERATE_PERIOD, type=int,
+                   help="How many secs before every step are results being "
+                        "still considered.")
+    p.add_argument('-j', '--jobs', default=1, type=int,
+                   help="Number of processes to generate the v3bw files of "
+                        "the steps with.")
+    return p
+
+
+class ResultsWindow:
+    """The results of **results**, a dictionary of results by relay
+    fingerprint, measured in a window of **secs** seconds that slides
+    forward.
+
+    The results are added and removed only when they enter and leave the
+    window, instead of filtering all the results again at every step.
+    Every step still returns a copy of the results in the window, so it
+    costs the number of results in it, as creating the bandwidth file from
+    them does.
+    """
+    def __init__(self, results, secs):
+        # Stable, so that the results of every relay measured at the same
+        # time keep their order.
+        self.results = sorted((r for values in results.values()
+                               for r in values), key=lambda r: r.time)
+        self.times = [r.time for r in self.results]
+        self.secs = secs
+        self.data = {}
+        # Indexes of the next result to add and to remove.
+        self.added = self.expired = None
+
+    def advance(self, end):
+        """Move the end of the window to **end**, not before the previous
+        one, and return a copy of the results in it by relay fingerprint.
+
+        The fingerprints are sorted, so that the order does not depend on
+        the step where the window started, as in every process of
+        ``--jobs``.
+        """
+        start = end - self.secs
+        if self.added is None:
+            self.added = self.expired = bisect_right(self.times, start)
+        while self.added < len(self.results) \
+                and self.results[self.added].time <= end:
+            result = self.results[self.added]
+            if result.fingerprint not in self.data:
+                self.data[result.fingerprint] = collections.deque()
+            self.data[result.fingerprint].append(result)
+            self.added += 1
+        # The results of every relay are in the same order as in
+        # ``results``, so the result that leaves is the first of its relay.
+        while self.expired < self.added \
+                and self.results[self.expired].time <= start:
+            fp = self.results[self.expired].fingerprint
+            self.data[fp].popleft()
+            if not self.data[fp]:
+                del self.data[fp]
+            self.expired += 1
+        return {fp: list(self.data[fp]) for fp in sorted(self.data)}
+
+
+def consensus_paths_by_time(consensus_dir):
+    """Return the valid-after times and paths of the consensuses in
+    **consensus_dir** and its subdirectories, ordered by time."""
+    consensuses = []
+    for dirpath, _, fnames in os.walk(consensus_dir):
+        for fname in fnames:
+            path = os.path.join(dirpath, fname)
+            try:
+                valid_after = read_valid_after(path)
+            except (OSError, UnicodeDecodeError):
+                valid_after = None
+            if valid_after is None:
+                log.debug('%s is not a consensus.', path)
+                continue
+            dt = datetime.strptime(valid_after, "%Y-%m-%d %H:%M:%S")
+            consensuses.append((calendar.timegm(dt.timetuple()), path))
+    return sorted(consensuses)
+
+
+def consensus_path_at(consensuses, ts):
+    """Return the path of the consensus of **consensuses** that was valid at
+    **ts**, the last one valid after it, or None if there is not any."""
+    i = bisect_right([valid_after for valid_after, _ in consensuses], ts)
+    return consensuses[i - 1][1] if i else None
+
+
+# The arguments of ``_replay_steps`` in the processes of the pool, set by the
+# pool initializer, so that the results are not pickled for every task, nor
+# at all when the processes are forked.
+_pool_args = None
+
+
+def _init_replay_pool(*args):
+    global _pool_args
+    _pool_args = args
+    # The processes are forked from sbws, which sets a SIGTERM handler to
+    # stop the scanner threads. Restore the default one, so that the pool
+    # can terminate them.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _replay_steps_in_pool(steps):
+    return _replay_steps(steps, *_pool_args)
+
+
+def _replay_steps(steps, window, consensuses, output_dir, args, conf):
+    """Generate the bandwidth files of **steps**, consecutive times, from the
+    results in **window**, with the arguments of ``sbws replay``.
+
+    :returns: the paths of the bandwidth files written.
+    """
+    fpaths = []
+    # Every step has its own state file, so that the steps do not depend on
+    # the order in which they are generated, nor modify the scanner state.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_fpath = os.path.join(tmp_dir, 'state.dat')
+        for ts in steps:
+            results = window.advance(ts)
+            results = trim_results_ip_changed(
+                results,
+                conf.getboolean('general', 'reset_bw_ipv4_changes'),
+                conf.getboolean('general', 'reset_bw_ipv6_changes'))
+            dt = unixts_to_dt_obj(ts)
+            if not results:
+                log.warning('No results at %s, not generating anything.', dt)
+                continue
+            if os.path.exists(state_fpath):
+                os.remove(state_fpath)
+            # The results are the ones in the window of the step, so they
+            # are not filtered again by their age.
+            bw_file = bw_file_from_results(
+                args, conf, results, state_fpath=state_fpath,
+                consensus_path=consensus_path_at(consensuses, ts),
+                consensus_cache_fname=None, secs_recent=None, processes=1)
+            bw_file.header.file_created = dt_obj_to_isodt_str(dt)
+            fpath = os.path.join(output_dir, dt.strftime(REPLAY_FNAME_FORMAT))
+            with open(fpath, 'wt') as fd:
+                fd.write(str(bw_file))
+            log.info('Wrote the v3bw file of %s to %s', dt, fpath)
+            fpaths.append(fpath)
+    return fpaths
+
+
+def _parse_time(arg, value):
+    try:
+        return calendar.timegm(isostr_to_dt_obj(value).timetuple())
+    except ValueError:
+        fail_hard('%s must be YYYY-MM-DDTHH:MM:SS, not %s', arg, value)
+
+
+def main(args, conf):
+    datadir = conf.getpath('paths', 'datadir')
+    if not os.path.isdir(datadir):
+        fail_hard('%s does not exist', datadir)
+    if args.scale_constant < 1:
+        fail_hard('--scale-constant must be positive')
+    if args.torflow_bw_margin < 0:
+        fail_hard('toflow-bw-margin must be major than 0.')
+    if args.step < 1:
+        fail_hard('--step must be positive')
+    if args.secs_recent < 1:
+        fail_hard('--secs-recent must be positive')
+    if args.jobs < 1:
+        fail_hard('--jobs must be positive')
+    if args.end:
+        end = _parse_time('--end', args.end)
+    else:
+        end = time.time() // args.step * args.step
+    if args.start:
+        start = _parse_time('--start', args.start)
+    else:
+        start = end - timedelta(
+            days=conf.getint('general', 'data_period')).total_seconds()
+    if start > end:
+        fail_hard('--start must not be after --end')
+    steps = list(range(int(start), int(end) + 1, args.step))
+    output_dir = args.output_dir or \
+        os.path.join(conf.getpath('paths', 'v3bw_dname'), 'replay')
+    os.makedirs(output_dir, exist_ok=True)
+
+    consensuses = []
+    if args.consensus_dir:
+        consensuses = consensus_paths_by_time(args.consensus_dir)
+        log.info('Found %s consensuses in %s.', len(consensuses),
+                 args.consensus_dir)
+    else:
+        log.warning('Without --consensus-dir, the v3bw files are generated '
+                    'without the consensus of every step.')
+
+    # The results of all the steps are loaded once.
+    fresh_days = ceil((time.time() - start + args.secs_recent) / 24 / 60 / 60)
+    results = load_recent_results_in_datadir(
+        fresh_days, datadir,
+        processes=conf.getint('general', 'load_results_processes'))
+    if len(results) < 1:
+        log.warning('No results, so not generating anything.')
+        return
+    window = ResultsWindow(results, args.secs_recent)
+    del results
+    step_args = (window, consensuses, output_dir, args, conf)
+    log.info('Generating the v3bw files of %s steps.', len(steps))
+    if args.jobs > 1 and len(steps) > 1:
+        # Contiguous chunks, so that the window only slides forward in
+        # every process.
+        chunk_size = ceil(len(steps) / (args.jobs * 4))
+        chunks = [steps[i:i + chunk_size]
+                  for i in range(0, len(steps), chunk_size)]
+        with multiprocessing.Pool(min(args.jobs, len(chunks)),
+                                  initializer=_init_replay_pool,
+                                  initargs=step_args) as pool:
+            fpaths = [fpath for chunk_fpaths in pool.imap(
+                _replay_steps_in_pool, chunks) for fpath in chunk_fpaths]
+    else:
+        fpaths = _replay_steps(steps, *step_args)
+    log.info('Wrote %s v3bw files to %s.', len(fpaths), output_dir)
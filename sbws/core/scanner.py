@@ -1,4 +1,8 @@
 ''' Measure the relays. '''
+import asyncio
+import collections
+import functools
+import itertools
 import queue
 
 import signal
@@ -11,6 +15,7 @@ from multiprocessing.context import TimeoutError
 
 from ..lib.circuitbuilder import GapsCircuitBuilder as CB
 from ..lib.resultdump import ResultDump
+from .generate import BwFileGenerator
 from ..lib.resultdump import (
     ResultSuccess, ResultErrorCircuit, ResultErrorStream,
     ResultErrorSecondRelay,  ResultError, ResultErrorDestination
@@ -18,10 +23,18 @@ from ..lib.resultdump import (
 from ..lib.relaylist import RelayList
 from ..lib.relayprioritizer import RelayPrioritizer
 from ..lib.destination import (DestinationList,
-                               connect_to_destination_over_circuit)
+                               connect_to_destination_over_circuit,
+                               async_connect_to_destination_over_circuit)
+from ..util import aio
+from ..util.histogram import PhaseTimer
+from ..util.metrics import MetricsServer
 from ..util.timestamp import now_isodt_str
 from ..util.state import State
-from sbws.globals import fail_hard, HTTP_GET_HEADERS, TIMEOUT_MEASUREMENTS
+from sbws.globals import (fail_hard, HTTP_GET_HEADERS, TIMEOUT_MEASUREMENTS,
+                          STUDENT_T_95,
+                          DOWNLOADS_STOP_NUM_DOWNLOADS, DOWNLOADS_STOP_STABLE,
+                          DOWNLOADS_STOP_STOPPING,
+                          DOWNLOAD_CHUNK_SIZE)
 import sbws.util.stem as stem_utils
 import sbws.util.requests as requests_utils
 from argparse import ArgumentDefaultsHelpFormatter
@@ -30,6 +43,8 @@ import time
 import os
 import logging
 import random
+import math
+from statistics import mean, median, stdev
 
 from .. import settings
 from ..lib.heartbeat import Heartbeat
@@ -41,6 +56,9 @@ log = logging.getLogger(__name__)
 pool = None
 rd = None
 controller = None
+metrics_server = None
+bw_file_generator = None
+circuit_builder = None
 
 FILLUP_TICKET_MSG = """Something went wrong.
 Please create an issue at
@@ -53,11 +71,19 @@ def stop_threads(signal, frame, exit_code=0):
     log.debug('Stopping sbws.')
     # Avoid new threads to start.
     settings.set_end_event()
-    # Stop Pool threads
-    pool.close()
-    pool.join()
+    # Stop Pool threads. There is no pool with the asyncio engine.
+    if pool is not None:
+        pool.close()
+        pool.join()
+    # Stop building circuits in advance and close the ones not used.
+    if circuit_builder is not None:
+        circuit_builder.stop_prefetching()
     # Stop ResultDump thread
     rd.thread.join()
+    if bw_file_generator is not None:
+        bw_file_generator.thread.join()
+    if metrics_server is not None:
+        metrics_server.stop()
     # Stop Tor thread
     controller.close()
     sys.exit(exit_code)
@@ -66,6 +92,37 @@ def stop_threads(signal, frame, exit_code=0):
 signal.signal(signal.SIGTERM, stop_threads)
 
 
+def start_metrics_server(conf):
+    """Serve ``settings.metrics`` on the local ``metrics_port`` or the Unix
+    socket ``metrics_socket``, if any of them is set.
+
+    :returns: the :class:`~sbws.util.metrics.MetricsServer` or None.
+    """
+    port = conf.getint('scanner', 'metrics_port')
+    socket_path = os.path.expanduser(conf['scanner']['metrics_socket'])
+    if not port and not socket_path:
+        return None
+    try:
+        server = MetricsServer(settings.metrics, port=port,
+                               socket_path=socket_path or None)
+    except OSError as e:
+        log.warning("Could not serve the metrics: %s", e)
+        return None
+    server.start()
+    return server
+
+
+def register_gauges(max_pending, pending):
+    """Register the gauges of the measurements in progress, **pending**
+    being the relays being measured."""
+    settings.metrics.set_gauge(
+        'sbws_measurements_pending', lambda: len(pending))
+    settings.metrics.set_gauge(
+        'sbws_measurement_workers',
+        lambda: {('state', 'busy'): len(pending),
+                 ('state', 'idle'): max_pending - len(pending)})
+
+
 def dumpstacks():
     log.critical(FILLUP_TICKET_MSG)
     thread_id2name = dict([(t.ident, t.name) for t in threading.enumerate()])
@@ -86,28 +143,51 @@ def dumpstacks():
 
 def timed_recv_from_server(session, dest, byte_range):
     ''' Request the **byte_range** from the URL at **dest**. If successful,
-    return True and the time it took to download. Otherwise return False and an
-    exception. '''
-
-    start_time = time.time()
-    HTTP_GET_HEADERS['Range'] = byte_range
-    # - response.elapsed "measures the time taken between sending the first
-    #   byte of the request and finishing parsing the headers.
-    #   It is therefore unaffected by consuming the response content"
-    #   If this mean that the content has arrived, elapsed could be used to
-    #   know the time it took.
+    return True and a dictionary with the download timings and the amount of
+    bytes received. Otherwise return False and an exception.
+
+    The body of the response is streamed in chunks of
+    :const:`~sbws.globals.DOWNLOAD_CHUNK_SIZE` bytes that are discarded as
+    they arrive, so that the memory used does not depend on the size of the
+    download.
+
+    The dictionary has the keys:
+
+    - ``duration``: seconds since the request was sent until the last byte
+      was received.
+    - ``ttfb``: seconds since the request was sent until the headers were
+      received (time to first byte).
+    - ``amount``: number of bytes of the body actually received.
+    '''
+
+    # Do not modify the global headers, since several threads are using them.
+    headers = dict(HTTP_GET_HEADERS, Range=byte_range)
+    wait = reserve_bandwidth(byte_range)
+    if wait:
+        time.sleep(wait)
+    start_time = time.monotonic()
+    amount = 0
     try:
         # headers are merged with the session ones, not overwritten.
-        session.get(dest.url, headers=HTTP_GET_HEADERS, verify=dest.verify)
+        # With ``stream``, ``get`` returns as soon as the headers are parsed.
+        with session.get(dest.url, headers=headers, verify=dest.verify,
+                         stream=True) as response:
+            ttfb = time.monotonic() - start_time
+            for chunk in response.iter_content(
+                    chunk_size=DOWNLOAD_CHUNK_SIZE):
+                amount += len(chunk)
     # All `requests` exceptions could be caught with
     # `requests.exceptions.RequestException`, but it seems that `requests`
     # does not catch all the ssl exceptions and urllib3 doesn't seem to have
     # a base exception class.
     except Exception as e:
         log.debug(e)
+        settings.metrics.inc('sbws_downloaded_bytes_total', amount)
         return False, e
-    end_time = time.time()
-    return True, end_time - start_time
+    end_time = time.monotonic()
+    settings.metrics.inc('sbws_downloaded_bytes_total', amount)
+    return True, {
+        'duration': end_time - start_time, 'ttfb': ttfb, 'amount': amount}
 
 
 def get_random_range_string(content_length, size):
@@ -134,6 +214,138 @@ def get_random_range_string(content_length, size):
     return 'bytes={}-{}'.format(start, end)
 
 
+def reserve_bandwidth(byte_range):
+    """Take from the scanner bandwidth budget the bytes in **byte_range**,
+    before requesting them.
+
+    :returns float: the seconds to wait before the request, 0 if there is not
+        a bandwidth budget.
+    """
+    if settings.bandwidth_budget is None:
+        return 0
+    start, end = byte_range.split('=')[1].split('-')
+    return settings.bandwidth_budget.reserve(int(end) - int(start) + 1)
+
+
+class _Downloads:
+    """The downloads to measure something to **dest**, deciding which
+    byte range to request next, when to stop and what the result is,
+    without making the requests.
+
+    The engines only make the requests::
+
+        for byte_range in iter(downloads.next_range, None):
+            success, data = timed_recv_from_server(session, dest, byte_range)
+            if not success:
+                return downloads.failed(data)
+            downloads.add(data)
+        return downloads.result()
+    """
+    #: What is being measured, for the logs.
+    measuring = None
+
+    def __init__(self, dest, content_length):
+        self.dest = dest
+        self.content_length = content_length
+
+    def failed(self, error):
+        """Return the result of the measurement when a download raised
+        **error**."""
+        log.debug('While measuring the %s to %s we hit an exception '
+                  '(does the webserver support Range requests?): %s',
+                  self.measuring, self.dest.url, error)
+        return None, error
+
+
+class RttDownloads(_Downloads):
+    """The ``num_rtts`` small downloads to measure the RTT to **dest**."""
+    measuring = 'RTT'
+
+    def __init__(self, conf, dest, content_length):
+        super().__init__(dest, content_length)
+        self.size = conf.getint('scanner', 'min_download_size')
+        self.num_rtts = conf.getint('scanner', 'num_rtts')
+        self.rtts = []
+
+    def next_range(self):
+        if len(self.rtts) >= self.num_rtts:
+            return None
+        log.debug('Measuring RTT to %s', self.dest.url)
+        return get_random_range_string(self.content_length, self.size)
+
+    def add(self, data):
+        # data is a dictionary with the download time
+        self.rtts.append(data['duration'])
+
+    def result(self):
+        return self.rtts, None
+
+
+class BandwidthDownloads(_Downloads):
+    """The downloads to measure the bandwidth to **dest**.
+
+    They are made until ``num_downloads`` of them took an acceptable time
+    or, when ``early_stop_ci_width`` is set, until the download rates are
+    similar enough (see :func:`_downloads_are_stable`), adjusting the amount
+    requested to aim for ``download_target`` seconds.
+
+    :param int initial_amount: the number of bytes to request first, see
+        :func:`initial_expected_amount`. When None, ``initial_read_request``.
+    """
+    measuring = 'bandwidth'
+
+    def __init__(self, conf, dest, content_length, initial_amount=None):
+        super().__init__(dest, content_length)
+        self.conf = conf
+        self.num_downloads = conf.getint('scanner', 'num_downloads')
+        self.expected_amount = initial_amount or \
+            conf.getint('scanner', 'initial_read_request')
+        self.min_dl = conf.getint('scanner', 'min_download_size')
+        self.max_dl = conf.getint('scanner', 'max_download_size')
+        self.download_times = {
+            'toofast': conf.getfloat('scanner', 'download_toofast'),
+            'min': conf.getfloat('scanner', 'download_min'),
+            'target': conf.getfloat('scanner', 'download_target'),
+            'max': conf.getfloat('scanner', 'download_max'),
+        }
+        self.results = []
+        self.attempts = 0
+        self.stop_reason = DOWNLOADS_STOP_STOPPING
+
+    def next_range(self):
+        if self.stop_reason == DOWNLOADS_STOP_STABLE or \
+                len(self.results) >= self.num_downloads or \
+                settings.end_event.is_set():
+            return None
+        assert self.expected_amount >= self.min_dl
+        assert self.expected_amount <= self.max_dl
+        self.attempts += 1
+        return get_random_range_string(self.content_length,
+                                       self.expected_amount)
+
+    def add(self, data):
+        # data is a dictionary with the download timings and amount
+        log.debug('Downloaded %s bytes in %.2f seconds, %.2f seconds to the '
+                  'first byte.', data['amount'], data['duration'],
+                  data['ttfb'])
+        if _should_keep_result(self.expected_amount == self.max_dl,
+                               data['duration'], self.download_times):
+            self.results.append({
+                'duration': data['duration'], 'amount': data['amount']})
+            if len(self.results) >= self.num_downloads:
+                self.stop_reason = DOWNLOADS_STOP_NUM_DOWNLOADS
+            elif _downloads_are_stable(self.conf, self.results):
+                self.stop_reason = DOWNLOADS_STOP_STABLE
+                return
+        self.expected_amount = _next_expected_amount(
+            self.expected_amount, data['duration'], self.download_times,
+            self.min_dl, self.max_dl, ttfb=data['ttfb'])
+
+    def result(self):
+        return self.results, {'attempts': self.attempts,
+                              'stop_reason': self.stop_reason}
+
+
 def measure_rtt_to_server(session, conf, dest, content_length):
     ''' Make multiple end-to-end RTT measurements by making small HTTP requests
     over a circuit + stream that should already exist, persist, and not need
@@ -144,63 +356,38 @@ def measure_rtt_to_server(session, conf, dest, content_length):
         None or exception if the measurement fail.
 
     '''
-    rtts = []
-    size = conf.getint('scanner', 'min_download_size')
-    for _ in range(0, conf.getint('scanner', 'num_rtts')):
-        log.debug('Measuring RTT to %s', dest.url)
-        random_range = get_random_range_string(content_length, size)
+    downloads = RttDownloads(conf, dest, content_length)
+    for random_range in iter(downloads.next_range, None):
         success, data = timed_recv_from_server(session, dest, random_range)
         if not success:
             # data is an exception
-            log.debug('While measuring the RTT to %s we hit an exception '
-                      '(does the webserver support Range requests?): %s',
-                      dest.url, data)
-            return None, data
-        assert success
-        # data is an RTT
-        assert isinstance(data, float) or isinstance(data, int)
-        rtts.append(data)
-    return rtts, None
-
-
-def measure_bandwidth_to_server(session, conf, dest, content_length):
+            return downloads.failed(data)
+        downloads.add(data)
+    return downloads.result()
+
+
+def measure_bandwidth_to_server(session, conf, dest, content_length,
+                                initial_amount=None):
     """
+    It makes the downloads of :class:`BandwidthDownloads`.
+
+    :param int initial_amount: the number of bytes to request first, see
+        :func:`initial_expected_amount`. When None, ``initial_read_request``.
     :returns tuple: results or None if the if the measurement fail.
-        None or exception if the measurement fail.
+        A dictionary with the number of downloads made (``attempts``) and
+        why it stopped (``stop_reason``, one of ``num_downloads``,
+        ``stable`` or ``stopping``), or exception if the measurement fail.
 
     """
-    results = []
-    num_downloads = conf.getint('scanner', 'num_downloads')
-    expected_amount = conf.getint('scanner', 'initial_read_request')
-    min_dl = conf.getint('scanner', 'min_download_size')
-    max_dl = conf.getint('scanner', 'max_download_size')
-    download_times = {
-        'toofast': conf.getfloat('scanner', 'download_toofast'),
-        'min': conf.getfloat('scanner', 'download_min'),
-        'target': conf.getfloat('scanner', 'download_target'),
-        'max': conf.getfloat('scanner', 'download_max'),
-    }
-    while len(results) < num_downloads and not settings.end_event.is_set():
-        assert expected_amount >= min_dl
-        assert expected_amount <= max_dl
-        random_range = get_random_range_string(content_length, expected_amount)
+    downloads = BandwidthDownloads(conf, dest, content_length,
+                                   initial_amount=initial_amount)
+    for random_range in iter(downloads.next_range, None):
         success, data = timed_recv_from_server(session, dest, random_range)
         if not success:
             # data is an exception
-            log.debug('While measuring the bandwidth to %s we hit an '
-                      'exception (does the webserver support Range '
-                      'requests?): %s', dest.url, data)
-            return None, data
-        assert success
-        # data is a download time
-        assert isinstance(data, float) or isinstance(data, int)
-        if _should_keep_result(
-                expected_amount == max_dl, data, download_times):
-            results.append({
-                'duration': data, 'amount': expected_amount})
-        expected_amount = _next_expected_amount(
-            expected_amount, data, download_times, min_dl, max_dl)
-    return results, None
+            return downloads.failed(data)
+        downloads.add(data)
+    return downloads.result()
 
 
 def _pick_ideal_second_hop(relay, dest, rl, cont, is_exit):
@@ -295,33 +482,17 @@ def error_no_circuit(circ_fps, nicknames, reason, relay, dest, our_nick):
     ]
 
 
-def measure_relay(args, conf, destinations, cb, rl, relay):
-    """
-    Select a Web server, a relay to build the circuit,
-    build the circuit and measure the bandwidth of the given relay.
-
-    :return Result: a measurement Result object
+def pick_measurement_path(relay, destinations, rl, cb, our_nick, timer):
+    """Pick a destination and a relay to help measuring **relay**, timing
+    every step with **timer**.
 
+    :returns: a list with an error Result if any of the steps failed,
+        otherwise the destination and the fingerprints, nicknames and exit
+        policy of the circuit to build.
     """
-    log.debug('Measuring %s %s', relay.nickname, relay.fingerprint)
-    our_nick = conf['scanner']['nickname']
-    s = requests_utils.make_session(
-        cb.controller, conf.getfloat('general', 'http_timeout'))
-    # Probably because the scanner is stopping.
-    if s is None:
-        if settings.end_event.is_set():
-            return None
-        else:
-            # In future refactor this should be returned from the make_session
-            reason = "Unable to get proxies."
-            log.debug(reason + ' to measure %s %s',
-                      relay.nickname, relay.fingerprint)
-            return [
-                ResultError(relay, [], '', our_nick,
-                            msg=reason),
-                ]
     # Pick a destionation
-    dest = destinations.next()
+    with timer.phase('pick_destination'):
+        dest = destinations.next()
     # When there're no any functional destinations.
     if not dest:
         # NOTE: When there're still functional destinations but only one of
@@ -345,104 +516,334 @@ def measure_relay(args, conf, destinations, cb, rl, relay):
     # exit, then pick a non-exit. Otherwise pick an exit.
     # Instead of ensuring that the relay can exit to all IPs, try first with
     # the relay as an exit, if it can exit to some IPs.
-    if relay.is_exit_not_bad_allowing_port(dest.port):
-        r = create_path_relay(relay, dest, rl, cb, relay_as_entry=False)
-    else:
-        r = create_path_relay(relay, dest, rl, cb)
+    with timer.phase('pick_second_hop'):
+        if relay.is_exit_not_bad_allowing_port(dest.port):
+            r = create_path_relay(relay, dest, rl, cb, relay_as_entry=False)
+        else:
+            r = create_path_relay(relay, dest, rl, cb)
     # When `error_no_helper` is triggered because a helper is not found, what
     # can happen in test networks with very few relays, it returns a list with
     # the error.
     if len(r) == 1:
         return r
     circ_fps, nicknames, exit_policy = r
+    return dest, circ_fps, nicknames, exit_policy
 
-    # Build the circuit
-    circ_id, reason = cb.build_circuit(circ_fps)
 
-    # If the circuit failed to get created, bad luck, it will be created again
-    # with other helper.
-    # Here we won't have the case that an exit tried to build the circuit as
-    # entry and failed (#40029), cause not checking that it can exit all IPs.
-    if not circ_id:
-        return error_no_circuit(circ_fps, nicknames, reason, relay, dest,
-                                our_nick)
+def take_prefetched_measurement_circuit(relay, cb):
+    """Return the destination, the circuit id and its fingerprints,
+    nicknames and exit policy of the circuit built in advance to measure
+    **relay**, or None if there is not any or its destination is not
+    functional anymore."""
+    prefetched = cb.take_prefetched_circuit(relay.fingerprint)
+    if prefetched is None:
+        return None
+    circ_id, circ_fps, (dest, nicknames, exit_policy) = prefetched
+    # The destination might have failed since the circuit was built.
+    if not dest.is_functional():
+        cb.close_circuit(circ_id)
+        return None
+    return dest, circ_id, circ_fps, nicknames, exit_policy
+
+
+def error_no_proxies(relay, our_nick):
+    # In future refactor this should be returned from the make_session
+    reason = "Unable to get proxies."
+    log.debug(reason + ' to measure %s %s',
+              relay.nickname, relay.fingerprint)
+    return [
+        ResultError(relay, [], '', our_nick,
+                    msg=reason),
+        ]
+
+
+def should_retry_as_entry(relay, dest, circ_fps, nicknames, exit_policy,
+                          reason):
+    """Whether to measure **relay** again as entry after it could not exit
+    to **dest** for **reason**.
+
+    In the case that the relay was used as an exit, but could not exit
+    to the Web server, try again using it as entry, to avoid that it would
+    always fail when there's only one Web server.
+    """
+    if not relay.is_exit_not_bad_allowing_port(dest.port):
+        return False
+    log.debug(
+        "Exit %s (%s) that can't exit all ips, with exit policy %s, failed"
+        " to connect to %s via circuit %s (%s). Reason: %s. Trying again "
+        "with it as entry.", relay.fingerprint, relay.nickname,
+        exit_policy, dest.url, circ_fps, nicknames, reason)
+    return True
+
+
+def error_no_circuit_as_entry(circ_fps, nicknames, reason, relay, dest,
+                              our_nick):
+    log.info(
+        "Exit %s (%s) that can't exit all ips, failed to create "
+        " circuit as entry: %s (%s).", relay.fingerprint,
+        relay.nickname, circ_fps, nicknames)
+    return error_no_circuit(circ_fps, nicknames, reason, relay, dest,
+                            our_nick)
+
+
+def error_no_stream(circ_fps, nicknames, exit_policy, reason, relay, dest,
+                    our_nick):
+    log.debug('Failed to connect to %s to measure %s (%s) via circuit '
+              '%s (%s). Exit policy: %s. Reason: %s.', dest.url,
+              relay.fingerprint, relay.nickname, circ_fps, nicknames,
+              exit_policy, reason)
+    return [
+        ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                          msg=reason),
+    ]
+
+
+def error_no_rtt(circ_fps, nicknames, reason, relay, dest, our_nick):
+    log.debug('Unable to measure RTT for %s (%s) to %s via circuit '
+              '%s (%s): %s', relay.fingerprint, relay.nickname,
+              dest.url, circ_fps, nicknames, reason)
+    return [
+        ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                          msg=str(reason)),
+    ]
+
+
+def error_no_bandwidth(circ_fps, nicknames, exit_policy, reason, relay, dest,
+                       our_nick):
+    log.debug('Failed to measure %s (%s) via circuit %s (%s) to %s. Exit'
+              ' policy: %s. Reason: %s.', relay.fingerprint,
+              relay.nickname, circ_fps, nicknames, dest.url, exit_policy,
+              reason)
+    return [
+        ResultErrorStream(relay, circ_fps, dest.url, our_nick,
+                          msg=str(reason)),
+    ]
+
+
+def success_result(rtts, bw_results, info, circ_fps, nicknames, relay, dest,
+                   our_nick):
+    log.debug('Success measurement for %s (%s) via circuit %s (%s) to %s',
+              relay.fingerprint, relay.nickname, circ_fps, nicknames, dest.url)
+    return [
+        ResultSuccess(rtts, bw_results, relay, circ_fps, dest.url, our_nick,
+                      download_attempts=info['attempts'],
+                      download_stop_reason=info['stop_reason']),
+    ]
+
+
+def prefetch_circuits(relays, destinations, rl, cb):
+    """Ask the circuit builder to build in advance the circuits to measure
+    **relays**, as :func:`pick_measurement_path` would choose them."""
+    for relay in relays:
+        if not cb.can_prefetch(relay.fingerprint):
+            continue
+        dest = destinations.next()
+        if not dest:
+            return
+        relay_as_exit = relay.is_exit_not_bad_allowing_port(dest.port)
+        r = create_path_relay(relay, dest, rl, cb,
+                              relay_as_entry=not relay_as_exit)
+        if len(r) == 1:
+            continue
+        circ_fps, nicknames, exit_policy = r
+        cb.prefetch_circuit(relay.fingerprint, circ_fps,
+                            data=(dest, nicknames, exit_policy))
+
+
+def lookahead(iterable, n):
+    """Yield every item in **iterable** together with a list of the next
+    **n** items."""
+    iterator = iter(iterable)
+    window = collections.deque(itertools.islice(iterator, n + 1))
+    while window:
+        item = window.popleft()
+        yield item, list(window)
+        window.extend(itertools.islice(iterator, 1))
+
+
+class ThreadsIO:
+    """The I/O of a measurement made by the ``threads`` engine, which blocks
+    the thread that measures the relay.
+
+    Its coroutines never suspend, so that :func:`_run_sync` can run them
+    without an event loop.
+    """
+    def __init__(self, conf, cb):
+        self.conf = conf
+        self.cb = cb
+        self.session = None
+
+    async def run(self, func, *args):
+        """Return ``func(*args)``, a blocking call to the Tor controller."""
+        return func(*args)
+
+    async def open(self):
+        """Return whether the downloads can be made through Tor."""
+        self.session = requests_utils.make_session(
+            self.cb.controller, self.conf.getfloat('general', 'http_timeout'))
+        return self.session is not None
+
+    async def build_circuit(self, circ_fps):
+        return self.cb.build_circuit(circ_fps)
+
+    async def connect(self, dest, circ_id):
+        return connect_to_destination_over_circuit(
+            dest, circ_id, self.session, self.cb.controller, dest._max_dl,
+            stream_router=self.cb.stream_router)
+
+    async def measure_rtt(self, dest, usable_data):
+        return measure_rtt_to_server(self.session, self.conf, dest,
+                                     usable_data['content_length'])
+
+    async def measure_bandwidth(self, dest, usable_data, initial_amount):
+        return measure_bandwidth_to_server(
+            self.session, self.conf, dest, usable_data['content_length'],
+            initial_amount=initial_amount)
+
+    def close(self, usable_data):
+        """Close the connection of **usable_data**, returned by
+        :meth:`connect`."""
+        # The session is not bound to the circuit.
+
+
+def _run_sync(coro):
+    """Return the result of **coro**, a coroutine that never suspends, as
+    the ones using :class:`ThreadsIO`."""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError('{} suspended without an event loop.'.format(coro))
+
+
+def measure_relay(args, conf, destinations, cb, rl, relay,
+                  initial_amount=None):
+    """
+    Select a Web server, a relay to build the circuit,
+    build the circuit and measure the bandwidth of the given relay.
+
+    :return Result: a measurement Result object
+
+    """
+    return _run_sync(measure_relay_with(
+        ThreadsIO(conf, cb), conf, destinations, cb, rl, relay,
+        initial_amount=initial_amount))
+
+
+async def measure_relay_with(io, conf, destinations, cb, rl, relay,
+                             initial_amount=None):
+    """Measure **relay** making the circuits, the connection and the
+    downloads with **io**, the I/O of the engine, :class:`ThreadsIO` or
+    :class:`AsyncioIO`.
+
+    The time spent in every phase is added to ``settings.phase_histograms``
+    with the outcome of the measurement: the result type, ``stopping`` or
+    ``exception``.
+
+    :return Result: a measurement Result object
+
+    """
+    timer = PhaseTimer(settings.phase_histograms)
+    outcome = 'exception'
+    try:
+        with timer.phase('total'):
+            result = await _measure_relay(io, conf, destinations, cb, rl,
+                                          relay, initial_amount, timer)
+        outcome = _measurement_outcome(result)
+        return result
+    finally:
+        timer.finish(outcome)
+
+
+def _measurement_outcome(result):
+    return result[0].type.value if result else 'stopping'
+
+
+async def _measure_relay(io, conf, destinations, cb, rl, relay,
+                         initial_amount, timer):
+    log.debug('Measuring %s %s', relay.nickname, relay.fingerprint)
+    our_nick = conf['scanner']['nickname']
+    with timer.phase('make_session'):
+        opened = await io.open()
+    # Probably because the scanner is stopping.
+    if not opened:
+        if settings.end_event.is_set():
+            return None
+        else:
+            return error_no_proxies(relay, our_nick)
+    # Use a circuit built in advance for this relay, if there is one.
+    r = await io.run(take_prefetched_measurement_circuit, relay, cb)
+    if r is None:
+        # Choosing the helper might need to refresh the relays list.
+        r = await io.run(pick_measurement_path, relay, destinations, rl, cb,
+                         our_nick, timer)
+        # When there is an error, it returns a list with the error.
+        if len(r) == 1:
+            return r
+        dest, circ_fps, nicknames, exit_policy = r
+        with timer.phase('build_circuit'):
+            circ_id, reason = await io.build_circuit(circ_fps)
+        # If the circuit failed to get created, bad luck, it will be created
+        # again with other helper.
+        # Here we won't have the case that an exit tried to build the circuit
+        # as entry and failed (#40029), cause not checking that it can exit
+        # all IPs.
+        if not circ_id:
+            return error_no_circuit(circ_fps, nicknames, reason, relay, dest,
+                                    our_nick)
+    else:
+        dest, circ_id, circ_fps, nicknames, exit_policy = r
     log.debug('Built circuit with path %s (%s) to measure %s (%s)',
               circ_fps, nicknames, relay.fingerprint, relay.nickname)
     # Make a connection to the destination
-    is_usable, usable_data = connect_to_destination_over_circuit(
-        dest, circ_id, s, cb.controller, dest._max_dl)
-
-    # In the case that the relay was used as an exit, but could not exit
-    # to the Web server, try again using it as entry, to avoid that it would
-    # always fail when there's only one Web server.
-    if not is_usable and \
-            relay.is_exit_not_bad_allowing_port(dest.port):
-        log.debug(
-            "Exit %s (%s) that can't exit all ips, with exit policy %s, failed"
-            " to connect to %s via circuit %s (%s). Reason: %s. Trying again "
-            "with it as entry.", relay.fingerprint, relay.nickname,
-            exit_policy, dest.url, circ_fps, nicknames, usable_data)
-        r = create_path_relay(relay, dest, rl, cb)
+    with timer.phase('connect'):
+        is_usable, usable_data = await io.connect(dest, circ_id)
+
+    if not is_usable and should_retry_as_entry(
+            relay, dest, circ_fps, nicknames, exit_policy, usable_data):
+        await io.run(cb.close_circuit, circ_id)
+        with timer.phase('pick_second_hop'):
+            r = await io.run(create_path_relay, relay, dest, rl, cb)
         if len(r) == 1:
             return r
         circ_fps, nicknames, exit_policy = r
-        circ_id, reason = cb.build_circuit(circ_fps)
+        with timer.phase('build_circuit'):
+            circ_id, reason = await io.build_circuit(circ_fps)
         if not circ_id:
-            log.info(
-                "Exit %s (%s) that can't exit all ips, failed to create "
-                " circuit as entry: %s (%s).", relay.fingerprint,
-                relay.nickname, circ_fps, nicknames)
-            return error_no_circuit(circ_fps, nicknames, reason, relay, dest,
-                                    our_nick)
+            return error_no_circuit_as_entry(circ_fps, nicknames, reason,
+                                             relay, dest, our_nick)
 
         log.debug('Built circuit with path %s (%s) to measure %s (%s)',
                   circ_fps, nicknames, relay.fingerprint, relay.nickname)
-        is_usable, usable_data = connect_to_destination_over_circuit(
-            dest, circ_id, s, cb.controller, dest._max_dl)
+        with timer.phase('connect'):
+            is_usable, usable_data = await io.connect(dest, circ_id)
     if not is_usable:
-        log.debug('Failed to connect to %s to measure %s (%s) via circuit '
-                  '%s (%s). Exit policy: %s. Reason: %s.', dest.url,
-                  relay.fingerprint, relay.nickname, circ_fps, nicknames,
-                  exit_policy, usable_data)
-        cb.close_circuit(circ_id)
-        return [
-            ResultErrorStream(relay, circ_fps, dest.url, our_nick,
-                              msg=usable_data),
-        ]
+        await io.run(cb.close_circuit, circ_id)
+        return error_no_stream(circ_fps, nicknames, exit_policy, usable_data,
+                               relay, dest, our_nick)
     assert is_usable
     assert 'content_length' in usable_data
-    # FIRST: measure RTT
-    rtts, reason = measure_rtt_to_server(s, conf, dest,
-                                         usable_data['content_length'])
-    if rtts is None:
-        log.debug('Unable to measure RTT for %s (%s) to %s via circuit '
-                  '%s (%s): %s', relay.fingerprint, relay.nickname,
-                  dest.url, circ_fps, nicknames, reason)
-        cb.close_circuit(circ_id)
-        return [
-            ResultErrorStream(relay, circ_fps, dest.url, our_nick,
-                              msg=str(reason)),
-        ]
-    # SECOND: measure bandwidth
-    bw_results, reason = measure_bandwidth_to_server(
-        s, conf, dest, usable_data['content_length'])
-    if bw_results is None:
-        log.debug('Failed to measure %s (%s) via circuit %s (%s) to %s. Exit'
-                  ' policy: %s. Reason: %s.', relay.fingerprint,
-                  relay.nickname, circ_fps, nicknames, dest.url, exit_policy,
-                  reason)
-        cb.close_circuit(circ_id)
-        return [
-            ResultErrorStream(relay, circ_fps, dest.url, our_nick,
-                              msg=str(reason)),
-        ]
-    cb.close_circuit(circ_id)
+    try:
+        # FIRST: measure RTT
+        with timer.phase('measure_rtt'):
+            rtts, reason = await io.measure_rtt(dest, usable_data)
+        if rtts is None:
+            return error_no_rtt(circ_fps, nicknames, reason, relay, dest,
+                                our_nick)
+        # SECOND: measure bandwidth
+        with timer.phase('measure_bandwidth'):
+            bw_results, reason = await io.measure_bandwidth(
+                dest, usable_data, initial_amount)
+        if bw_results is None:
+            return error_no_bandwidth(circ_fps, nicknames, exit_policy,
+                                      reason, relay, dest, our_nick)
+    finally:
+        io.close(usable_data)
+        await io.run(cb.close_circuit, circ_id)
     # Finally: store result
-    log.debug('Success measurement for %s (%s) via circuit %s (%s) to %s',
-              relay.fingerprint, relay.nickname, circ_fps, nicknames, dest.url)
-    return [
-        ResultSuccess(rtts, bw_results, relay, circ_fps, dest.url, our_nick),
-    ]
+    return success_result(rtts, bw_results, reason, circ_fps, nicknames,
+                          relay, dest, our_nick)
 
 
 def dispatch_worker_thread(*a, **kw):
@@ -485,8 +886,73 @@ def _should_keep_result(did_request_maximum, result_time, download_times):
     return False
 
 
+def _downloads_are_stable(conf, results):
+    """Whether the width of the 95% confidence interval of the mean download
+    rate in **results** is smaller than ``early_stop_ci_width`` times the
+    mean, after at least ``early_stop_min_downloads`` downloads.
+
+    It is always False when ``early_stop_ci_width`` is 0.
+    """
+    max_width = conf.getfloat('scanner', 'early_stop_ci_width')
+    if not max_width or \
+            len(results) < conf.getint('scanner', 'early_stop_min_downloads'):
+        return False
+    rates = [r['amount'] / r['duration'] for r in results]
+    rate_mean = mean(rates)
+    if len(rates) < 2 or rate_mean <= 0:
+        return False
+    # Student's t distribution, since there are very few downloads.
+    t = STUDENT_T_95[max(df for df in STUDENT_T_95 if df < len(rates))]
+    width = 2 * t * stdev(rates) / math.sqrt(len(rates))
+    log.debug('The confidence interval of the download rate is %.2f%% of '
+              'the mean after %s downloads.', width / rate_mean * 100,
+              len(rates))
+    return width <= max_width * rate_mean
+
+
+def initial_expected_amount(conf, relay, results):
+    """Return the number of bytes to request first to measure **relay**, so
+    that it does not take several downloads that are too fast to reach the
+    target download time.
+
+    It is the amount that would be downloaded in ``download_target`` seconds
+    at the median rate of the downloads in the last successful measurement
+    of the relay in **results**.
+    When the relay has not been measured, it is the amount that would be
+    downloaded in ``download_toofast`` seconds at its observed or consensus
+    bandwidth, since the download rate via a two hops circuit is usually
+    lower.
+
+    :returns int: the amount, or None when ``initial_read_request`` should be
+        used.
+    """
+    if not conf.getboolean('scanner', 'initial_read_request_from_history'):
+        return None
+    rate = None
+    successes = [r for r in results
+                 if isinstance(r, ResultSuccess) and r.downloads]
+    if successes:
+        last = max(successes, key=lambda r: r.time)
+        rates = [d['amount'] / d['duration'] for d in last.downloads
+                 if d['duration'] > 0]
+        if rates:
+            rate = median(rates)
+            seconds = conf.getfloat('scanner', 'download_target')
+    if rate is None:
+        rate = relay.observed_bandwidth or relay.consensus_bandwidth
+        seconds = conf.getfloat('scanner', 'download_toofast')
+    if not rate:
+        return None
+    expected_amount = int(rate * seconds)
+    expected_amount = max(conf.getint('scanner', 'min_download_size'),
+                          expected_amount)
+    expected_amount = min(conf.getint('scanner', 'max_download_size'),
+                          expected_amount)
+    return expected_amount
+
+
 def _next_expected_amount(expected_amount, result_time, download_times,
-                          min_dl, max_dl):
+                          min_dl, max_dl, ttfb=None):
     if result_time < download_times['toofast']:
         # Way too fast, greatly increase the amount we ask for
         expected_amount = int(expected_amount * 5)
@@ -494,8 +960,16 @@ def _next_expected_amount(expected_amount, result_time, download_times,
             result_time >= download_times['max']:
         # As long as the result is between min/max, keep the expected amount
         # the same. Otherwise, adjust so we are aiming for the target amount.
-        expected_amount = int(
-            expected_amount * download_times['target'] / result_time)
+        transfer_time = result_time - ttfb if ttfb is not None else 0
+        if transfer_time > 0 and ttfb < download_times['target']:
+            # The time to the first byte does not depend on the amount
+            # requested, so use only the transfer rate to aim for the target.
+            expected_amount = int(
+                expected_amount / transfer_time
+                * (download_times['target'] - ttfb))
+        else:
+            expected_amount = int(
+                expected_amount * download_times['target'] / result_time)
     # Make sure we don't request too much or too little
     expected_amount = max(min_dl, expected_amount)
     expected_amount = min(max_dl, expected_amount)
@@ -542,6 +1016,82 @@ def result_putter_error(target):
     return closure
 
 
+class PendingMeasurements:
+    """The relays being measured and the measurement slots available.
+
+    The measurements threads notify when they finish, so that the main loop
+    can start a new measurement as soon as a slot is free, instead of
+    sleeping.
+
+    There is only one measurement for a relay at the same time.
+    """
+    def __init__(self, max_pending):
+        self._max_pending = max_pending
+        self._pending = {}
+        self._num_finished = 0
+        self._cond = threading.Condition()
+
+    def __contains__(self, fingerprint):
+        with self._cond:
+            return fingerprint in self._pending
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    @property
+    def async_results(self):
+        with self._cond:
+            return [r for r in self._pending.values() if r is not None]
+
+    def add(self, fingerprint):
+        """Reserve a slot for the relay before its measurement starts, so
+        that it can not finish before it is added."""
+        with self._cond:
+            assert fingerprint not in self._pending
+            self._pending[fingerprint] = None
+
+    def set_async_result(self, fingerprint, async_result):
+        with self._cond:
+            # The measurement might have already finished.
+            if fingerprint in self._pending:
+                self._pending[fingerprint] = async_result
+
+    def finish(self, fingerprint):
+        with self._cond:
+            self._pending.pop(fingerprint, None)
+            self._num_finished += 1
+            self._cond.notify_all()
+
+    def wait_for_free_slot(self, timeout):
+        """Return True when there is a free slot or sbws is stopping, and
+        False if no measurement finished in ``timeout`` seconds."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: len(self._pending) < self._max_pending
+                or settings.end_event.is_set(), timeout)
+
+    def wait_for_finished(self, timeout):
+        """Return True when some measurement finished or sbws is stopping,
+        and False if no measurement finished in ``timeout`` seconds."""
+        with self._cond:
+            num_finished = self._num_finished
+            return self._cond.wait_for(
+                lambda: self._num_finished > num_finished
+                or settings.end_event.is_set(), timeout)
+
+
+def measurement_finished(pending, fingerprint, callback):
+    """Wrap a pool **callback**, so that the measurement slot is freed after
+    calling it, even if it raises an exception."""
+    def closure(obj):
+        try:
+            callback(obj)
+        finally:
+            pending.finish(fingerprint)
+    return closure
+
+
 def main_loop(args, conf, controller, relay_list, circuit_builder, result_dump,
               relay_prioritizer, destinations, pool):
     """Starts and reuse the threads that measure the relays forever.
@@ -552,17 +1102,20 @@ def main_loop(args, conf, controller, relay_list, circuit_builder, result_dump,
     Then, it starts a second loop with an ordered list (generator) of relays
     to measure that might a subset of all the current relays in the Network.
 
-    For every relay, it starts a new thread which runs ``measure_relay`` to
-    measure the relay until there are ``max_pending_results`` threads.
-    After that, it will reuse a thread that has finished for every relay to
-    measure.
+    For every relay, it waits until there are less than
+    ``measurement_threads`` measurements pending and then it starts a thread
+    which runs ``measure_relay`` to measure the relay.
     It is the the pool method ``apply_async`` which starts or reuse a thread.
-    This method returns an ``ApplyResult`` immediately, which has a ``ready``
-    methods that tells whether the thread has finished or not.
+    Relays that are still being measured are skipped, so that a relay is
+    never measured twice at the same time.
+    While waiting, the circuits to measure the next ``circuit_prefetch``
+    relays are built in advance.
 
-    When the thread finish, ie. ``ApplyResult`` is ``ready``, it triggers
-    ``result_putter`` callback, which put the ``Result`` in ``ResultDump``
-    queue and complete immediately.
+    When the thread finish, it triggers ``result_putter`` callback, which put
+    the ``Result`` in ``ResultDump`` queue and complete immediately.
+    Then, the slot is freed and the main loop is notified, so that it can
+    start measuring the next relay without waiting for the rest of the relays
+    in the loop to finish.
 
     ``ResultDump`` thread (started before and out of this function) will get
     the ``Result`` from the queue and write it to disk, so this doesn't block
@@ -572,55 +1125,71 @@ def main_loop(args, conf, controller, relay_list, circuit_builder, result_dump,
     instead ``result_putter_error``, which logs the error and complete
     immediately.
 
-    Before the outer loop iterates, it waits (non blocking) that all
-    the ``Results`` are ready calling ``wait_for_results``.
-    This avoid to start measuring the same relay which might still being
-    measured.
+    When all the relays in the ordered list have been queued, the outer loop
+    obtains a new ordered list, that takes into account the measurements that
+    finished, without waiting for the pending ones.
 
     """
     log.info("Started the main loop to measure the relays.")
     hbeat = Heartbeat(conf.getpath('paths', 'state_fname'))
+    pending = PendingMeasurements(
+        conf.getint('scanner', 'measurement_threads'))
+    register_gauges(conf.getint('scanner', 'measurement_threads'), pending)
 
-    # Set the time to wait for a thread to finish as the half of an HTTP
-    # request timeout.
     # Do not start a new loop if sbws is stopping.
     while not settings.end_event.is_set():
         log.debug("Starting a new measurement loop.")
         num_relays = 0
-        # Since loop might finish before pending_results is 0 due waiting too
-        # long, set it here and not outside the loop.
-        pending_results = []
         loop_tstart = time.time()
 
         # Register relay fingerprints to the heartbeat module
         hbeat.register_consensus_fprs(relay_list.relays_fingerprints)
 
-        for target in relay_prioritizer.best_priority():
+        for target, upcoming in lookahead(relay_prioritizer.best_priority(),
+                                          circuit_builder.prefetch_size):
             # Don't start measuring a relay if sbws is stopping.
             if settings.end_event.is_set():
                 break
+            # Don't measure a relay that is still being measured.
+            if target.fingerprint in pending:
+                log.debug("%s is still being measured, skipping it.",
+                          target.fingerprint)
+                continue
+            # Build the circuits for the next relays while waiting.
+            prefetch_circuits(
+                [r for r in upcoming if r.fingerprint not in pending],
+                destinations, relay_list, circuit_builder)
+            if not wait_for_free_slot(pending):
+                break
+            if not wait_for_bandwidth_budget():
+                break
             # 40023, disable to decrease state.dat json lines
             # relay_list.increment_recent_measurement_attempt()
             target.increment_relay_recent_measurement_attempt()
             num_relays += 1
+            pending.add(target.fingerprint)
             # callback and callback_err must be non-blocking
-            callback = result_putter(result_dump)
-            callback_err = result_putter_error(target)
+            callback = measurement_finished(
+                pending, target.fingerprint, result_putter(result_dump))
+            callback_err = measurement_finished(
+                pending, target.fingerprint, result_putter_error(target))
+            initial_amount = initial_expected_amount(
+                conf, target, result_dump.results_for_relay(target))
             async_result = pool.apply_async(
                 dispatch_worker_thread,
                 [args, conf, destinations, circuit_builder, relay_list,
-                 target], {}, callback, callback_err)
-            pending_results.append(async_result)
+                 target], {'initial_amount': initial_amount}, callback,
+                callback_err)
+            pending.set_async_result(target.fingerprint, async_result)
 
             # Register this measurement to the heartbeat module
             hbeat.register_measured_fpr(target.fingerprint)
 
-        # After the for has finished, the pool has queued all the relays
-        # and pending_results has the list of all the AsyncResults.
-        # It could also be obtained with pool._cache, which contains
-        # a dictionary with AsyncResults as items.
-        num_relays_to_measure = len(pending_results)
-        wait_for_results(num_relays_to_measure, pending_results)
+        # When all the relays with the best priority are still being
+        # measured (or there are not relays), wait for some measurement to
+        # finish before prioritizing again.
+        if num_relays == 0:
+            pending.wait_for_finished(TIMEOUT_MEASUREMENTS)
 
         # Print the heartbeat message
         hbeat.print_heartbeat_message()
@@ -634,66 +1203,74 @@ def main_loop(args, conf, controller, relay_list, circuit_builder, result_dump,
         # In a testing network, exit after first loop
         if controller.get_conf('TestingTorNetwork') == '1':
             log.info("In a testing network, exiting after the first loop.")
+            wait_for_results(pending)
             # Threads should be closed nicely in some refactor
             stop_threads(signal.SIGTERM, None)
 
 
-def wait_for_results(num_relays_to_measure, pending_results):
-    """Wait for the pool to finish and log progress.
+def wait_for_free_slot(pending):
+    """Wait until a measurement slot is free and log progress.
 
-    While there are relays being measured, just log the progress
-    and sleep :const:`~sbws.globals.TIMEOUT_MEASUREMENTS` (3mins),
-    which is aproximately the time it can take to measure a relay in
-    the worst case.
+    The measurement threads notify when they finish, so this returns as soon
+    as there is a free slot.
 
-    When there has not been any relay measured in ``TIMEOUT_MEASUREMENTS``
-    and there are still relays pending to be measured, it means there is no
-    progress and call :func:`~sbws.core.scanner.force_get_results`.
+    When no relay has been measured in
+    :const:`~sbws.globals.TIMEOUT_MEASUREMENTS` (3mins), which is
+    aproximately the time it can take to measure a relay in the worst case,
+    it means there is no progress and call
+    :func:`~sbws.core.scanner.force_get_results` to log the pending
+    measurements.
 
     This can happen in the case of a bug that makes either
     :func:`~sbws.core.scanner.measure_relay`,
     :func:`~sbws.core.scanner.result_putter` (callback) and/or
     :func:`~sbws.core.scanner.result_putter_error` (callback error) stall.
 
-    .. note:: in a future refactor, this could be simpler by:
+    :returns bool: True when there is a free slot, False if sbws is stopping.
+    """
+    while not settings.end_event.is_set():
+        if pending.wait_for_free_slot(TIMEOUT_MEASUREMENTS):
+            return not settings.end_event.is_set()
+        log.warning("No measurement finished in %s seconds, with %s "
+                    "measurements pending.", TIMEOUT_MEASUREMENTS,
+                    len(pending))
+        force_get_results(pending.async_results)
+    return False
 
-      1. Initializing the pool at the begingging of each loop
-      2. Callling :meth:`~Pool.close`; :meth:`~Pool.join` after
-         :meth:`~Pool.apply_async`,
-         to ensure no new jobs are added until the pool has finished with all
-         the ones in the queue.
 
-      As currently, there would be still two cases when the pool could stall:
+def wait_for_bandwidth_budget():
+    """Wait until there is bandwidth budget to start a new measurement.
+
+    :returns bool: True when there is budget, False if sbws is stopping.
+    """
+    if settings.bandwidth_budget is not None:
+        wait = settings.bandwidth_budget.wait_time()
+        if wait:
+            log.debug("Waiting %.2f seconds for bandwidth budget.", wait)
+            settings.end_event.wait(wait)
+    return not settings.end_event.is_set()
 
-      1. There's an exception in ``measure_relay`` and another in
-         ``callback_err``
-      2. There's an exception ``callback``.
 
-      This could also be simpler by not having callback and callback error in
-      ``apply_async`` and instead just calling callback with the
-      ``pending_results``.
+def wait_for_results(pending):
+    """Wait for all the pending measurements to finish and log progress.
 
-      (callback could be also simpler by not having a thread and queue and
-      just storing to disk, since the time to write to disk is way smaller
-      than the time to request over the network.)
+    As :func:`~sbws.core.scanner.wait_for_free_slot`, if no relay has been
+    measured in :const:`~sbws.globals.TIMEOUT_MEASUREMENTS`, it calls
+    :func:`~sbws.core.scanner.force_get_results` and stops waiting.
     """
-    num_last_measured = 1
-    while num_last_measured > 0 and not settings.end_event.is_set():
-        log.info("Pending measurements: %s out of %s: ",
-                 len(pending_results), num_relays_to_measure)
-        time.sleep(TIMEOUT_MEASUREMENTS)
-        old_pending_results = pending_results
-        pending_results = [r for r in pending_results if not r.ready()]
-        num_last_measured = len(old_pending_results) - len(pending_results)
-    if len(pending_results) > 0:
-        force_get_results(pending_results)
+    while len(pending) > 0 and not settings.end_event.is_set():
+        log.info("Pending measurements: %s", len(pending))
+        if not pending.wait_for_finished(TIMEOUT_MEASUREMENTS):
+            force_get_results(pending.async_results)
+            return
 
 
 def force_get_results(pending_results):
     """Try to get either the result or an exception, which gets logged.
 
-    It is call by :func:`~sbws.core.scanner.wait_for_results` when
-    the time waiting for the results was long.
+    It is call by :func:`~sbws.core.scanner.wait_for_free_slot` and
+    :func:`~sbws.core.scanner.wait_for_results` when the time waiting for the
+    results was long.
 
     To get either the :class:`~sbws.lib.resultdump.Result` or an exception,
     call :meth:`~AsyncResult.get` with timeout.
@@ -726,6 +1303,289 @@ def force_get_results(pending_results):
                         type(e), e, e.__traceback__)))
 
 
+class AsyncioEngine:
+    """State shared by the measurements run by the ``asyncio`` engine.
+
+    With this engine every relay is measured by a coroutine instead of a
+    thread, so that the number of measurements in flight is not bounded by
+    the number of threads. All the coroutines run in the same event loop.
+
+    Calls to the Tor controller are quick, but blocking, so they are run in
+    the default executor, while circuit builds, streams and HTTP downloads
+    do not block the event loop.
+    """
+    def __init__(self, conf, controller, loop):
+        self.controller = controller
+        self.loop = loop
+        self.circuit_events = aio.CircuitEventDispatcher(controller, loop)
+        self.http_timeout = conf.getfloat('general', 'http_timeout')
+        self.socks_addr = None
+        self.stream_lock = None
+
+    async def start(self):
+        """Initialize the attributes that need the loop to be running."""
+        # Create the lock within the loop, so that it is bound to it.
+        self.stream_lock = asyncio.Lock()
+        self.socks_addr = await self.loop.run_in_executor(
+            None, stem_utils.get_socks_info, self.controller)
+        self.circuit_events.start()
+
+    def stop(self):
+        self.circuit_events.stop()
+
+
+async def async_timed_recv_from_server(conn, byte_range):
+    """Same as :func:`timed_recv_from_server`, but using an
+    :class:`~sbws.util.aio.HTTPConnection`."""
+    headers = dict(HTTP_GET_HEADERS, Range=byte_range)
+    wait = reserve_bandwidth(byte_range)
+    if wait:
+        await asyncio.sleep(wait)
+    try:
+        response = await conn.get(headers=headers)
+    except aio.HTTP_EXCEPTIONS as e:
+        log.debug(e)
+        return False, e
+    settings.metrics.inc('sbws_downloaded_bytes_total', response.num_bytes)
+    return True, {'duration': response.duration, 'ttfb': response.ttfb,
+                  'amount': response.num_bytes}
+
+
+async def async_measure_rtt_to_server(conn, conf, dest, content_length):
+    """Same as :func:`measure_rtt_to_server`, to be run as a coroutine."""
+    downloads = RttDownloads(conf, dest, content_length)
+    for random_range in iter(downloads.next_range, None):
+        success, data = await async_timed_recv_from_server(conn, random_range)
+        if not success:
+            return downloads.failed(data)
+        downloads.add(data)
+    return downloads.result()
+
+
+async def async_measure_bandwidth_to_server(conn, conf, dest, content_length,
+                                            initial_amount=None):
+    """Same as :func:`measure_bandwidth_to_server`, to be run as a
+    coroutine."""
+    downloads = BandwidthDownloads(conf, dest, content_length,
+                                   initial_amount=initial_amount)
+    for random_range in iter(downloads.next_range, None):
+        success, data = await async_timed_recv_from_server(conn, random_range)
+        if not success:
+            return downloads.failed(data)
+        downloads.add(data)
+    return downloads.result()
+
+
+async def async_build_circuit(cb, circ_fps, engine):
+    """Build a circuit without blocking the event loop.
+
+    Tor is asked to build the circuit without waiting for it, then
+    the coroutine waits for the ``CIRC`` event that says the circuit was
+    built or failed.
+
+    :returns tuple: circuit id if the circuit was built, error if there
+        was an error building the circuit.
+    """
+    circ_id, reason = await engine.loop.run_in_executor(
+        None, functools.partial(cb.build_circuit, circ_fps,
+                                await_build=False))
+    if not circ_id:
+        return None, reason
+    built, reason = await engine.circuit_events.wait_for_circuit(
+        circ_id, cb.circuit_timeout)
+    if not built:
+        settings.metrics.inc('sbws_circuits_total', status='failed')
+        await engine.loop.run_in_executor(None, cb.close_circuit, circ_id)
+        return None, reason
+    settings.metrics.inc('sbws_circuits_total', status='built')
+    return circ_id, None
+
+
+class AsyncioIO:
+    """The I/O of a measurement made by the ``asyncio`` **engine**, an
+    :class:`AsyncioEngine`, without blocking the event loop."""
+    def __init__(self, conf, cb, engine):
+        self.conf = conf
+        self.cb = cb
+        self.engine = engine
+
+    async def run(self, func, *args):
+        """Return ``func(*args)``, a blocking call to the Tor controller,
+        run in the default executor."""
+        return await self.engine.loop.run_in_executor(None, func, *args)
+
+    async def open(self):
+        """Return whether the downloads can be made through Tor."""
+        return self.engine.socks_addr is not None
+
+    async def build_circuit(self, circ_fps):
+        return await async_build_circuit(self.cb, circ_fps, self.engine)
+
+    async def connect(self, dest, circ_id):
+        return await async_connect_to_destination_over_circuit(
+            dest, circ_id, self.cb.controller, self.engine.socks_addr,
+            dest._max_dl, self.engine.http_timeout, self.engine.stream_lock,
+            stream_router=self.cb.stream_router)
+
+    async def measure_rtt(self, dest, usable_data):
+        return await async_measure_rtt_to_server(
+            usable_data['connection'], self.conf, dest,
+            usable_data['content_length'])
+
+    async def measure_bandwidth(self, dest, usable_data, initial_amount):
+        return await async_measure_bandwidth_to_server(
+            usable_data['connection'], self.conf, dest,
+            usable_data['content_length'], initial_amount=initial_amount)
+
+    def close(self, usable_data):
+        """Close the connection of **usable_data**, returned by
+        :meth:`connect`."""
+        usable_data['connection'].close()
+
+
+async def async_measure_relay(args, conf, destinations, cb, rl, relay,
+                              engine, initial_amount=None):
+    """Same as :func:`measure_relay`, to be run as a coroutine by the
+    ``asyncio`` engine.
+
+    :return Result: a measurement Result object
+
+    """
+    return await measure_relay_with(
+        AsyncioIO(conf, cb, engine), conf, destinations, cb, rl, relay,
+        initial_amount=initial_amount)
+
+
+async def async_dispatch_worker(args, conf, destinations, cb, rl, target,
+                                engine, callback, initial_amount=None):
+    """Measure **target** and pass the result to **callback**, as
+    :func:`dispatch_worker_thread` and the pool callbacks do for the threads
+    engine."""
+    if not destinations.functional_destinations or \
+            settings.end_event.is_set():
+        return
+    try:
+        result = await async_measure_relay(
+            args, conf, destinations, cb, rl, target, engine,
+            initial_amount=initial_amount)
+    except Exception as e:
+        result_putter_error(target)(e)
+        return
+    # ``callback`` might block up to some seconds when the queue is full.
+    await engine.loop.run_in_executor(None, callback, result)
+
+
+async def async_main_loop(args, conf, controller, relay_list, circuit_builder,
+                          result_dump, relay_prioritizer, destinations,
+                          engine):
+    """Same as :func:`main_loop`, but measuring the relays with coroutines.
+
+    Up to ``measurement_threads`` relays are measured at the same time.
+    Since coroutines are cheap, this number can be much higher than with
+    the threads engine.
+
+    As in :func:`main_loop`, a new measurement starts as soon as another
+    finishes, relays that are still being measured are skipped and a new
+    ordered list of relays is obtained without waiting for the pending
+    measurements.
+
+    It returns when sbws is stopping or, in a testing network, after the
+    first loop.
+    """
+    log.info("Started the asyncio main loop to measure the relays.")
+    loop = engine.loop
+    hbeat = Heartbeat(conf.getpath('paths', 'state_fname'))
+    semaphore = asyncio.Semaphore(conf.getint('scanner',
+                                              'measurement_threads'))
+    callback = result_putter(result_dump)
+    # Fingerprint of the relays being measured and their tasks.
+    pending = {}
+    register_gauges(conf.getint('scanner', 'measurement_threads'), pending)
+
+    def finished(fingerprint, task):
+        pending.pop(fingerprint, None)
+        semaphore.release()
+
+    await engine.start()
+    while not settings.end_event.is_set():
+        log.debug("Starting a new measurement loop.")
+        num_relays = 0
+        loop_tstart = time.time()
+        # Obtaining the relays might need to refresh the consensus.
+        relays_fingerprints = await loop.run_in_executor(
+            None, lambda: relay_list.relays_fingerprints)
+        hbeat.register_consensus_fprs(relays_fingerprints)
+        targets = await loop.run_in_executor(
+            None, lambda: list(relay_prioritizer.best_priority()))
+        for i, target in enumerate(targets):
+            if settings.end_event.is_set():
+                break
+            if target.fingerprint in pending:
+                log.debug("%s is still being measured, skipping it.",
+                          target.fingerprint)
+                continue
+            # Build the circuits for the next relays while waiting.
+            upcoming = [r for r in
+                        targets[i + 1:i + 1 + circuit_builder.prefetch_size]
+                        if r.fingerprint not in pending]
+            await loop.run_in_executor(
+                None, prefetch_circuits, upcoming, destinations, relay_list,
+                circuit_builder)
+            # Wait for a free measurement slot.
+            await semaphore.acquire()
+            if settings.bandwidth_budget is not None:
+                await asyncio.sleep(settings.bandwidth_budget.wait_time())
+            if settings.end_event.is_set():
+                semaphore.release()
+                break
+            target.increment_relay_recent_measurement_attempt()
+            num_relays += 1
+            initial_amount = initial_expected_amount(
+                conf, target, result_dump.results_for_relay(target))
+            task = loop.create_task(async_dispatch_worker(
+                args, conf, destinations, circuit_builder, relay_list,
+                target, engine, callback, initial_amount=initial_amount))
+            pending[target.fingerprint] = task
+            task.add_done_callback(
+                functools.partial(finished, target.fingerprint))
+            hbeat.register_measured_fpr(target.fingerprint)
+        # When all the relays with the best priority are still being
+        # measured, wait for some measurement to finish before prioritizing
+        # again.
+        if num_relays == 0 and pending:
+            await asyncio.wait(list(pending.values()),
+                               timeout=TIMEOUT_MEASUREMENTS,
+                               return_when=asyncio.FIRST_COMPLETED)
+        elif num_relays == 0:
+            await asyncio.sleep(TIMEOUT_MEASUREMENTS)
+        hbeat.print_heartbeat_message()
+        loop_tdelta = (time.time() - loop_tstart) / 60
+        log.debug("Attempted to measure %s relays in %s minutes",
+                  num_relays, loop_tdelta)
+        testing_network = await loop.run_in_executor(
+            None, controller.get_conf, 'TestingTorNetwork')
+        if testing_network == '1':
+            log.info("In a testing network, exiting after the first loop.")
+            if pending:
+                await asyncio.wait(list(pending.values()))
+            break
+
+
+def run_async_main_loop(args, conf, controller, relay_list, circuit_builder,
+                        result_dump, relay_prioritizer, destinations):
+    """Run :func:`async_main_loop` in a new event loop until it returns."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = AsyncioEngine(conf, controller, loop)
+    try:
+        loop.run_until_complete(async_main_loop(
+            args, conf, controller, relay_list, circuit_builder,
+            result_dump, relay_prioritizer, destinations, engine))
+    finally:
+        engine.stop()
+        loop.close()
+
+
 def run_speedtest(args, conf):
     """Initializes all the data and threads needed to measure the relays.
 
@@ -740,10 +1600,13 @@ def run_speedtest(args, conf):
     It initializes the thread pool that will launch the measurement threads.
     The pool starts 3 other threads that are not the measurement (worker)
     threads.
+    When the ``engine`` is ``asyncio``, it starts an event loop that
+    measures the relays with coroutines instead.
     Finally, it calls the function that will manage the measurement threads.
 
     """
-    global rd, pool, controller
+    global rd, pool, controller, metrics_server, bw_file_generator, \
+        circuit_builder
 
     controller = stem_utils.launch_or_connect_to_tor(conf)
 
@@ -758,20 +1621,47 @@ def run_speedtest(args, conf):
     # Call only once to initialize http_headers
     settings.init_http_headers(conf.get('scanner', 'nickname'), state['uuid'],
                                state['tor_version'])
+    settings.init_bandwidth_budget(conf.getint('scanner', 'bandwidth_budget'))
     # To do not have to pass args and conf to RelayList, pass an extra
     # argument with the data_period
     measurements_period = conf.getint('general', 'data_period')
     rl = RelayList(args, conf, controller, measurements_period, state)
-    cb = CB(args, conf, controller, rl)
+    # Attach the streams to the circuits with a single listener, when Tor
+    # supports it.
+    stream_router = stem_utils.StreamRouter(controller)
+    if not stream_router.start():
+        stream_router = None
+    cb = CB(args, conf, controller, rl, stream_router=stream_router)
+    circuit_builder = cb
     rd = ResultDump(args, conf)
     rp = RelayPrioritizer(args, conf, rl, rd)
     destinations, error_msg = DestinationList.from_config(
         conf, cb, rl, controller)
     if not destinations:
         fail_hard(error_msg)
+    settings.metrics.set_gauge(
+        'sbws_result_queue_size', lambda: rd.queue.qsize())
+    settings.metrics.set_gauge(
+        'sbws_functional_destinations',
+        lambda: len(destinations.functional_destinations))
+    if settings.bandwidth_budget is not None:
+        settings.metrics.set_gauge(
+            'sbws_bandwidth_budget_utilization',
+            settings.bandwidth_budget.utilization)
+    metrics_server = start_metrics_server(conf)
+    if conf.getint('scanner', 'generate_interval'):
+        bw_file_generator = BwFileGenerator(
+            conf, rd, conf.getint('scanner', 'generate_interval'))
+        bw_file_generator.start()
     max_pending_results = conf.getint('scanner', 'measurement_threads')
-    pool = Pool(max_pending_results)
     try:
+        if conf['scanner']['engine'] == 'asyncio':
+            run_async_main_loop(args, conf, controller, rl, cb, rd, rp,
+                                destinations)
+            # The loop only returns when sbws is stopping or after the first
+            # loop in a testing network.
+            stop_threads(signal.SIGTERM, None)
+        pool = Pool(max_pending_results)
         main_loop(args, conf, controller, rl, cb, rd, rp, destinations, pool)
     except KeyboardInterrupt:
         log.info("Interrupted by the user.")
@@ -162,7 +162,8 @@ def main(args, conf):
 
     fresh_days = conf.getint('general', 'data_period')
     results = load_recent_results_in_datadir(
-        fresh_days, datadir, success_only=False)
+        fresh_days, datadir, success_only=False,
+        processes=conf.getint('general', 'load_results_processes'))
     if len(results) < 1:
         log.warning('No fresh results')
         return
@@ -17,6 +17,12 @@ RESULT_VERSION = 4
 WIRE_VERSION = 1
 SPEC_VERSION = '1.5.0'
 
+# Tor version since which the STREAM events include the SOCKS username, used
+# to know to which circuit a new stream should be attached.
+TOR_VERSION_STREAM_SOCKS_USERNAME = '0.4.1.1-alpha'
+# The SOCKS username is different for every stream, the password is not used.
+SOCKS_PASSWORD = 'sbws'
+
 # This is a dictionary of torrc options we always want to set when launching
 # Tor and that do not depend on any runtime configuration
 # Options that are known at runtime (from configuration file) are added
@@ -146,6 +152,29 @@ HTTP_GET_HEADERS = {
     'Range': '{}',
     'Accept-Encoding': 'identity',
 }
+# Number of bytes read from the network at a time while downloading, so that
+# the memory used does not depend on the size of the download.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Upper bounds, in seconds, of the buckets of the histograms of the time
+# spent in every measurement phase.
+PHASE_HISTOGRAM_BUCKETS = [
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250]
+# Why the scanner stopped downloading data to measure a relay: it got
+# ``num_downloads`` downloads, the download rates were stable enough or sbws
+# is stopping.
+DOWNLOADS_STOP_NUM_DOWNLOADS = 'num_downloads'
+DOWNLOADS_STOP_STABLE = 'stable'
+DOWNLOADS_STOP_STOPPING = 'stopping'
+# Two-sided 95% quantiles of the Student's t distribution by degrees of
+# freedom, to calculate the confidence interval of the download rates.
+# Between the degrees of freedom in the table, the previous value is used,
+# which is slightly bigger.
+STUDENT_T_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 11: 2.201, 12: 2.179, 13: 2.160,
+    14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+    20: 2.086, 25: 2.060, 30: 2.042, 40: 2.021, 60: 2.000, 120: 1.980,
+}
 DESTINATION_VERIFY_CERTIFICATE = True
 # This number might need adjusted depending on the percentage of circuits and
 # HTTP requests failures.
@@ -1,6 +1,13 @@
 from stem import CircuitExtensionFailed, InvalidRequest, ProtocolError, Timeout
 from stem import InvalidArguments, ControllerError, SocketClosed
+from stem import CircStatus
+from collections import OrderedDict
+from multiprocessing.dummy import Pool
+from threading import Condition, RLock
 import logging
+import time
+
+from sbws import settings
 
 log = logging.getLogger(__name__)
 
@@ -25,8 +32,11 @@ class CircuitBuilder:
     '''
     # XXX: In new major version, remove args and conf, they are not used.
     def __init__(self, args, conf, controller, relay_list=None,
-                 close_circuits_on_exit=True):
+                 close_circuits_on_exit=True, stream_router=None):
         self.controller = controller
+        # A running ``sbws.util.stem.StreamRouter`` to attach the streams to
+        # the circuits, or None to attach them one by one.
+        self.stream_router = stream_router
         self.built_circuits = set()
         self.close_circuits_on_exit = close_circuits_on_exit
         self.circuit_timeout = conf.getint('general', 'circuit_timeout')
@@ -38,9 +48,14 @@ class CircuitBuilder:
         except (InvalidArguments, InvalidRequest, SocketClosed) as e:
             log.debug(e)
         self.built_circuits.discard(circ_id)
+        if self.stream_router is not None:
+            self.stream_router.remove_routes(circ_id)
 
-    def _build_circuit_impl(self, path):
+    def _build_circuit_impl(self, path, await_build=True):
         """
+        :param bool await_build: whether to block until the circuit is built.
+            When False, the circuit id is returned as soon as Tor accepts to
+            build it and the caller has to wait for the ``CIRC`` events.
         :returns tuple: circuit id if the circuit was built, error if there
             was an error building the circuit.
         """
@@ -52,10 +67,13 @@ class CircuitBuilder:
         log.debug('Building %s', fp_path)
         try:
             circ_id = c.new_circuit(
-                path, await_build=True, timeout=timeout)
+                path, await_build=await_build, timeout=timeout)
         except (InvalidRequest, CircuitExtensionFailed,
                 ProtocolError, Timeout, SocketClosed) as e:
+            settings.metrics.inc('sbws_circuits_total', status='failed')
             return None, str(e)
+        if await_build:
+            settings.metrics.inc('sbws_circuits_total', status='built')
         return circ_id, None
 
     def __del__(self):
@@ -79,11 +97,30 @@ class CircuitBuilder:
 # build the circuit, the relays are not just choosen as random as this class
 # does.
 class GapsCircuitBuilder(CircuitBuilder):
-    """Same as ``CircuitBuilder`` but implements build_circuit."""
-    def __init__(self, *a, **kw):
-        super().__init__(*a, **kw)
-
-    def build_circuit(self, path):
+    """Same as ``CircuitBuilder`` but implements build_circuit.
+
+    It can also build circuits in advance (prefetch), while other relays are
+    being measured, so that the time to build a circuit overlaps with the
+    time to download data.
+    At most ``circuit_prefetch`` circuits are being built or waiting to be
+    used, and they are closed if they are not used in
+    ``circuit_prefetch_ttl`` seconds.
+    """
+    def __init__(self, args, conf, *a, **kw):
+        super().__init__(args, conf, *a, **kw)
+        self.prefetch_size = conf.getint('scanner', 'circuit_prefetch')
+        self.prefetch_ttl = conf.getint('scanner', 'circuit_prefetch_ttl')
+        self._prefetch_lock = RLock()
+        # Notified when a circuit being built in advance is built or fails.
+        self._prefetch_done = Condition(self._prefetch_lock)
+        # Keys of the circuits being built in advance.
+        self._prefetching = set()
+        # Circuits built in advance, by key, in the order they were built.
+        self._prefetched = OrderedDict()
+        self._prefetch_pool = Pool(self.prefetch_size) \
+            if self.prefetch_size > 0 else None
+
+    def build_circuit(self, path, await_build=True):
         """Return parent class build circuit method.
 
         Since sbws is only building 2 hop paths, there is no need to add random
@@ -91,4 +128,111 @@ class GapsCircuitBuilder(CircuitBuilder):
         ``Relay`` objects.
 
         """
-        return self._build_circuit_impl(path)
+        return self._build_circuit_impl(path, await_build=await_build)
+
+    def can_prefetch(self, key):
+        """Whether a circuit for **key** can be built in advance.
+
+        It is False when prefetching is disabled, there is already a circuit
+        for **key** or there are already ``circuit_prefetch`` circuits.
+        """
+        if self._prefetch_pool is None:
+            return False
+        self._expire_prefetched_circuits()
+        with self._prefetch_lock:
+            if key in self._prefetching or key in self._prefetched:
+                return False
+            return (len(self._prefetching) + len(self._prefetched)
+                    < self.prefetch_size)
+
+    def prefetch_circuit(self, key, path, data=None):
+        """Build a circuit with **path** in the background.
+
+        It can be obtained later with :meth:`take_prefetched_circuit` and the
+        same **key**, together with **data**.
+
+        :returns bool: whether the circuit is going to be built.
+        """
+        if not self.can_prefetch(key):
+            return False
+        with self._prefetch_lock:
+            # Prefetching might have been stopped meanwhile.
+            if self._prefetch_pool is None:
+                return False
+            self._prefetching.add(key)
+            self._prefetch_pool.apply_async(
+                self._prefetch_circuit_impl, (key, path, data))
+        return True
+
+    def _prefetch_circuit_impl(self, key, path, data):
+        circ_id, reason = None, None
+        try:
+            circ_id, reason = self._build_circuit_impl(path)
+        finally:
+            with self._prefetch_lock:
+                self._prefetching.discard(key)
+                if circ_id:
+                    self.built_circuits.add(circ_id)
+                    self._prefetched[key] = (circ_id, path, data,
+                                             time.monotonic())
+                self._prefetch_done.notify_all()
+        if not circ_id:
+            log.debug('Could not prefetch circuit %s: %s', path, reason)
+
+    def _expire_prefetched_circuits(self):
+        oldest_allowed = time.monotonic() - self.prefetch_ttl
+        with self._prefetch_lock:
+            expired = [k for k, v in self._prefetched.items()
+                       if v[3] < oldest_allowed]
+            circ_ids = [self._prefetched.pop(k)[0] for k in expired]
+        for circ_id in circ_ids:
+            log.debug('Closing prefetched circuit %s, not used in %s seconds.',
+                      circ_id, self.prefetch_ttl)
+            self.close_circuit(circ_id)
+
+    def take_prefetched_circuit(self, key):
+        """Return the circuit id, the path and the data of a circuit built in
+        advance for **key**, or None if there is not a fresh one.
+
+        If the circuit is still being built, it waits for it, so that the
+        caller does not build other circuit for the same relay.
+        The caller owns the circuit and has to close it.
+        """
+        if self._prefetch_pool is None:
+            return None
+        with self._prefetch_lock:
+            self._prefetch_done.wait_for(
+                lambda: key not in self._prefetching)
+        self._expire_prefetched_circuits()
+        with self._prefetch_lock:
+            entry = self._prefetched.pop(key, None)
+        if entry is None:
+            return None
+        circ_id, path, data, _ = entry
+        # Tor might have closed the circuit meanwhile.
+        try:
+            circ = self.controller.get_circuit(circ_id, default=None)
+        except (ControllerError, SocketClosed) as e:
+            log.debug(e)
+            circ = None
+        if circ is None or circ.status != CircStatus.BUILT:
+            # It might still exist, for instance while being extended.
+            self.close_circuit(circ_id)
+            return None
+        return circ_id, path, data
+
+    def stop_prefetching(self):
+        """Stop building circuits in advance, wait for the ones being built
+        and close all of them, so that no circuits are built while sbws is
+        stopping."""
+        with self._prefetch_lock:
+            pool, self._prefetch_pool = self._prefetch_pool, None
+        if pool is None:
+            return
+        pool.close()
+        pool.join()
+        with self._prefetch_lock:
+            circ_ids = [v[0] for v in self._prefetched.values()]
+            self._prefetched.clear()
+        for circ_id in circ_ids:
+            self.close_circuit(circ_id)
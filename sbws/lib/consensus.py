@@ -0,0 +1,133 @@
+"""Router statuses of the cached consensus, parsed only once for every
+consensus and stored in a compact table until the consensus changes."""
+import collections
+import hashlib
+import logging
+import json
+import os
+import re
+from threading import Lock
+
+from stem.descriptor import parse_file
+
+log = logging.getLogger(__name__)
+
+#: The values of a router status used to generate the bandwidth file.
+RouterStatus = collections.namedtuple(
+    'RouterStatus', ['fingerprint', 'bandwidth', 'is_unmeasured', 'flags'])
+
+#: Version of the format of the consensus cache file.
+CONSENSUS_CACHE_VERSION = 1
+
+#: Number of consensuses whose router statuses are kept in memory.
+ROUTER_STATUSES_MEMO_SIZE = 2
+
+# The key and router statuses of the last consensuses read by consensus path,
+# the most recently read at the end.
+_router_statuses = collections.OrderedDict()
+_router_statuses_lock = Lock()
+
+
+def consensus_key(consensus_path):
+    """Return the valid-after time and the SHA-256 digest of the consensus in
+    **consensus_path**, that identify it."""
+    with open(consensus_path, 'rb') as fd:
+        data = fd.read()
+    match = re.search(rb'^valid-after (.*)$', data, re.MULTILINE)
+    valid_after = match.group(1).decode('ascii') if match else None
+    return valid_after, hashlib.sha256(data).hexdigest()
+
+
+def read_valid_after(consensus_path):
+    """Return the valid-after time of the consensus in **consensus_path**,
+    reading only its header, or None when it is not found."""
+    with open(consensus_path, 'rb') as fd:
+        for line in fd:
+            if line.startswith(b'valid-after '):
+                return line[len(b'valid-after '):].strip().decode('ascii')
+            if line.startswith(b'r '):
+                break
+    return None
+
+
+def _parse_router_statuses(consensus_path):
+    return {
+        rs.fingerprint: RouterStatus(
+            rs.fingerprint, rs.bandwidth, rs.is_unmeasured,
+            frozenset(rs.flags))
+        for rs in parse_file(consensus_path)
+    }
+
+
+def _read_cache(cache_fname, key):
+    """Return the router statuses in the cache file **cache_fname**, or None
+    when it does not exist or it is for other consensus."""
+    if not cache_fname or not os.path.isfile(cache_fname):
+        return None
+    try:
+        with open(cache_fname, 'rt') as fd:
+            cache = json.load(fd)
+        if cache['version'] != CONSENSUS_CACHE_VERSION \
+                or tuple(cache['key']) != key:
+            return None
+        return {fingerprint: RouterStatus(
+                    fingerprint, bandwidth, is_unmeasured, frozenset(flags))
+                for fingerprint, bandwidth, is_unmeasured, flags
+                in cache['router_statuses']}
+    # A file from an incompatible version of sbws or that was truncated.
+    except Exception as e:
+        log.debug('Could not read the consensus cache %s: %s',
+                  cache_fname, e)
+        return None
+
+
+def _write_cache(cache_fname, key, router_statuses_d):
+    tmp_fname = cache_fname + '.tmp'
+    try:
+        with open(tmp_fname, 'wt') as fd:
+            json.dump({
+                'version': CONSENSUS_CACHE_VERSION,
+                'key': key,
+                'router_statuses': [
+                    [rs.fingerprint, rs.bandwidth, rs.is_unmeasured,
+                     sorted(rs.flags)]
+                    for rs in router_statuses_d.values()],
+            }, fd)
+        os.replace(tmp_fname, cache_fname)
+    except OSError as e:
+        log.warning('Could not write the consensus cache %s: %s',
+                    cache_fname, e)
+
+
+def read_router_statuses(consensus_path, cache_fname=None):
+    """Return the router statuses of the consensus in **consensus_path** by
+    fingerprint.
+
+    The consensus is only parsed the first time it is read. Its router
+    statuses are kept in memory, with the ones of the last
+    ``ROUTER_STATUSES_MEMO_SIZE`` consensuses read, and, when **cache_fname**
+    is given, written to that file, so that other processes do not parse it
+    again either.
+    They are used until the valid-after time or the digest of the consensus
+    change.
+
+    :raises FileNotFoundError: when the consensus does not exist.
+    """
+    key = consensus_key(consensus_path)
+    with _router_statuses_lock:
+        loaded = _router_statuses.get(consensus_path)
+        if loaded is not None and loaded[0] == key:
+            _router_statuses.move_to_end(consensus_path)
+            return loaded[1]
+        router_statuses_d = _read_cache(cache_fname, key)
+        if router_statuses_d is None:
+            log.debug('Parsing the consensus %s valid after %s.',
+                      consensus_path, key[0])
+            router_statuses_d = _parse_router_statuses(consensus_path)
+            if cache_fname:
+                _write_cache(cache_fname, key, router_statuses_d)
+        _router_statuses[consensus_path] = (key, router_statuses_d)
+        _router_statuses.move_to_end(consensus_path)
+        while len(_router_statuses) > ROUTER_STATUSES_MEMO_SIZE:
+            _router_statuses.popitem(last=False)
+        return router_statuses_d
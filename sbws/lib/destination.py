@@ -1,3 +1,4 @@
+import asyncio
 import collections
 import datetime
 import logging
@@ -6,8 +7,10 @@ import requests
 from urllib.parse import urlparse
 from stem.control import EventType
 
-from sbws.globals import DESTINATION_VERIFY_CERTIFICATE
+from sbws.globals import DESTINATION_VERIFY_CERTIFICATE, SOCKS_PASSWORD
 import sbws.util.stem as stem_utils
+from sbws.util import aio
+from sbws.util.requests import set_socks_username
 from ..globals import (
     MAX_NUM_DESTINATION_FAILURES,
     DELTA_SECONDS_RETRY_DESTINATION,
@@ -62,7 +65,8 @@ def _parse_verify_option(conf_section):
     return verify
 
 
-def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
+def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl,
+                                        stream_router=None):
     '''
     Connect to **dest* over the given **circ_id** using the given Requests
     **session**. Make sure the destination seems usable. Return True and a
@@ -96,6 +100,10 @@ def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
     :param session Session: the Requests library session object to use to make
         the connection.
     :param cont Controller: them Stem library controller controlling Tor
+    :param stream_router StreamRouter: when it is running, the **session**
+        opens the streams with a SOCKS username routed to **circ_id**,
+        otherwise a stream listener is added while holding
+        ``stream_building_lock``.
     :returns: True and a dictionary if everything is in order and measurements
         should commence.  False and an error string otherwise.
     '''
@@ -105,36 +113,131 @@ def connect_to_destination_over_circuit(dest, circ_id, session, cont, max_dl):
     if settings.end_event.is_set():
         return False, "Shutting down."
     error_prefix = 'When sending HTTP HEAD to {}, '.format(dest.url)
+    try:
+        if stream_router is not None and stream_router.is_running:
+            # The streams of the session will be attached to the circuit
+            # until it is closed.
+            set_socks_username(session, stream_router.add_route(circ_id))
+            head = session.head(dest.url, verify=dest.verify)
+        else:
+            head = _head_attaching_stream(dest, circ_id, session, cont)
+    except requests.exceptions.RequestException as e:
+        dest.add_failure()
+        return False, 'Could not connect to {} over circ {} {}: {}'.format(
+            dest.url, circ_id, stem_utils.circuit_str(cont, circ_id), e)
+    if head.status_code != requests.codes.ok:
+        dest.add_failure()
+        return False, error_prefix + 'we expected HTTP code '\
+            '{} not {}'.format(requests.codes.ok, head.status_code)
+    if 'content-length' not in head.headers:
+        dest.add_failure()
+        return False, error_prefix + 'we expect the header Content-Length '\
+            'to exist in the response'
+    content_length = int(head.headers['content-length'])
+    if max_dl > content_length:
+        dest.add_failure()
+        return False, error_prefix + 'our maximum configured download size '\
+            'is {} but the content is only {}'.format(max_dl, content_length)
+    log.debug('Connected to %s over circuit %s', dest.url, circ_id)
+    # Any failure connecting to the destination will call add_failure,
+    # It can not be set at the start, to be able to know whether it is
+    # failing consecutive times.
+    dest.add_success()
+    return True, {'content_length': content_length}
+
+
+def _head_attaching_stream(dest, circ_id, session, cont):
     with stem_utils.stream_building_lock:
         listener = stem_utils.attach_stream_to_circuit_listener(cont, circ_id)
         stem_utils.add_event_listener(cont, listener, EventType.STREAM)
         try:
-            head = session.head(dest.url, verify=dest.verify)
-        except requests.exceptions.RequestException as e:
-            dest.add_failure()
-            return False, 'Could not connect to {} over circ {} {}: {}'.format(
-                dest.url, circ_id, stem_utils.circuit_str(cont, circ_id), e)
+            return session.head(dest.url, verify=dest.verify)
         finally:
             stem_utils.remove_event_listener(cont, listener)
+
+
+async def async_connect_to_destination_over_circuit(dest, circ_id, cont,
+                                                    socks_addr, max_dl,
+                                                    timeout, stream_lock,
+                                                    stream_router=None):
+    """Same as :func:`connect_to_destination_over_circuit`, but to be run
+    as a coroutine by the scanner ``asyncio`` engine.
+
+    Instead of a Requests session, it opens an
+    :class:`~sbws.util.aio.HTTPConnection` through the SOCKS proxy at
+    **socks_addr** and returns it in the dictionary, with the key
+    ``connection``, so that the measurements are made over the same stream.
+    The caller must close it.
+
+    When **stream_router** is running, the stream is opened with a SOCKS
+    username routed to **circ_id**. Otherwise, **stream_lock**, an
+    ``asyncio.Lock``, is held while the stream is attached to the circuit.
+    """
+    assert isinstance(dest, Destination)
+    log.debug("Connecting to destination over circuit.")
+    # Do not start if sbws is stopping
+    if settings.end_event.is_set():
+        return False, "Shutting down."
+    loop = asyncio.get_event_loop()
+    error_prefix = 'When sending HTTP HEAD to {}, '.format(dest.url)
+    try:
+        if stream_router is not None and stream_router.is_running:
+            conn = await aio.HTTPConnection.open(
+                dest.url, socks_addr, verify=dest.verify,
+                headers=settings.HTTP_HEADERS, timeout=timeout,
+                socks_username=stream_router.add_route(circ_id),
+                socks_password=SOCKS_PASSWORD)
+        else:
+            conn = await _async_open_attaching_stream(
+                dest, circ_id, cont, socks_addr, timeout, stream_lock)
+    except aio.HTTP_EXCEPTIONS as e:
+        dest.add_failure()
+        circ_str = await loop.run_in_executor(
+            None, stem_utils.circuit_str, cont, circ_id)
+        return False, 'Could not connect to {} over circ {} {}: {}'.format(
+            dest.url, circ_id, circ_str, e)
+    try:
+        head = await conn.head()
+    except aio.HTTP_EXCEPTIONS as e:
+        conn.close()
+        dest.add_failure()
+        return False, error_prefix + 'got {}'.format(e)
     if head.status_code != requests.codes.ok:
+        conn.close()
         dest.add_failure()
         return False, error_prefix + 'we expected HTTP code '\
             '{} not {}'.format(requests.codes.ok, head.status_code)
     if 'content-length' not in head.headers:
+        conn.close()
         dest.add_failure()
         return False, error_prefix + 'we expect the header Content-Length '\
             'to exist in the response'
     content_length = int(head.headers['content-length'])
     if max_dl > content_length:
+        conn.close()
         dest.add_failure()
         return False, error_prefix + 'our maximum configured download size '\
             'is {} but the content is only {}'.format(max_dl, content_length)
     log.debug('Connected to %s over circuit %s', dest.url, circ_id)
-    # Any failure connecting to the destination will call add_failure,
-    # It can not be set at the start, to be able to know whether it is
-    # failing consecutive times.
     dest.add_success()
-    return True, {'content_length': content_length}
+    return True, {'content_length': content_length, 'connection': conn}
+
+
+async def _async_open_attaching_stream(dest, circ_id, cont, socks_addr,
+                                       timeout, stream_lock):
+    loop = asyncio.get_event_loop()
+    async with stream_lock:
+        listener = stem_utils.attach_stream_to_circuit_listener(cont, circ_id)
+        await loop.run_in_executor(
+            None, stem_utils.add_event_listener, cont, listener,
+            EventType.STREAM)
+        try:
+            return await aio.HTTPConnection.open(
+                dest.url, socks_addr, verify=dest.verify,
+                headers=settings.HTTP_HEADERS, timeout=timeout)
+        finally:
+            await loop.run_in_executor(
+                None, stem_utils.remove_event_listener, cont, listener)
 
 
 class Destination:
@@ -4,6 +4,7 @@ Classes and functions to implement a heartbeat system to monitor the progress.
 import logging
 import time
 
+from .. import settings
 from ..util.state import State
 
 
@@ -60,6 +61,15 @@ class Heartbeat(object):
                  len(self.measured_fp_set), new_measured_percent,
                  main_loop_tdelta)
         log.info("%s relays still not measured.", len(not_measured_fp_set))
+        settings.phase_histograms.log_summary()
+        # So that external tools can read them.
+        self.state_dict['measurement_phases'] = \
+            settings.phase_histograms.to_dict()
+        if settings.bandwidth_budget is not None:
+            log.info("Used %s%% of the bandwidth budget in the last %s "
+                     "seconds.",
+                     round(settings.bandwidth_budget.utilization() * 100),
+                     settings.bandwidth_budget.window)
 
         # The case when it is equal will only happen when all the relays
         # have been measured.
@@ -3,6 +3,12 @@ from statistics import mean
 from sbws.globals import RELAY_TYPES
 from sbws.util.stem import rs_relay_type
 
+try:
+    import numpy
+# NumPy is optional, without it the bandwidth lines are scaled one by one.
+except ImportError:
+    numpy = None
+
 
 def bw_measurements_from_results(results):
     return [
@@ -11,11 +17,12 @@ def bw_measurements_from_results(results):
     ]
 
 
-def bw_filt(bw_measurements):
+def bw_filt(bw_measurements, mu=None):
     """Filtered bandwidth for a relay.
 
     It is the equivalent to Torflow's ``filt_sbw``.
-    ``mu`` in this function is the equivalent to Torflow's ``sbw``.
+    ``mu`` in this function is the equivalent to Torflow's ``sbw``. It is
+    the rounded mean of **bw_measurements**, calculated here when not given.
     """
     # It's safe to return 0 here, because:
     # 1. this value will be the numerator when calculating the ratio.
@@ -26,7 +33,8 @@ def bw_filt(bw_measurements):
         return 0
     # Torflow is rounding to an integer, so is `bw_mean_from_results` in
     # `v3bwfile.py`
-    mu = round(mean(bw_measurements))
+    if mu is None:
+        mu = round(mean(bw_measurements))
     bws_gte_mean = list(filter(lambda bw: bw >= mu, bw_measurements))
     if bws_gte_mean:
         return round(mean(bws_gte_mean))
@@ -51,3 +59,38 @@ def network_means_by_relay_type(bw_lines, router_statuses_d):
             mu_type[rt] = mean([line.bw_mean for line in bw_lines_type]) or 1
             muf_type[rt] = mean([line.bw_filt for line in bw_lines_type]) or 1
     return mu_type, muf_type
+
+
+def relay_type_indexes(bw_lines, router_statuses_d):
+    """Return an array with the index in ``RELAY_TYPES`` of the type of the
+    relay of every line, as assigned in :func:`network_means_by_relay_type`.
+    """
+    indexes = []
+    for line in bw_lines:
+        rs = None
+        if router_statuses_d:
+            rs = router_statuses_d.get(line.node_id.replace("$", ""), None)
+        indexes.append(RELAY_TYPES.index(rs_relay_type(rs)))
+    return numpy.array(indexes, dtype=int)
+
+
+def network_means_by_relay_type_arrays(bw_means, bw_filts, types):
+    """Like :func:`network_means_by_relay_type`, with the ``bw_mean`` and
+    ``bw_filt`` of the lines in arrays and their relay type indexes in
+    **types**.
+
+    :returns: arrays with the means by relay type index.
+    """
+    # In ``network_means_by_relay_type`` both means are stored in the same
+    # dictionary, so the means of ``bw_filt`` replace the ones of
+    # ``bw_mean``. Return the same values.
+    counts = numpy.bincount(types, minlength=len(RELAY_TYPES))
+    # The bandwidths are integers, so their sums are exact and the means are
+    # the same as with ``statistics.mean``. The means of the types without
+    # lines are not a number.
+    with numpy.errstate(invalid='ignore'):
+        muf = numpy.bincount(types, weights=bw_filts,
+                             minlength=len(RELAY_TYPES)) / counts
+    # Ensure they won't be 0 to avoid division by 0
+    muf[muf == 0] = 1
+    return muf, muf
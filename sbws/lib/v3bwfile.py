@@ -7,17 +7,18 @@
 import copy
 import logging
 import math
+import multiprocessing
 import os
-from itertools import combinations
+import signal
 from statistics import median, mean
-from stem.descriptor import parse_file
 
 from sbws import __version__
 from sbws.globals import (SPEC_VERSION, BW_LINE_SIZE, SBWS_SCALE_CONSTANT,
                           TORFLOW_SCALING, SBWS_SCALING, TORFLOW_BW_MARGIN,
                           TORFLOW_OBS_LAST, TORFLOW_OBS_MEAN,
-                          PROP276_ROUND_DIG, MIN_REPORT, MAX_BW_DIFF_PERC)
-from sbws.lib import scaling
+                          PROP276_ROUND_DIG, MIN_REPORT, MAX_BW_DIFF_PERC,
+                          RELAY_TYPES)
+from sbws.lib import consensus, scaling
 from sbws.lib.resultdump import ResultSuccess, _ResultType
 from sbws.util.filelock import DirectoryLock
 from sbws.util.timestamp import (now_isodt_str, unixts_to_isodt_str,
@@ -301,6 +302,87 @@ def result_type_to_key(type_str):
     return type_str.replace('-', '_')
 
 
+def _relay_results_stats(results, secs_recent=None, secs_away=None):
+    """Obtain the values of the Bandwidth Line of a relay walking its
+    **results** only once.
+
+    The values are the same as the ones returned by the ``V3BWLine``
+    ``*_from_results`` static methods: the ones of the relay from all the
+    results and the ones of the measurements from the successful results
+    more recent than **secs_recent**.
+    Whether the successful results are away from each other is known after
+    walking all of them, as ``results_away_each_other`` returns all or none.
+    """
+    now = now_unixts()
+    type_counts = dict.fromkeys([rt.value for rt in _ResultType], 0)
+    in_recent_consensus_count = 0
+    priority_list = set()
+    measurement_attempt = set()
+    last_time = None
+    num_success = 0
+    min_time = max_time = None
+    recent = {
+        'num': 0, 'bws': [], 'rtts': [], 'desc_bw_obs': [],
+        'desc_bw_avg': None, 'desc_bw_bur': None,
+        'consensus_bandwidth': None,
+        'consensus_bandwidth_is_unmeasured': None,
+        # Results without it after the last one with it.
+        'consensus_bandwidth_is_unmeasured_nones': 0,
+    }
+    for r in results:
+        if r.type in type_counts:
+            type_counts[r.type] += 1
+        in_recent_consensus_count = max(
+            in_recent_consensus_count,
+            len(getattr(r, 'relay_in_recent_consensus', []) or []))
+        # See the workaround for #34309 in ``V3BWLine.from_results``.
+        if getattr(r, "relay_recent_priority_list", None):
+            priority_list.update(r.relay_recent_priority_list)
+        if getattr(r, "relay_recent_measurement_attempt", None):
+            measurement_attempt.update(r.relay_recent_measurement_attempt)
+        last_time = r.time if last_time is None else max(last_time, r.time)
+        if not isinstance(r, ResultSuccess):
+            continue
+        num_success += 1
+        min_time = r.time if min_time is None else min(min_time, r.time)
+        max_time = r.time if max_time is None else max(max_time, r.time)
+        if secs_recent is not None and (now - r.time) >= secs_recent:
+            continue
+        recent['num'] += 1
+        recent['bws'].extend(dl['amount'] / dl['duration']
+                             for dl in r.downloads)
+        recent['rtts'].extend(round(rtt * 1000) for rtt in r.rtts)
+        # The last values are at the end of the list.
+        if r.relay_average_bandwidth is not None:
+            recent['desc_bw_avg'] = r.relay_average_bandwidth
+        if r.relay_burst_bandwidth is not None:
+            recent['desc_bw_bur'] = r.relay_burst_bandwidth
+        if r.consensus_bandwidth is not None:
+            recent['consensus_bandwidth'] = r.consensus_bandwidth
+        if r.consensus_bandwidth_is_unmeasured is not None:
+            recent['consensus_bandwidth_is_unmeasured'] = \
+                r.consensus_bandwidth_is_unmeasured
+            recent['consensus_bandwidth_is_unmeasured_nones'] = 0
+        else:
+            recent['consensus_bandwidth_is_unmeasured_nones'] += 1
+        if r.relay_observed_bandwidth is not None:
+            recent['desc_bw_obs'].append(r.relay_observed_bandwidth)
+    # Any pair of results is further than ``secs_away`` when the first and
+    # the last ones are.
+    away = (secs_away is None or num_success < 2
+            or max_time - min_time > secs_away)
+    return {
+        'type_counts': type_counts,
+        'relay_in_recent_consensus_count': in_recent_consensus_count,
+        'relay_recent_priority_list_count': len(priority_list),
+        'relay_recent_measurement_attempt_count': len(measurement_attempt),
+        'last_time': last_time,
+        'num_success': num_success,
+        'num_away': num_success if away else 0,
+        'recent': recent,
+    }
+
+
 class V3BWHeader(object):
     """
     Create a bandwidth measurements (V3bw) header
@@ -658,17 +740,15 @@ class V3BWLine(object):
         kwargs['nick'] = results[0].nickname
         if getattr(results[0], 'master_key_ed25519'):
             kwargs['master_key_ed25519'] = results[0].master_key_ed25519
-        kwargs['time'] = cls.last_time_from_results(results)
-        kwargs.update(cls.result_types_from_results(results))
+        stats = _relay_results_stats(results, secs_recent, secs_away)
+        kwargs['time'] = unixts_to_isodt_str(round(stats['last_time']))
+        kwargs.update([(result_type_to_key(type_str), count)
+                       for type_str, count in stats['type_counts'].items()])
 
         # If it has not the attribute, return list to be able to call len
         # If it has the attribute, but it is None, return also list
         kwargs['relay_in_recent_consensus_count'] = str(
-            max([
-                len(getattr(r, 'relay_in_recent_consensus', []) or [])
-                for r in results
-            ])
-        )
+            stats['relay_in_recent_consensus_count'])
 
         # Workaround for #34309.
         # Because of a bug, probably in relaylist, resultdump, relayprioritizer
@@ -677,20 +757,13 @@ class V3BWLine(object):
         # If there is an unexpected failure and the result is not stored, this
         # number would be lower than what would be the correct one.
         # This should happen rarely or never.
-        ts = set([])
-        for r in results:
-            if getattr(r, "relay_recent_priority_list", None):
-                ts.update(r.relay_recent_priority_list)
-        kwargs["relay_recent_priority_list_count"] = str(len(ts))
+        kwargs["relay_recent_priority_list_count"] = str(
+            stats['relay_recent_priority_list_count'])
 
         # Same comment as the previous paragraph.
-        ts = set()
-        for r in results:
-            if getattr(r, "relay_recent_measurement_attempt", None):
-                ts.update(r.relay_recent_measurement_attempt)
-        kwargs["relay_recent_measurement_attempt_count"] = str(len(ts))
+        kwargs["relay_recent_measurement_attempt_count"] = str(
+            stats['relay_recent_measurement_attempt_count'])
 
-        success_results = [r for r in results if isinstance(r, ResultSuccess)]
 
         # NOTE: The following 4 conditions exclude relays from the bandwidth
         # file when the measurements does not satisfy some rules, what makes
@@ -722,41 +795,37 @@ class V3BWLine(object):
 
         exclusion_reason = None
 
-        number_excluded_error = len(results) - len(success_results)
+        number_excluded_error = len(results) - stats['num_success']
         if number_excluded_error > 0:
             # then the number of error results is the number of results
             kwargs['relay_recent_measurements_excluded_error_count'] = \
                 number_excluded_error
-        if not success_results:
+        if not stats['num_success']:
             exclusion_reason = 'recent_measurements_excluded_error_count'
             return (cls(node_id, 1, **kwargs), exclusion_reason)
 
-        results_away = \
-            cls.results_away_each_other(success_results, secs_away)
-        number_excluded_near = len(success_results) - len(results_away)
+        number_excluded_near = stats['num_success'] - stats['num_away']
         if number_excluded_near > 0:
             kwargs['relay_recent_measurements_excluded_near_count'] = \
                 number_excluded_near
-        if not results_away:
+        if not stats['num_away']:
             exclusion_reason = \
                 'recent_measurements_excluded_near_count'
             return (cls(node_id, 1, **kwargs), exclusion_reason)
-        # log.debug("Results away from each other: %s",
-        #           [unixts_to_isodt_str(r.time) for r in results_away])
 
-        results_recent = cls.results_recent_than(results_away, secs_recent)
-        number_excluded_old = len(results_away) - len(results_recent)
+        recent = stats['recent']
+        number_excluded_old = stats['num_away'] - recent['num']
         if number_excluded_old > 0:
             kwargs['relay_recent_measurements_excluded_old_count'] = \
                 number_excluded_old
-        if not results_recent:
+        if not recent['num']:
             exclusion_reason = \
                 'recent_measurements_excluded_old_count'
             return (cls(node_id, 1, **kwargs), exclusion_reason)
 
-        if not len(results_recent) >= min_num:
+        if not recent['num'] >= min_num:
             kwargs['relay_recent_measurements_excluded_few_count'] = \
-                len(results_recent)
+                recent['num']
             # log.debug('The number of results is less than %s', min_num)
             exclusion_reason = \
                 'recent_measurements_excluded_few_count'
@@ -770,14 +839,22 @@ class V3BWLine(object):
             consensus_bandwidth_is_unmeasured = \
                 router_statuses_d[node_id].is_unmeasured
         else:
-            consensus_bandwidth = \
-                cls.consensus_bandwidth_from_results(results_recent)
+            consensus_bandwidth = recent['consensus_bandwidth']
+            if consensus_bandwidth is None:
+                log.warning("Consensus bandwidth is None.")
             consensus_bandwidth_is_unmeasured = \
-                cls.consensus_bandwidth_is_unmeasured_from_results(
-                    results_recent)
+                recent['consensus_bandwidth_is_unmeasured']
+            if recent['consensus_bandwidth_is_unmeasured_nones']:
+                log.warning(
+                    "Consensus bandwidth is unmeasured is None in %d "
+                    "results.",
+                    recent['consensus_bandwidth_is_unmeasured_nones'])
         # If there is no last observed bandwidth, there won't be mean either.
-        desc_bw_obs_last = \
-            cls.desc_bw_obs_last_from_results(results_recent)
+        if recent['desc_bw_obs']:
+            desc_bw_obs_last = recent['desc_bw_obs'][-1]
+        else:
+            desc_bw_obs_last = None
+            log.warning("Descriptor observed bandwidth is None.")
 
         # Exclude also relays without consensus bandwidth nor observed
         # bandwidth, since they can't be scaled
@@ -791,27 +868,32 @@ class V3BWLine(object):
         del kwargs['vote']
         del kwargs['unmeasured']
 
-        rtt = cls.rtt_from_results(results_recent)
+        rtts = recent['rtts']
+        rtt = round(median(rtts)) if rtts else None
         if rtt:
             kwargs['rtt'] = rtt
-        bw = cls.bw_median_from_results(results_recent)
-        # XXX: all the class functions could use the bw_measurements instead of
-        # obtaining them each time or use a class Measurements.
-        bw_measurements = scaling.bw_measurements_from_results(results_recent)
-        kwargs['bw_mean'] = cls.bw_mean_from_results(results_recent)
-        kwargs['bw_filt'] = scaling.bw_filt(bw_measurements)
-        kwargs['bw_median'] = cls.bw_median_from_results(
-            results_recent)
-        kwargs['desc_bw_avg'] = \
-            cls.desc_bw_avg_from_results(results_recent)
-        kwargs['desc_bw_bur'] = \
-            cls.desc_bw_bur_from_results(results_recent)
+        bw_measurements = recent['bws']
+        bw = max(round(median(bw_measurements)), 1) if bw_measurements else 1
+        # It's safe to use 0 as the mean, see ``bw_mean_from_results``.
+        bw_mean = round(mean(bw_measurements)) if bw_measurements else 0
+        kwargs['bw_mean'] = bw_mean
+        kwargs['bw_filt'] = scaling.bw_filt(bw_measurements, mu=bw_mean)
+        kwargs['bw_median'] = bw
+        kwargs['desc_bw_avg'] = recent['desc_bw_avg']
+        if kwargs['desc_bw_avg'] is None:
+            log.warning("Descriptor average bandwidth is None.")
+        kwargs['desc_bw_bur'] = recent['desc_bw_bur']
+        if kwargs['desc_bw_bur'] is None:
+            log.warning("Descriptor burst bandwidth is None.")
         kwargs['consensus_bandwidth'] = consensus_bandwidth
         kwargs['consensus_bandwidth_is_unmeasured'] = \
             consensus_bandwidth_is_unmeasured
         kwargs['desc_bw_obs_last'] = desc_bw_obs_last
-        kwargs['desc_bw_obs_mean'] = \
-            cls.desc_bw_obs_mean_from_results(results_recent)
+        if recent['desc_bw_obs']:
+            kwargs['desc_bw_obs_mean'] = round(mean(recent['desc_bw_obs']))
+        else:
+            kwargs['desc_bw_obs_mean'] = None
+            log.warning("Descriptor observed bandwidth is None.")
 
         bwl = cls(node_id, bw, **kwargs)
         return bwl, None
@@ -843,9 +925,11 @@ class V3BWLine(object):
         #           "secs.", secs_away)
         if secs_away is None or len(results) < 2:
             return results
-        for a, b in combinations(results, 2):
-            if abs(a.time - b.time) > secs_away:
-                return results
+        # Any pair of results is further than ``secs_away`` when the first
+        # and the last ones are.
+        times = [r.time for r in results]
+        if max(times) - min(times) > secs_away:
+            return results
         # log.debug("Results are NOT away from each other in at least %ss: %s",
         #           secs_away, [unixts_to_isodt_str(r.time) for r in results])
         return []
@@ -991,6 +1075,36 @@ class V3BWLine(object):
     def del_relay_type(self):
         delattr(self, "relay_type")
 
+def _bw_lines_from_results(items, secs_recent, secs_away, min_num,
+                           router_statuses_d):
+    """Create the bw lines and exclusion reasons of the relays in **items**,
+    a list of fingerprints and results."""
+    return [V3BWLine.from_results(values, secs_recent, secs_away, min_num,
+                                  router_statuses_d)
+            for _, values in items]
+
+
+# The arguments of ``_bw_lines_from_results`` in the processes of the pool
+# of ``V3BWFile.from_results``, except the relays, that are given as slices.
+# They are set by the pool initializer, so that the results are not pickled
+# for every shard, nor at all when the processes are forked.
+_pool_args = None
+
+
+def _init_bw_lines_pool(*args):
+    global _pool_args
+    _pool_args = args
+    # The processes are forked from sbws, which sets a SIGTERM handler to
+    # stop the scanner threads. Restore the default one, so that the pool
+    # can terminate them.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _bw_lines_from_results_slice(start, stop):
+    items, *args = _pool_args
+    return _bw_lines_from_results(items[start:stop], *args)
+
+
 class V3BWFile(object):
     """
     Create a Bandwidth List file following spec version 1.X.X
@@ -1016,7 +1130,8 @@ class V3BWFile(object):
                      round_digs=PROP276_ROUND_DIG,
                      secs_recent=None, secs_away=None, min_num=0,
                      consensus_path=None, max_bw_diff_perc=MAX_BW_DIFF_PERC,
-                     reverse=False):
+                     reverse=False, consensus_cache_fname=None,
+                     processes=1):
         """Create V3BWFile class from sbws Results.
 
         :param dict results: see below
@@ -1027,6 +1142,11 @@ class V3BWFile(object):
         :param int scale_constant: sbws scaling constant
         :param int torflow_obs: method to choose descriptor observed bandwidth
         :param bool reverse: whether to sort the bw lines descending or not
+        :param str consensus_cache_fname: file where to store the router
+            statuses of the consensus, to parse it only when it changes
+        :param int processes: number of processes to create the bw lines
+            with. With more than one, the relays are split in shards that
+            are processed in parallel.
 
         Results are in the form::
 
@@ -1039,10 +1159,11 @@ class V3BWFile(object):
                                          destinations_countries, state_fpath)
         bw_lines_raw = []
         bw_lines_excluded = []
-        router_statuses_d = cls.read_router_statuses(consensus_path)
-        # XXX: Use router_statuses_d to not parse again the file.
-        number_consensus_relays = \
-            cls.read_number_consensus_relays(consensus_path)
+        # The consensus is only parsed once.
+        router_statuses_d = cls.read_router_statuses(
+            consensus_path, consensus_cache_fname)
+        number_consensus_relays = cls.read_number_consensus_relays(
+            consensus_path, consensus_cache_fname)
         state = State(state_fpath)
 
         # Create a dictionary with the number of relays excluded by any of the
@@ -1053,11 +1174,25 @@ class V3BWFile(object):
         exclusion_dict = dict(
             [(k, 0) for k in HEADER_RECENT_MEASUREMENTS_EXCLUDED_KEYS]
             )
-        for fp, values in results.items():
-            # log.debug("Relay fp %s", fp)
-            line, reason = V3BWLine.from_results(values, secs_recent,
-                                                 secs_away, min_num,
-                                                 router_statuses_d)
+        items = list(results.items())
+        if processes > 1 and len(items) > 1:
+            # Contiguous shards, merged in the same order as when creating
+            # the lines one after the other.
+            shard_size = math.ceil(len(items) / (processes * 4))
+            shards = [(i, i + shard_size)
+                      for i in range(0, len(items), shard_size)]
+            with multiprocessing.Pool(
+                    min(processes, len(shards)),
+                    initializer=_init_bw_lines_pool,
+                    initargs=(items, secs_recent, secs_away, min_num,
+                              router_statuses_d)) as pool:
+                lines = [line for shard_lines in pool.starmap(
+                    _bw_lines_from_results_slice, shards)
+                    for line in shard_lines]
+        else:
+            lines = _bw_lines_from_results(items, secs_recent, secs_away,
+                                           min_num, router_statuses_d)
+        for line, reason in lines:
             # If there is no reason it means the line will not be excluded.
             if not reason:
                 bw_lines_raw.append(line)
@@ -1228,8 +1363,25 @@ class V3BWFile(object):
         method.
 
         See details in :ref:`torflow_aggr`.
+
+        When NumPy is installed, the lines are scaled with vector operations,
+        with the same result.
         """
         log.info("Calculating relays' bandwidth using Torflow method.")
+        if scaling.numpy is not None:
+            bw_lines_tf = V3BWFile._bw_torflow_scale_arrays(
+                bw_lines, desc_bw_obs_type, cap, num_round_dig,
+                router_statuses_d)
+        else:
+            bw_lines_tf = V3BWFile._bw_torflow_scale_lines(
+                bw_lines, desc_bw_obs_type, cap, num_round_dig,
+                router_statuses_d)
+        return sorted(bw_lines_tf, key=lambda x: x.bw, reverse=reverse)
+
+    @staticmethod
+    def _bw_torflow_scale_lines(bw_lines, desc_bw_obs_type, cap,
+                                num_round_dig, router_statuses_d):
+        """Scale the lines one by one, as Torflow."""
         bw_lines_tf = copy.deepcopy(bw_lines)
         mu_type, muf_type = scaling.network_means_by_relay_type(
             bw_lines_tf, router_statuses_d
@@ -1324,16 +1476,98 @@ class V3BWFile(object):
             bw_scaled = min(hlimit, l.bw)
             # round and convert to KB
             l.bw = kb_round_x_sig_dig(bw_scaled, digits=num_round_dig)
-        return sorted(bw_lines_tf, key=lambda x: x.bw, reverse=reverse)
+        return bw_lines_tf
 
     @staticmethod
-    def read_number_consensus_relays(consensus_path):
+    def _bw_torflow_scale_arrays(bw_lines, desc_bw_obs_type, cap,
+                                 num_round_dig, router_statuses_d):
+        """Scale the lines as :meth:`_bw_torflow_scale_lines`, with the values
+        of all the lines in arrays, where the values that are None are not
+        a number."""
+        np = scaling.numpy
+
+        def column(name):
+            return np.array([getattr(l, name) for l in bw_lines], dtype=float)
+
+        types = scaling.relay_type_indexes(bw_lines, router_statuses_d)
+        bw_mean = column('bw_mean')
+        bw_filt = column('bw_filt')
+        mu, muf = scaling.network_means_by_relay_type_arrays(
+            bw_mean, bw_filt, types)
+        log.debug('mu %s', dict(
+            (rt, mu[i]) for i, rt in enumerate(RELAY_TYPES) if i in types))
+        log.debug('muf %s', dict(
+            (rt, muf[i]) for i, rt in enumerate(RELAY_TYPES) if i in types))
+
+        # See the comments in ``_bw_torflow_scale_lines``.
+        if desc_bw_obs_type == TORFLOW_OBS_LAST:
+            desc_bw_obs_last = column('desc_bw_obs_last')
+            # As ``or``, use the mean also when the last is 0.
+            desc_bw_obs = np.where(
+                np.isnan(desc_bw_obs_last) | (desc_bw_obs_last == 0),
+                column('desc_bw_obs_mean'), desc_bw_obs_last)
+        else:
+            desc_bw_obs = column('desc_bw_obs_mean')
+        # ``fmin`` ignores the values that are not a number.
+        desc_bw = np.fmin(desc_bw_obs, np.fmin(column('desc_bw_bur'),
+                                               column('desc_bw_avg')))
+        consensus_bandwidth = column('consensus_bandwidth')
+        consensus_bandwidth_is_unmeasured = np.array(
+            [bool(l.consensus_bandwidth_is_unmeasured) for l in bw_lines])
+        min_bandwidth = np.where(
+            np.isnan(desc_bw_obs),
+            consensus_bandwidth,
+            np.where(
+                consensus_bandwidth_is_unmeasured
+                | np.isnan(consensus_bandwidth) | (consensus_bandwidth == 0),
+                desc_bw_obs, np.fmin(desc_bw, consensus_bandwidth)))
+        scaled = ~np.isnan(min_bandwidth)
+        not_scaled = len(bw_lines) - np.count_nonzero(scaled)
+        if not_scaled:
+            log.warning("Can not scale %d relays missing descriptor and"
+                        " consensus bandwidth.", not_scaled)
+
+        # Torflow's scaling
+        ratio = np.maximum(bw_mean / mu[types], bw_filt / muf[types])
+        bw = np.where(scaled, ratio * min_bandwidth, column('bw'))
+
+        # Torflow's ``tot_net_bw``
+        if router_statuses_d:
+            summed = scaled & np.array(
+                [l.node_id.replace("$", "") in router_statuses_d
+                 for l in bw_lines], dtype=bool)
+        else:
+            summed = scaled
+        # ``cumsum`` adds the values in order, as when adding them one by
+        # one, so that the sum is the same.
+        sum_bw = np.cumsum(bw[summed])[-1] if summed.any() else 0
+
+        # Torflow's clipping
+        hlimit = sum_bw * cap
+        log.debug("sum_bw: %s, hlimit: %s", sum_bw, hlimit)
+        bw_lines_tf = []
+        # The rounding to significant digits is done for every line, since it
+        # is not the same with vector operations.
+        for l, bw_scaled in zip(bw_lines,
+                                np.minimum(hlimit, bw).tolist()):
+            line = copy.copy(l)
+            line.bw = kb_round_x_sig_dig(bw_scaled, digits=num_round_dig)
+            bw_lines_tf.append(line)
+        return bw_lines_tf
+
+    @staticmethod
+    def read_number_consensus_relays(consensus_path, cache_fname=None):
         """Read the number of relays in the Network from the cached consensus
-        file."""
+        file.
+
+        :param str cache_fname: see
+            :func:`~sbws.lib.consensus.read_router_statuses`
+        """
         num = None
         try:
-            num = len(list(parse_file(consensus_path)))
-        except (FileNotFoundError, AttributeError):
+            num = len(consensus.read_router_statuses(consensus_path,
+                                                     cache_fname))
+        except (FileNotFoundError, TypeError):
             log.info("It is not possible to obtain statistics about the "
                      "percentage of measured relays because the cached "
                      "consensus file is not found.")
@@ -1341,15 +1575,17 @@ class V3BWFile(object):
         return num
 
     @staticmethod
-    def read_router_statuses(consensus_path):
-        """Read the router statuses from the cached consensus file."""
+    def read_router_statuses(consensus_path, cache_fname=None):
+        """Read the router statuses from the cached consensus file.
+
+        The consensus is parsed only once, see
+        :func:`~sbws.lib.consensus.read_router_statuses`.
+        """
         router_statuses_d = None
         try:
-            router_statuses_d = dict([
-                (r.fingerprint, r)
-                for r in parse_file(consensus_path)
-            ])
-        except (FileNotFoundError, AttributeError):
+            router_statuses_d = consensus.read_router_statuses(
+                consensus_path, cache_fname)
+        except (FileNotFoundError, TypeError):
             log.warning("It is not possible to obtain the last consensus"
                         "cached file %s.", consensus_path)
         return router_statuses_d
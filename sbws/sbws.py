@@ -3,6 +3,7 @@ import os
 import sbws.core.cleanup
 import sbws.core.scanner
 import sbws.core.generate
+import sbws.core.replay
 import sbws.core.stats
 from sbws.util.config import get_config
 from sbws.util.config import validate_config
@@ -63,6 +64,8 @@ def main():
                     'a': def_args, 'kw': def_kwargs},
         'generate': {'f': sbws.core.generate.main,
                      'a': def_args, 'kw': def_kwargs},
+        'replay': {'f': sbws.core.replay.main,
+                   'a': def_args, 'kw': def_kwargs},
         'stats': {'f': sbws.core.stats.main,
                   'a': def_args, 'kw': def_kwargs},
     }
@@ -0,0 +1,362 @@
+"""Asyncio helpers used by the scanner ``asyncio`` measurement engine.
+
+They implement the minimum needed to measure a relay without blocking one
+thread per measurement:
+
+- a SOCKS5 client to open streams through Tor's SocksPort,
+- an HTTP/1.1 client able to make ``HEAD`` and ranged ``GET`` requests over
+  a persistent connection and
+- a dispatcher of ``CIRC`` events, to wait for circuits to be built without
+  blocking.
+
+Only the Python standard library is used, so that the ``asyncio`` engine does
+not add new dependencies.
+
+"""
+import asyncio
+import collections
+import logging
+import socket
+import ssl
+import struct
+import time
+from urllib.parse import urlparse
+
+from stem import CircStatus
+from stem.control import EventType
+
+import sbws.util.stem as stem_utils
+from sbws.globals import DOWNLOAD_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+SOCKS_VERSION = 5
+SOCKS_AUTH_NONE = 0
+SOCKS_AUTH_USERPASS = 2
+SOCKS_AUTH_NO_ACCEPTABLE = 0xFF
+SOCKS_CMD_CONNECT = 1
+SOCKS_ATYP_IPV4 = 1
+SOCKS_ATYP_DOMAINNAME = 3
+SOCKS_ATYP_IPV6 = 4
+SOCKS_REPLIES = {
+    1: 'general SOCKS server failure',
+    2: 'connection not allowed by ruleset',
+    3: 'network unreachable',
+    4: 'host unreachable',
+    5: 'connection refused',
+    6: 'TTL expired',
+    7: 'command not supported',
+    8: 'address type not supported',
+}
+# Maximum number of circuit events to remember for circuits that were not
+# being waited yet.
+MAX_UNCLAIMED_CIRCUIT_EVENTS = 1000
+
+
+class Socks5Error(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    pass
+
+
+# Exceptions that can be raised while connecting or making HTTP requests.
+# ``ssl.SSLError`` is a subclass of ``OSError``.
+HTTP_EXCEPTIONS = (Socks5Error, HTTPError, OSError, asyncio.TimeoutError,
+                   ValueError)
+
+
+async def _sock_recv_exactly(loop, sock, num_bytes):
+    data = b''
+    while len(data) < num_bytes:
+        chunk = await loop.sock_recv(sock, num_bytes - len(data))
+        if not chunk:
+            raise Socks5Error('SOCKS server closed the connection.')
+        data += chunk
+    return data
+
+
+async def _socks5_handshake(loop, sock, host, port, username, password):
+    if username is not None:
+        await loop.sock_sendall(sock, bytes(
+            [SOCKS_VERSION, 1, SOCKS_AUTH_USERPASS]))
+    else:
+        await loop.sock_sendall(sock, bytes(
+            [SOCKS_VERSION, 1, SOCKS_AUTH_NONE]))
+    version, method = await _sock_recv_exactly(loop, sock, 2)
+    if version != SOCKS_VERSION or method == SOCKS_AUTH_NO_ACCEPTABLE:
+        raise Socks5Error('SOCKS server did not accept any auth method.')
+    if method == SOCKS_AUTH_USERPASS:
+        user = username.encode()
+        passwd = (password or '').encode()
+        await loop.sock_sendall(
+            sock,
+            bytes([1, len(user)]) + user + bytes([len(passwd)]) + passwd)
+        _, status = await _sock_recv_exactly(loop, sock, 2)
+        if status != 0:
+            raise Socks5Error('SOCKS username/password auth failed.')
+    hostname = host.encode('idna')
+    await loop.sock_sendall(
+        sock,
+        bytes([SOCKS_VERSION, SOCKS_CMD_CONNECT, 0, SOCKS_ATYP_DOMAINNAME,
+               len(hostname)])
+        + hostname + struct.pack('>H', port))
+    version, reply, _, atyp = await _sock_recv_exactly(loop, sock, 4)
+    if reply != 0:
+        raise Socks5Error('SOCKS server replied: {}'.format(
+            SOCKS_REPLIES.get(reply, 'unknown error {}'.format(reply))))
+    # Consume the bound address and port, they are not used.
+    if atyp == SOCKS_ATYP_IPV4:
+        await _sock_recv_exactly(loop, sock, 4 + 2)
+    elif atyp == SOCKS_ATYP_IPV6:
+        await _sock_recv_exactly(loop, sock, 16 + 2)
+    elif atyp == SOCKS_ATYP_DOMAINNAME:
+        length, = await _sock_recv_exactly(loop, sock, 1)
+        await _sock_recv_exactly(loop, sock, length + 2)
+    else:
+        raise Socks5Error('Unknown SOCKS address type {}'.format(atyp))
+
+
+async def socks5_open_connection(socks_addr, host, port, username=None,
+                                 password=None, ssl_context=None,
+                                 timeout=None):
+    """Open a connection to **host** and **port** via the SOCKS5 proxy at
+    **socks_addr**.
+
+    The host name is resolved by the proxy, as ``socks5h`` does in Requests.
+
+    :param tuple socks_addr: the proxy address and port.
+    :param str username: SOCKS username, used by Tor to isolate streams.
+    :param ssl.SSLContext ssl_context: when not None, TLS is negotiated with
+        **host** once the proxy has connected to it.
+    :returns: an ``asyncio`` (StreamReader, StreamWriter) pair.
+    :raises: Socks5Error, OSError or asyncio.TimeoutError.
+    """
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(
+            loop.sock_connect(sock, tuple(socks_addr)), timeout)
+        await asyncio.wait_for(
+            _socks5_handshake(loop, sock, host, port, username, password),
+            timeout)
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                sock=sock, ssl=ssl_context,
+                server_hostname=host if ssl_context else None),
+            timeout)
+    except BaseException:
+        sock.close()
+        raise
+
+
+def make_ssl_context(verify):
+    """Return an ``ssl.SSLContext`` that behaves as Requests' ``verify``.
+
+    **verify** can be a boolean or the path to a CA bundle file.
+    """
+    if isinstance(verify, str):
+        return ssl.create_default_context(cafile=verify)
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class HTTPResponse:
+    """The status and headers of an HTTP response.
+
+    ``num_bytes`` is the number of bytes of the body received, ``ttfb`` the
+    seconds between sending the request and receiving the first byte of the
+    response and ``duration`` the seconds between sending the request and
+    receiving the last byte of the body.
+    """
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.num_bytes = 0
+        self.ttfb = None
+        self.duration = None
+
+
+class HTTPConnection:
+    """A persistent HTTP/1.1 connection over a stream.
+
+    Its ``head`` and ``get`` methods resemble the ones in Requests' Session,
+    but the body of the response is always discarded as it arrives, so that
+    the memory used does not depend on the size of the download.
+
+    """
+    def __init__(self, url, reader, writer, headers=None, timeout=None):
+        self._url = urlparse(url)
+        self._reader = reader
+        self._writer = writer
+        self._headers = headers or {}
+        self._timeout = timeout
+
+    @classmethod
+    async def open(cls, url, socks_addr, verify=True, headers=None,
+                   timeout=None, socks_username=None, socks_password=None):
+        """Open a connection to **url** through the SOCKS5 proxy
+        **socks_addr**."""
+        u = urlparse(url)
+        port = u.port or (443 if u.scheme == 'https' else 80)
+        ssl_context = make_ssl_context(verify) if u.scheme == 'https' \
+            else None
+        reader, writer = await socks5_open_connection(
+            socks_addr, u.hostname, port, username=socks_username,
+            password=socks_password, ssl_context=ssl_context,
+            timeout=timeout)
+        return cls(url, reader, writer, headers=headers, timeout=timeout)
+
+    def close(self):
+        self._writer.close()
+
+    @property
+    def _target(self):
+        target = self._url.path or '/'
+        if self._url.query:
+            target += '?' + self._url.query
+        return target
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+        if not line:
+            raise HTTPError('Connection closed by the server.')
+        return line
+
+    async def _read_chunk(self, num_bytes):
+        data = await asyncio.wait_for(
+            self._reader.read(min(num_bytes, DOWNLOAD_CHUNK_SIZE)),
+            self._timeout)
+        if not data:
+            raise HTTPError('Connection closed by the server before the body '
+                            'was received.')
+        return len(data)
+
+    async def _request(self, method, headers):
+        req_headers = {'Host': self._url.netloc}
+        req_headers.update(self._headers)
+        req_headers.update(headers or {})
+        lines = ['{} {} HTTP/1.1'.format(method, self._target)]
+        lines.extend('{}: {}'.format(k, v) for k, v in req_headers.items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        start_time = time.monotonic()
+        await asyncio.wait_for(self._writer.drain(), self._timeout)
+        status_line = await self._readline()
+        ttfb = time.monotonic() - start_time
+        try:
+            _, status_code, *_ = status_line.decode('latin-1').split(None, 2)
+            status_code = int(status_code)
+        except ValueError:
+            raise HTTPError('Malformed status line {!r}'.format(status_line))
+        response_headers = {}
+        while True:
+            line = (await self._readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+        response = HTTPResponse(status_code, response_headers)
+        response.ttfb = ttfb
+        return response, start_time
+
+    async def _drain_body(self, response):
+        headers = response.headers
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = (await self._readline()).decode('latin-1')
+                size = int(size_line.split(';')[0].strip(), 16)
+                if size == 0:
+                    # Trailer headers, if any, end with an empty line.
+                    while (await self._readline()).strip():
+                        pass
+                    break
+                remaining = size
+                while remaining > 0:
+                    received = await self._read_chunk(remaining)
+                    remaining -= received
+                    response.num_bytes += received
+                # CRLF after every chunk.
+                await self._readline()
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                received = await self._read_chunk(remaining)
+                remaining -= received
+                response.num_bytes += received
+        else:
+            raise HTTPError('The response does not have Content-Length nor '
+                            'chunked Transfer-Encoding.')
+
+    async def head(self, headers=None):
+        response, start_time = await self._request('HEAD', headers)
+        response.duration = time.monotonic() - start_time
+        return response
+
+    async def get(self, headers=None):
+        response, start_time = await self._request('GET', headers)
+        await self._drain_body(response)
+        response.duration = time.monotonic() - start_time
+        return response
+
+
+class CircuitEventDispatcher:
+    """Single ``CIRC`` event listener that notifies coroutines waiting for
+    their circuits to be built or to fail.
+
+    stem calls the listener from its own thread, so the events are passed to
+    the event loop with ``call_soon_threadsafe``.
+    """
+    def __init__(self, controller, loop):
+        self._controller = controller
+        self._loop = loop
+        self._waiters = {}
+        # An event might arrive before the coroutine started to wait for it.
+        self._unclaimed = collections.OrderedDict()
+
+    def start(self):
+        stem_utils.add_event_listener(
+            self._controller, self._listener, EventType.CIRC)
+
+    def stop(self):
+        stem_utils.remove_event_listener(self._controller, self._listener)
+
+    def _listener(self, event):
+        if event.status in (CircStatus.BUILT, CircStatus.FAILED):
+            self._loop.call_soon_threadsafe(
+                self._dispatch, event.id, event.status, event.reason)
+
+    def _dispatch(self, circ_id, status, reason):
+        waiter = self._waiters.pop(circ_id, None)
+        if waiter is None:
+            self._unclaimed[circ_id] = (status, reason)
+            while len(self._unclaimed) > MAX_UNCLAIMED_CIRCUIT_EVENTS:
+                self._unclaimed.popitem(last=False)
+        elif not waiter.done():
+            waiter.set_result((status, reason))
+
+    async def wait_for_circuit(self, circ_id, timeout):
+        """Wait until the circuit **circ_id** is built.
+
+        :returns tuple: True and None if the circuit was built, False and
+            the reason otherwise.
+        """
+        if circ_id in self._unclaimed:
+            status, reason = self._unclaimed.pop(circ_id)
+        else:
+            waiter = self._loop.create_future()
+            self._waiters[circ_id] = waiter
+            try:
+                status, reason = await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                return False, 'Timed out waiting for circuit {} to be ' \
+                    'built.'.format(circ_id)
+            finally:
+                self._waiters.pop(circ_id, None)
+        if status == CircStatus.BUILT:
+            return True, None
+        return False, 'Circuit failed to be created: {}'.format(reason)
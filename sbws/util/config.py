@@ -24,6 +24,12 @@ _HEX = '0123456789ABCDEF'
 
 _LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
 
+_SCANNER_ENGINES = ['threads', 'asyncio']
+
+_RESULTS_FORMATS = ['json', 'sqlite']
+
+_RESULTS_SYNC = ['flush', 'fsync']
+
 log = logging.getLogger(__name__)
 
 
@@ -223,6 +229,7 @@ def _validate_general(conf):
     ints = {
         'data_period': {'minimum': 1, 'maximum': None},
         'circuit_timeout': {'minimum': 1, 'maximum': None},
+        'load_results_processes': {'minimum': 1, 'maximum': None},
     }
     floats = {
         'http_timeout': {'minimum': 0.0, 'maximum': None},
@@ -263,7 +270,8 @@ def _validate_paths(conf):
     err_tmpl = Template('$sec/$key ($val): $e')
     unvalidated_keys = [
         'datadir', 'sbws_home', 'v3bw_fname', 'v3bw_dname', 'state_fname',
-        'log_dname']
+        'log_dname', 'results_snapshot_fname', 'generate_snapshot_fname',
+        'consensus_cache_fname']
     all_valid_keys = unvalidated_keys
     allow_missing = ['sbws_home']
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl,
@@ -293,22 +301,42 @@ def _validate_scanner(conf):
     ints = {
         'num_rtts': {'minimum': 0, 'maximum': 100},
         'num_downloads': {'minimum': 1, 'maximum': 100},
+        'early_stop_min_downloads': {'minimum': 2, 'maximum': 100},
         'initial_read_request': {'minimum': 1, 'maximum': None},
         'measurement_threads': {'minimum': 1, 'maximum': None},
+        'bandwidth_budget': {'minimum': 0, 'maximum': None},
+        'metrics_port': {'minimum': 0, 'maximum': 65535},
+        'results_snapshot_interval': {'minimum': 0, 'maximum': None},
+        'generate_snapshot_interval': {'minimum': 0, 'maximum': None},
+        'generate_interval': {'minimum': 0, 'maximum': None},
         'min_download_size': {'minimum': 1, 'maximum': None},
         'max_download_size': {'minimum': 1, 'maximum': None},
+        'circuit_prefetch': {'minimum': 0, 'maximum': None},
+        'circuit_prefetch_ttl': {'minimum': 1, 'maximum': None},
     }
     floats = {
+        'early_stop_ci_width': {'minimum': 0.0, 'maximum': None},
         'download_toofast': {'minimum': 0.001, 'maximum': None},
         'download_min': {'minimum': 0.001, 'maximum': None},
         'download_target': {'minimum': 0.001, 'maximum': None},
         'download_max': {'minimum': 0.001, 'maximum': None},
     }
+    bools = {
+        'initial_read_request_from_history': {},
+    }
+    enums = {
+        'engine': {'choices': _SCANNER_ENGINES},
+        'results_format': {'choices': _RESULTS_FORMATS},
+        'results_sync': {'choices': _RESULTS_SYNC},
+    }
     all_valid_keys = list(ints.keys()) + list(floats.keys()) + \
-        ['nickname', 'country']
+        list(bools.keys()) + list(enums.keys()) + \
+        ['nickname', 'country', 'metrics_socket']
     errors.extend(_validate_section_keys(conf, sec, all_valid_keys, err_tmpl))
     errors.extend(_validate_section_ints(conf, sec, ints, err_tmpl))
     errors.extend(_validate_section_floats(conf, sec, floats, err_tmpl))
+    errors.extend(_validate_section_bools(conf, sec, bools, err_tmpl))
+    errors.extend(_validate_section_enums(conf, sec, enums, err_tmpl))
     valid, error_msg = _validate_nickname(conf[sec], 'nickname')
     if not valid:
         errors.append(err_tmpl.substitute(
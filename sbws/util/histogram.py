@@ -0,0 +1,134 @@
+"""Histograms of the time spent in every phase of the measurements."""
+import bisect
+import collections
+import contextlib
+import logging
+import time
+from threading import Lock
+
+from sbws.globals import PHASE_HISTOGRAM_BUCKETS
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Number of observations smaller or equal than every bucket upper bound,
+    plus their count and sum.
+
+    :param list buckets: the sorted upper bounds of the buckets. Values
+        bigger than the last one are only in the ``+Inf`` bucket.
+    """
+    def __init__(self, buckets=PHASE_HISTOGRAM_BUCKETS):
+        self.buckets = list(buckets)
+        # The last one is the ``+Inf`` bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket with the **q** quantile, or
+        None if there are not observations.
+
+        When it is in the ``+Inf`` bucket, return the last upper bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        """Return the cumulative counts by upper bound, as in Prometheus
+        histograms, the count and the sum."""
+        cumulative = 0
+        buckets = collections.OrderedDict()
+        for upper_bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            buckets[str(upper_bound)] = cumulative
+        return {'buckets': buckets, 'count': self.count,
+                'sum': round(self.sum, 6)}
+
+
+class PhaseHistograms:
+    """Thread-safe histograms of the seconds spent in every measurement phase
+    by outcome of the measurement."""
+    def __init__(self):
+        self._lock = Lock()
+        # By phase and outcome.
+        self._histograms = collections.defaultdict(dict)
+
+    def observe(self, phase, outcome, seconds):
+        with self._lock:
+            histogram = self._histograms[phase].get(outcome)
+            if histogram is None:
+                histogram = self._histograms[phase][outcome] = Histogram()
+            histogram.observe(seconds)
+
+    def to_dict(self):
+        """Return the histograms by phase and outcome."""
+        with self._lock:
+            return {
+                phase: {outcome: histogram.to_dict()
+                        for outcome, histogram in by_outcome.items()}
+                for phase, by_outcome in self._histograms.items()
+            }
+
+    def log_summary(self):
+        """Log the number of times every phase was run and the median and 90th
+        percentile of its duration, for all the outcomes and then by
+        outcome."""
+        with self._lock:
+            for phase, by_outcome in sorted(self._histograms.items()):
+                total = Histogram()
+                for histogram in by_outcome.values():
+                    total.counts = [a + b for a, b in
+                                    zip(total.counts, histogram.counts)]
+                    total.count += histogram.count
+                    total.sum += histogram.sum
+                log.info("Phase %s: %s times, %.2f seconds on average, "
+                         "median <= %s, 90th percentile <= %s.",
+                         phase, total.count, total.sum / total.count,
+                         total.quantile(0.5), total.quantile(0.9))
+                for outcome, histogram in sorted(by_outcome.items()):
+                    log.debug("Phase %s with outcome %s: %s times, median <= "
+                              "%s, 90th percentile <= %s.", phase, outcome,
+                              histogram.count, histogram.quantile(0.5),
+                              histogram.quantile(0.9))
+
+
+class PhaseTimer:
+    """Time the phases of a measurement with a monotonic clock.
+
+    Since the outcome of the measurement is only known at the end, the
+    durations are added to the **histograms** by :meth:`finish`.
+
+    >>> timer = PhaseTimer(histograms)
+    >>> with timer.phase('build_circuit'):
+    ...     build_circuit()
+    >>> timer.finish('success')
+    """
+    def __init__(self, histograms):
+        self.histograms = histograms
+        self.durations = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations.append((name, time.monotonic() - start))
+
+    def finish(self, outcome):
+        for name, seconds in self.durations:
+            self.histograms.observe(name, outcome, seconds)
+        self.durations = []
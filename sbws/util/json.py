@@ -1,5 +1,6 @@
 """JSON custom serializers and deserializers."""
 import datetime
+import functools
 import json
 
 from .timestamps import DateTimeSeq, DateTimeIntSeq
@@ -42,3 +43,52 @@ class CustomDecoder(json.JSONDecoder):
             except TypeError:
                 pass
         return obj
+
+
+#: Keys of the results and of the state file whose values are ISO 8601
+#: strings, lists of them or lists of pairs of them and a number.
+DATETIME_KEYS = frozenset([
+    # Results
+    'relay_in_recent_consensus',
+    'relay_recent_measurement_attempt',
+    'relay_recent_priority_list',
+    # State
+    'scanner_started',
+    'min_perc_reached',
+    'recent_consensus',
+    'recent_consensus_count',
+    'recent_measurement_attempt',
+    'recent_priority_list',
+    'recent_priority_relay',
+])
+
+
+# The same timestamps, as the ones of the consensuses, are in many results.
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return value
+
+
+def _to_datetime(value):
+    if isinstance(value, list):
+        return [_to_datetime(item) for item in value]
+    if isinstance(value, str):
+        return _parse_datetime(value)
+    return value
+
+
+class ResultDecoder(json.JSONDecoder):
+    """JSONDecoder that deserializes to datetime only the values of the
+    :data:`DATETIME_KEYS` in the decoded object, instead of trying to
+    deserialize every string as :class:`CustomDecoder` does.
+    """
+
+    def decode(self, s, **kwargs):
+        decoded = super().decode(s, **kwargs)
+        if isinstance(decoded, dict):
+            for key in DATETIME_KEYS.intersection(decoded):
+                decoded[key] = _to_datetime(decoded[key])
+        return decoded
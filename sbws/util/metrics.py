@@ -0,0 +1,193 @@
+"""Counters and gauges of the running scanner, served over HTTP in the
+Prometheus text format."""
+import collections
+import errno
+import http.server
+import logging
+import os
+import socketserver
+import stat
+import threading
+
+log = logging.getLogger(__name__)
+
+#: Type and help text of the metrics.
+METRICS = {
+    'sbws_measurements_pending': (
+        'gauge', 'Relays being measured.'),
+    'sbws_measurement_workers': (
+        'gauge', 'Measurement threads or coroutines, by state.'),
+    'sbws_result_queue_size': (
+        'gauge', 'Results waiting to be written by ResultDump.'),
+    'sbws_results_total': (
+        'counter', 'Results stored, by type.'),
+    'sbws_functional_destinations': (
+        'gauge', 'Destinations that are functional.'),
+    'sbws_circuits_total': (
+        'counter', 'Circuits that were built or failed to build.'),
+    'sbws_downloaded_bytes_total': (
+        'counter', 'Bytes downloaded to measure relays.'),
+    'sbws_bandwidth_budget_utilization': (
+        'gauge', 'Fraction of the bandwidth budget used in the last minute.'),
+    'sbws_measurement_phase_seconds': (
+        'histogram', 'Seconds spent in every measurement phase, by outcome.'),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels)) + '}'
+
+
+class Metrics:
+    """Thread-safe registry of counters and gauges.
+
+    Counters are incremented by the code that measures. Gauges are functions
+    called every time the metrics are rendered, so that they are always up
+    to date and do not need to be updated by the code measuring.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # By name and labels.
+        self._counters = collections.defaultdict(dict)
+        self._gauges = {}
+        self.phase_histograms = None
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[name][key] = \
+                self._counters[name].get(key, 0) + amount
+
+    def set_gauge(self, name, func):
+        """Set the function that returns the value of the gauge **name**, or
+        a dictionary with the values by label name and value."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def _gauge_samples(self, name, func):
+        try:
+            value = func()
+        # A gauge must not break the endpoint.
+        except Exception as e:
+            log.debug("Could not obtain gauge %s: %s", name, e)
+            return []
+        if isinstance(value, dict):
+            return [(name, (label,), v) for label, v in value.items()]
+        return [(name, (), value)]
+
+    def _histogram_samples(self):
+        samples = []
+        if self.phase_histograms is None:
+            return samples
+        name = 'sbws_measurement_phase_seconds'
+        phases = self.phase_histograms.to_dict()
+        for phase, by_outcome in sorted(phases.items()):
+            for outcome, histogram in sorted(by_outcome.items()):
+                labels = (('phase', phase), ('outcome', outcome))
+                for upper_bound, count in histogram['buckets'].items():
+                    samples.append((name + '_bucket',
+                                    labels + (('le', upper_bound),), count))
+                samples.append((name + '_count', labels, histogram['count']))
+                samples.append((name + '_sum', labels, histogram['sum']))
+        return samples
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format."""
+        with self._lock:
+            counters = {name: dict(values)
+                        for name, values in self._counters.items()}
+            gauges = dict(self._gauges)
+        samples = collections.defaultdict(list)
+        for name, values in counters.items():
+            for labels, value in values.items():
+                samples[name].append((name, labels, value))
+        for name, func in gauges.items():
+            samples[name].extend(self._gauge_samples(name, func))
+        samples['sbws_measurement_phase_seconds'] = self._histogram_samples()
+        lines = []
+        for name in sorted(samples):
+            if not samples[name]:
+                continue
+            metric_type, text = METRICS.get(name, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for sample_name, labels, value in samples[name]:
+                lines.append('{}{} {}'.format(
+                    sample_name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The client address is empty with Unix sockets.
+        log.debug("Metrics request: " + format, *args)
+
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+class MetricsServer:
+    """Serve **metrics** at ``/metrics`` on a local TCP **port** or, if
+    **socket_path** is set, on that Unix socket, from a daemon thread."""
+    def __init__(self, metrics, port=0, socket_path=None,
+                 address='127.0.0.1'):
+        self.socket_path = socket_path
+        if socket_path:
+            # Remove the socket left by a previous run, but nothing else, in
+            # case the path is wrong.
+            if _is_socket(socket_path):
+                os.remove(socket_path)
+            elif os.path.lexists(socket_path):
+                raise FileExistsError(
+                    errno.EEXIST, 'Not a socket, not removing it to serve '
+                    'the metrics', socket_path)
+            self.server = _UnixMetricsServer(
+                socket_path, _MetricsRequestHandler)
+        else:
+            self.server = _TCPMetricsServer(
+                (address, port), _MetricsRequestHandler)
+        self.server.metrics = metrics
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        log.info("Serving metrics on %s.", self.address)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path and _is_socket(self.socket_path):
+            os.remove(self.socket_path)
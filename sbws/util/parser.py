@@ -1,6 +1,7 @@
 import sbws.core.cleanup
 import sbws.core.scanner
 import sbws.core.generate
+import sbws.core.replay
 import sbws.core.stats
 from sbws import __version__
 
@@ -27,5 +28,6 @@ def create_parser():
     sbws.core.cleanup.gen_parser(sub)
     sbws.core.scanner.gen_parser(sub)
     sbws.core.generate.gen_parser(sub)
+    sbws.core.replay.gen_parser(sub)
     sbws.core.stats.gen_parser(sub)
     return p
@@ -1,6 +1,7 @@
 import requests
 
 from sbws import settings
+from sbws.globals import SOCKS_PASSWORD
 from sbws.util import stem as stem_utils
 
 
@@ -35,3 +36,18 @@ def make_session(controller, timeout):
     s._timeout = timeout
     s.headers = settings.HTTP_HEADERS
     return s
+
+
+def set_socks_username(session, username):
+    """Make **session** open the streams with the SOCKS **username**, so that
+    a :class:`~sbws.util.stem.StreamRouter` can attach them to the right
+    circuit.
+
+    """
+    proxies = {}
+    for scheme, url in session.proxies.items():
+        # Remove the previous username, if any.
+        address = url.split('://', 1)[1].rpartition('@')[2]
+        proxies[scheme] = 'socks5h://{}:{}@{}'.format(
+            username, SOCKS_PASSWORD, address)
+    session.proxies = proxies
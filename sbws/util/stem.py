@@ -5,12 +5,15 @@ from stem import (SocketError, InvalidRequest, UnsatisfiableRequest,
                   OperationFailed, ControllerError, InvalidArguments,
                   ProtocolError, SocketClosed)
 from stem.connection import IncorrectSocketType
+from stem.control import EventType
+from stem.version import Version
 import stem.process
 from threading import RLock
 import copy
+import itertools
 import logging
 import os
-from sbws.globals import fail_hard
+from sbws.globals import fail_hard, TOR_VERSION_STREAM_SOCKS_USERNAME
 from sbws.globals import (TORRC_STARTING_POINT, TORRC_RUNTIME_OPTIONS,
                           TORRC_OPTIONS_CAN_FAIL, G, M, E, GE)
 from sbws import settings
@@ -61,6 +64,85 @@ def remove_event_listener(controller, func):
         log.exception("Exception trying to remove event %s", e)
 
 
+class StreamRouter:
+    """Attach the new streams to circuits with a single ``STREAM`` event
+    listener, instead of adding and removing a listener for every stream
+    while holding ``stream_building_lock``.
+
+    Every stream is opened with a different SOCKS username, obtained with
+    :meth:`add_route`, and Tor reports it in the ``STREAM`` events, so the
+    streams for different circuits can be opened at the same time.
+
+    :param controller: the Stem controller
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.is_running = False
+        self._lock = RLock()
+        # SOCKS username to circuit id.
+        self._routes = {}
+        self._counter = itertools.count()
+
+    def start(self):
+        """Start listening for ``STREAM`` events.
+
+        :returns bool: False if Tor does not report the SOCKS username in the
+            ``STREAM`` events, so that ``stream_building_lock`` has to be
+            used instead.
+        """
+        try:
+            version = self.controller.get_version()
+        except (ControllerError, SocketClosed) as e:
+            log.debug(e)
+            return False
+        if version < Version(TOR_VERSION_STREAM_SOCKS_USERNAME):
+            log.info("Tor %s does not report the SOCKS username of the "
+                     "streams, they will be attached one by one.", version)
+            return False
+        add_event_listener(self.controller, self._listener, EventType.STREAM)
+        self.is_running = True
+        return True
+
+    def stop(self):
+        if self.is_running:
+            remove_event_listener(self.controller, self._listener)
+            self.is_running = False
+
+    def add_route(self, circ_id):
+        """Return a new SOCKS username to open streams that will be attached
+        to **circ_id**."""
+        username = 'sbws-{}'.format(next(self._counter))
+        with self._lock:
+            self._routes[username] = circ_id
+        return username
+
+    def remove_routes(self, circ_id):
+        """Forget the SOCKS usernames of the streams attached to
+        **circ_id**, normally because the circuit has been closed."""
+        with self._lock:
+            for username in [u for u, c in self._routes.items()
+                             if c == circ_id]:
+                del self._routes[username]
+
+    def _listener(self, st):
+        if st.status != 'NEW' or st.purpose != 'USER':
+            return
+        username = st.keyword_args.get('SOCKS_USERNAME')
+        with self._lock:
+            circ_id = self._routes.get(username)
+        if circ_id is None:
+            log.debug('Not attaching stream %s with unknown SOCKS username '
+                      '%s.', st.id, username)
+            return
+        log.debug('Attaching stream %s to circ %s', st.id, circ_id)
+        try:
+            self.controller.attach_stream(st.id, circ_id)
+        except (UnsatisfiableRequest, InvalidRequest, OperationFailed,
+                SocketClosed) as e:
+            log.debug('Error attaching stream %s to circ %s: %s',
+                      st.id, circ_id, e)
+
+
 def init_controller(conf):
     c = None
     # If the external control port is set, use it to initialize the controller.
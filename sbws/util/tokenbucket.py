@@ -0,0 +1,74 @@
+"""Token bucket to limit the rate at which all the measurements download."""
+import collections
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """Tokens (bytes) are added to the bucket at ``rate`` per second, up to
+    ``capacity``.
+
+    A download takes all the tokens it needs before starting, even if there
+    are not enough, instead of taking them while receiving the data, so that
+    the download is not throttled while it is being measured. The following
+    downloads wait until that debt is paid.
+
+    It is thread-safe. Coroutines can use :meth:`reserve` and sleep the
+    number of seconds it returns.
+
+    :param int rate: bytes per second.
+    :param int capacity: maximum number of tokens, by default ``rate``.
+    :param int window: seconds used to calculate the :meth:`utilization`.
+    """
+    def __init__(self, rate, capacity=None, window=60):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.window = window
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = Lock()
+        # Time at which every reservation starts and its number of tokens.
+        self._reserved = collections.deque()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def wait_time(self):
+        """Return the seconds until there are tokens available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0, -self._tokens / self.rate)
+
+    def reserve(self, amount):
+        """Take **amount** tokens.
+
+        :returns float: the seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0, -self._tokens / self.rate)
+            self._tokens -= amount
+            self._reserved.append((now + wait, amount))
+        return wait
+
+    def consume(self, amount):
+        """Take **amount** tokens, blocking until they can be used."""
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    def utilization(self):
+        """Return the fraction of the rate that was reserved in the last
+        ``window`` seconds."""
+        with self._lock:
+            now = time.monotonic()
+            while self._reserved and \
+                    self._reserved[0][0] < now - self.window:
+                self._reserved.popleft()
+            reserved = sum(amount for start, amount in self._reserved
+                           if start <= now)
+        return reserved / (self.rate * self.window)
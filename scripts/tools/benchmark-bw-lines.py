@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Measure the time to create the Bandwidth Lines of the relays from their
+results with ``V3BWLine.from_results``.
+
+Without a data directory, it generates results with the size of the
+results kept by a scanner measuring every relay: 5 days of results of
+7000 relays, some of them errors, old or without descriptor values.
+With ``--output``, the lines are written to a file, to compare the lines
+created by different versions of sbws.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import logging
+import random
+import time
+
+from sbws.globals import GENERATE_PERIOD
+from sbws.lib.resultdump import (Result, load_recent_results_in_datadir,
+                                 trim_results_ip_changed)
+from sbws.lib.v3bwfile import V3BWLine
+from sbws.util.timestamp import unixts_to_dt_obj
+
+ERROR_TYPES = ['error-circ', 'error-stream', 'error-misc']
+
+
+def _generate_results(num_relays, results_per_relay, seed):
+    rand = random.Random(seed)
+    # Generate the same results during an hour, so that the lines can be
+    # compared.
+    now = time.time() // 3600 * 3600
+    results = {}
+    for i in range(num_relays):
+        fp = '{:040X}'.format(i)
+        relay_results = []
+        # Some relays are excluded for having few, near or error results.
+        span = rand.choice([6 * 24 * 60 * 60] * 9 + [12 * 60 * 60])
+        error_rate = rand.choice([0.1] * 9 + [1])
+        for j in range(rand.randint(1, 2 * results_per_relay - 1)):
+            ts = now - rand.uniform(0, span)
+            d = {
+                'version': 4, 'time': ts, 'type': 'success',
+                'fingerprint': fp, 'nickname': 'relay{}'.format(i),
+                'address': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+                'master_key_ed25519':
+                    'g+Shk00y9Md0hg1S6ptnuc/wWKbADBgdjT0Kg+TSF3s',
+                'circ': [fp, 'B' * 40],
+                'dest_url': 'https://example.com/sbws.bin',
+                'scanner': 'scanner',
+                'rtts': [rand.uniform(0.1, 1) for _ in range(10)],
+                'downloads': [
+                    {'amount': rand.randint(1, 1 << 30),
+                     'duration': rand.uniform(5, 11)}
+                    for _ in range(5)],
+                'relay_average_bandwidth': rand.choice(
+                    [None, 1 << 30, rand.randint(1, 1 << 30)]),
+                'relay_burst_bandwidth': rand.randint(1, 1 << 30),
+                'relay_observed_bandwidth': rand.choice(
+                    [None, rand.randint(1, 1 << 27)]),
+                'consensus_bandwidth': rand.randint(1, 1 << 20),
+                'consensus_bandwidth_is_unmeasured': rand.random() < 0.1,
+                'relay_in_recent_consensus': [
+                    unixts_to_dt_obj(ts - k * 3600)
+                    for k in range(rand.randint(0, 24))],
+                'relay_recent_measurement_attempt': [unixts_to_dt_obj(ts)],
+                'relay_recent_priority_list': [unixts_to_dt_obj(ts)],
+            }
+            if rand.random() < error_rate:
+                d['type'] = rand.choice(ERROR_TYPES)
+                d['msg'] = 'Error'
+            relay_results.append(Result.from_dict(d))
+        relay_results.sort(key=lambda r: r.time)
+        results[fp] = relay_results
+    return results
+
+
+def _time_lines(results, args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = [
+            V3BWLine.from_results(results[fp], secs_recent=args.secs_recent,
+                                  secs_away=args.secs_away,
+                                  min_num=args.min_num)
+            for fp in results
+        ]
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, lines
+
+
+def main(args):
+    # Do not log the warnings about the descriptor values of every relay.
+    logging.basicConfig(level=logging.ERROR)
+    if args.datadir:
+        results = load_recent_results_in_datadir(
+            GENERATE_PERIOD / 24 / 60 / 60, args.datadir)
+        results = trim_results_ip_changed(results)
+    else:
+        results = _generate_results(args.num_relays, args.results_per_relay,
+                                    args.seed)
+    duration, lines = _time_lines(results, args, args.repeat)
+    print('{} relays, {} results'.format(
+        len(results), sum(len(rs) for rs in results.values())))
+    print('V3BWLine.from_results: {:.3f} seconds'.format(duration))
+    if args.output:
+        with open(args.output, 'w') as fd:
+            for line, reason in lines:
+                fd.write('{} {}\n'.format(reason, line))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--datadir',
+                        help='Data directory with the results files. If not '
+                        'given, results are generated.')
+    parser.add_argument('-n', '--num-relays', type=int, default=7000,
+                        help='Number of relays to generate results for.')
+    parser.add_argument('-p', '--results-per-relay', type=int, default=20,
+                        help='Mean number of results to generate for every '
+                        'relay.')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed of the generated results.')
+    parser.add_argument('--secs-recent', type=int,
+                        default=GENERATE_PERIOD,
+                        help='Ignore results older than these seconds.')
+    parser.add_argument('--secs-away', type=int, default=24 * 60 * 60,
+                        help='Results must span more than these seconds.')
+    parser.add_argument('--min-num', type=int, default=2,
+                        help='Minimum number of results of a relay.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Times to create the lines, taking the best.')
+    parser.add_argument('-o', '--output',
+                        help='File to write the Bandwidth Lines to.')
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare the time to decode a results file with the generic JSON decoder
+and with the decoder that only deserializes the known timestamp keys.
+
+Without a results file, it generates one with the size of a day of results
+of a scanner measuring every relay.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import datetime
+import json
+import time
+
+from sbws.util.json import CustomDecoder, CustomEncoder, ResultDecoder
+
+
+def _generate_lines(num_results):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    timestamps = [now - datetime.timedelta(hours=i) for i in range(24)]
+    lines = []
+    for i in range(num_results):
+        fp = '{:040X}'.format(i)
+        result = {
+            'version': 4, 'time': time.time(), 'type': 'success',
+            'fingerprint': fp, 'nickname': 'relay{}'.format(i),
+            'address': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+            'master_key_ed25519':
+                'g+Shk00y9Md0hg1S6ptnuc/wWKbADBgdjT0Kg+TSF3s',
+            'circ': [fp, 'B' * 40], 'dest_url': 'https://example.com/sbws.bin',
+            'scanner': 'scanner', 'rtts': [0.45] * 10,
+            'downloads': [{'amount': 590009, 'duration': 6.1}] * 5,
+            'relay_average_bandwidth': 1000000000,
+            'relay_burst_bandwidth': 123456,
+            'relay_observed_bandwidth': 524288,
+            'consensus_bandwidth': 600000,
+            'consensus_bandwidth_is_unmeasured': False,
+            'relay_in_recent_consensus': timestamps,
+            'relay_recent_measurement_attempt': timestamps[:2],
+            'relay_recent_priority_list': timestamps[:3],
+        }
+        lines.append(json.dumps(result, cls=CustomEncoder))
+    return lines
+
+
+def _time_decoding(lines, decoder, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            json.loads(line, cls=decoder)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main(args):
+    if args.results_file:
+        with open(args.results_file) as fd:
+            lines = fd.readlines()
+    else:
+        lines = _generate_lines(args.num_results)
+    for line in lines:
+        assert json.loads(line, cls=ResultDecoder) == \
+            json.loads(line, cls=CustomDecoder)
+    custom = _time_decoding(lines, CustomDecoder, args.repeat)
+    schema = _time_decoding(lines, ResultDecoder, args.repeat)
+    print('{} results'.format(len(lines)))
+    print('CustomDecoder: {:.3f} seconds'.format(custom))
+    print('ResultDecoder: {:.3f} seconds'.format(schema))
+    print('Speedup: {:.1f}x'.format(custom / schema))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-f', '--results-file',
+                        help='Results file to decode. If not given, one is '
+                        'generated.')
+    parser.add_argument('-n', '--num-results', type=int, default=7000,
+                        help='Number of results to generate.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Times to decode the results, taking the best.')
+    main(parser.parse_args())
@@ -81,5 +81,7 @@ setup(
         'test': ['tox', 'pytest', 'coverage', 'freezegun'],
         # recommonmark: to make sphinx render markdown
         'doc': ['sphinx', 'recommonmark', 'pylint'],
+        # numpy: to scale the bandwidth lines with vector operations
+        'numpy': ['numpy'],
     },
 )
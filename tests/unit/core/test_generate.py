@@ -1,8 +1,13 @@
 """Unit tests for sbws.core.generate module."""
 import argparse
+import os
+from math import ceil
+from unittest import mock
 
-from sbws.globals import TORFLOW_ROUND_DIG, PROP276_ROUND_DIG
-from sbws.core.generate import gen_parser
+from sbws.globals import TORFLOW_ROUND_DIG, PROP276_ROUND_DIG, GENERATE_PERIOD
+from sbws.core.generate import (BwFileGenerator, default_args, gen_parser,
+                                main)
+from sbws.lib.resultdump import load_recent_results_in_datadir
 
 
 def test_gen_parser_arg_round_digs():
@@ -32,3 +37,31 @@ def test_gen_parser_arg_round_digs():
     args = parser_generate.parse_args(['--round-digs',
                                        str(PROP276_ROUND_DIG)])
     assert args.round_digs == PROP276_ROUND_DIG
+
+
+def test_bw_file_generator(conf_results):
+    """The bandwidth file generated from the results in memory of the scanner
+    is the same as the one generated by ``sbws generate``."""
+    latest = os.path.join(conf_results.getpath('paths', 'v3bw_dname'),
+                          'latest.v3bw')
+
+    def bw_file_lines():
+        with open(latest) as fd:
+            return [line for line in fd.read().splitlines()
+                    if not line.startswith('file_created')]
+
+    main(default_args(), conf_results)
+    expected = bw_file_lines()
+    os.remove(latest)
+    result_dump = mock.Mock()
+    # The results are not loaded yet.
+    result_dump.generate_results.return_value = None
+    generator = BwFileGenerator(conf_results, result_dump, 60)
+    generator.generate()
+    assert not os.path.exists(latest)
+    result_dump.generate_results.return_value = \
+        load_recent_results_in_datadir(
+            ceil(GENERATE_PERIOD / 24 / 60 / 60),
+            conf_results.getpath('paths', 'datadir'))
+    generator.generate()
+    assert bw_file_lines() == expected
@@ -0,0 +1,80 @@
+"""Unit tests for sbws.core.replay module."""
+import os
+import random
+import shutil
+import time
+
+from sbws.core.replay import (ResultsWindow, consensus_path_at,
+                              consensus_paths_by_time, main)
+from sbws.lib.resultdump import Result, write_result_to_datadir
+from sbws.util.timestamp import unixts_to_isodt_str
+
+
+def test_results_window(result_success_dict):
+    rnd = random.Random(1)
+    results = {}
+    for i in range(100):
+        r = Result.from_dict(dict(result_success_dict,
+                                  fingerprint='{:040X}'.format(i % 3),
+                                  time=rnd.uniform(0, 100)))
+        results.setdefault(r.fingerprint, []).append(r)
+    window = ResultsWindow(results, 20)
+    for end in [10, 15, 15, 40, 42, 90, 200]:
+        expected = {}
+        for fp in sorted(results):
+            values = sorted([r for r in results[fp]
+                             if end - 20 < r.time <= end],
+                            key=lambda r: r.time)
+            if values:
+                expected[fp] = values
+        assert window.advance(end) == expected
+
+
+def test_consensus_path_at(root_data_path, tmpdir):
+    consensus_dir = tmpdir.mkdir('consensuses')
+    for fname in ['2020-02-29-11-00-00-consensus',
+                  '2020-02-29-10-00-00-consensus',
+                  '2020-03-05-10-00-00-consensus']:
+        shutil.copy(os.path.join(root_data_path, fname), str(consensus_dir))
+    consensuses = consensus_paths_by_time(str(consensus_dir))
+    assert [os.path.basename(path) for _, path in consensuses] == [
+        '2020-02-29-10-00-00-consensus', '2020-02-29-11-00-00-consensus',
+        '2020-03-05-10-00-00-consensus']
+    ts = consensuses[0][0]
+    assert consensus_path_at(consensuses, ts - 1) is None
+    assert consensus_path_at(consensuses, ts) == consensuses[0][1]
+    assert consensus_path_at(consensuses, ts + 3599) == consensuses[0][1]
+    assert consensus_path_at(consensuses, ts + 3600) == consensuses[1][1]
+
+
+def test_replay_jobs(sbwshome_only_datadir, conf, parser, root_data_path,
+                     result_success_dict, tmpdir):
+    """The bandwidth files of the steps generated in several processes are
+    the same as the ones generated in one."""
+    end = time.time() // 3600 * 3600
+    for i in range(10):
+        for fp in ['A' * 40, 'B' * 40]:
+            write_result_to_datadir(
+                Result.from_dict(dict(result_success_dict, fingerprint=fp,
+                                      time=end - i * 1800)),
+                conf.getpath('paths', 'datadir'))
+
+    def replay(jobs):
+        output_dir = str(tmpdir.join('replay{}'.format(jobs)))
+        args = parser.parse_args([
+            'replay', '--start', unixts_to_isodt_str(end - 4 * 3600),
+            '--end', unixts_to_isodt_str(end), '--secs-recent', '7200',
+            '--consensus-dir', root_data_path, '--output-dir', output_dir,
+            '--jobs', str(jobs)])
+        main(args, conf)
+        bw_files = {}
+        for fname in sorted(os.listdir(output_dir)):
+            with open(os.path.join(output_dir, fname)) as fd:
+                bw_files[fname] = fd.read()
+        return bw_files
+
+    bw_files = replay(1)
+    assert len(bw_files) == 5
+    assert replay(2) == bw_files
+    last = bw_files[sorted(bw_files)[-1]]
+    assert 'file_created={}'.format(unixts_to_isodt_str(end)) in last
@@ -1,7 +1,21 @@
 """Unit tests for scanner.py."""
 import pytest
 
-from sbws.core.scanner import result_putter
+import asyncio
+import threading
+from statistics import median
+from unittest.mock import MagicMock
+
+from sbws.core import scanner
+from sbws.core.scanner import (result_putter, timed_recv_from_server,
+                               _next_expected_amount, PendingMeasurements,
+                               measurement_finished, lookahead,
+                               initial_expected_amount, _downloads_are_stable,
+                               BandwidthDownloads, RttDownloads,
+                               measure_relay_with, _run_sync)
+from sbws.globals import HTTP_GET_HEADERS
+from sbws.lib.destination import Destination
+from sbws.lib.resultdump import ResultErrorStream, ResultSuccess
 
 
 def test_result_putter(sbwshome_only_datadir, result_success, rd, end_event):
@@ -26,3 +40,217 @@ def test_result_putter(sbwshome_only_datadir, result_success, rd, end_event):
     assert rd.queue.qsize() == 1
     assert rd.queue.full()
     end_event.set()
+
+
+class _FakeResponse:
+    def __init__(self, size):
+        self._size = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+    def iter_content(self, chunk_size):
+        sent = 0
+        while sent < self._size:
+            chunk = min(chunk_size, self._size - sent)
+            sent += chunk
+            yield b'x' * chunk
+
+
+class _FakeSession:
+    def __init__(self):
+        self.kwargs = None
+
+    def get(self, url, **kwargs):
+        self.kwargs = kwargs
+        start, end = kwargs['headers']['Range'].split('=')[1].split('-')
+        return _FakeResponse(int(end) - int(start) + 1)
+
+
+def test_timed_recv_from_server_streams():
+    session = _FakeSession()
+    dest = Destination('https://example.com/sbws.bin', 1000, True)
+    success, data = timed_recv_from_server(session, dest, 'bytes=0-299999')
+    assert success
+    assert session.kwargs['stream'] is True
+    assert data['amount'] == 300000
+    assert 0 <= data['ttfb'] <= data['duration']
+    # The global headers are not modified.
+    assert HTTP_GET_HEADERS['Range'] == '{}'
+
+
+def test_next_expected_amount_ttfb():
+    download_times = {'toofast': 1, 'min': 5, 'target': 6, 'max': 10}
+    # Without the time to first byte, the amount scales with the total time.
+    assert _next_expected_amount(
+        1000, 3, download_times, 1, 10 ** 9) == 2000
+    # When most of the time is the time to first byte, the amount scales
+    # with the transfer rate only.
+    assert _next_expected_amount(
+        1000, 3, download_times, 1, 10 ** 9, ttfb=2) == 4000
+
+
+def test_pending_measurements():
+    pending = PendingMeasurements(2)
+    pending.add('A')
+    assert pending.wait_for_free_slot(0)
+    pending.add('B')
+    assert 'A' in pending
+    assert len(pending) == 2
+    # There is not a free slot until a measurement finishes.
+    assert not pending.wait_for_free_slot(0)
+    results = []
+    callback = measurement_finished(pending, 'A', results.append)
+    timer = threading.Timer(0.05, callback, ['result'])
+    timer.start()
+    assert pending.wait_for_free_slot(5)
+    timer.join()
+    assert results == ['result']
+    assert 'A' not in pending
+    assert len(pending) == 1
+    # The slot is freed even if the callback fails.
+    callback = measurement_finished(pending, 'B', lambda r: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        callback('result')
+    assert len(pending) == 0
+
+
+def test_lookahead():
+    assert list(lookahead('abc', 0)) == [('a', []), ('b', []), ('c', [])]
+    assert list(lookahead('abc', 2)) == [
+        ('a', ['b', 'c']), ('b', ['c']), ('c', [])]
+
+
+class _FakeRelay:
+    def __init__(self, observed_bandwidth=None, consensus_bandwidth=None):
+        self.observed_bandwidth = observed_bandwidth
+        self.consensus_bandwidth = consensus_bandwidth
+
+
+def test_initial_expected_amount(conf, result_success, result_error_stream):
+    relay = _FakeRelay(observed_bandwidth=10 ** 6)
+    # Disabled by default.
+    assert initial_expected_amount(conf, relay, [result_success]) is None
+    conf['scanner']['initial_read_request_from_history'] = 'on'
+    # Aim for the target time at the previous median download rate.
+    rate = median(d['amount'] / d['duration']
+                  for d in result_success.downloads)
+    assert initial_expected_amount(
+        conf, relay, [result_error_stream, result_success]) == \
+        int(rate * conf.getfloat('scanner', 'download_target'))
+    # Without previous successful measurements, aim for the too fast time at
+    # the relay's bandwidth.
+    assert initial_expected_amount(conf, relay, [result_error_stream]) == \
+        int(10 ** 6 * conf.getfloat('scanner', 'download_toofast'))
+    assert initial_expected_amount(conf, _FakeRelay(), []) is None
+    conf['scanner']['initial_read_request_from_history'] = 'off'
+    assert initial_expected_amount(conf, relay, [result_success]) is None
+
+
+def test_downloads_are_stable(conf):
+    stable = [{'amount': 10 ** 6, 'duration': d} for d in [6, 6.1, 5.9]]
+    unstable = [{'amount': 10 ** 6, 'duration': d} for d in [6, 9, 5.1]]
+    # Disabled by default.
+    assert not _downloads_are_stable(conf, stable)
+    conf['scanner']['early_stop_ci_width'] = '0.1'
+    assert _downloads_are_stable(conf, stable)
+    assert not _downloads_are_stable(conf, unstable)
+    # Not before the minimum number of downloads.
+    assert not _downloads_are_stable(conf, stable[:2])
+
+
+def _download_at(byte_range, rate, ttfb=0.5):
+    start, end = byte_range.split('=')[1].split('-')
+    amount = int(end) - int(start) + 1
+    return {'amount': amount, 'duration': ttfb + amount / rate, 'ttfb': ttfb}
+
+
+def test_bandwidth_downloads(conf):
+    dest = Destination('https://example.com/sbws.bin', 1000, True)
+    downloads = BandwidthDownloads(conf, dest, 1 << 30)
+    for byte_range in iter(downloads.next_range, None):
+        downloads.add(_download_at(byte_range, 10 ** 6))
+    results, info = downloads.result()
+    # The first downloads are too fast, until the amount aims for the
+    # target time.
+    assert info == {'attempts': 9, 'stop_reason': 'num_downloads'}
+    assert [r['duration'] for r in results] == [6] * 5
+
+    conf['scanner']['early_stop_ci_width'] = '0.1'
+    downloads = BandwidthDownloads(conf, dest, 1 << 30,
+                                   initial_amount=5500000)
+    for byte_range in iter(downloads.next_range, None):
+        downloads.add(_download_at(byte_range, 10 ** 6))
+    results, info = downloads.result()
+    assert info == {'attempts': 3, 'stop_reason': 'stable'}
+    assert len(results) == 3
+
+
+def test_rtt_downloads(conf):
+    conf['scanner']['num_rtts'] = '3'
+    dest = Destination('https://example.com/sbws.bin', 1000, True)
+    downloads = RttDownloads(conf, dest, 1 << 30)
+    for byte_range in iter(downloads.next_range, None):
+        downloads.add(_download_at(byte_range, 10 ** 6, ttfb=0.1))
+    rtts, _ = downloads.result()
+    assert len(rtts) == 3
+    error = Exception('Range not supported')
+    assert RttDownloads(conf, dest, 1 << 30).failed(error) == (None, error)
+
+
+class _FakeIO:
+    def __init__(self, rtts=([0.1], None)):
+        self.rtts = rtts
+        self.closed = []
+
+    async def run(self, func, *args):
+        return func(*args)
+
+    async def open(self):
+        return True
+
+    async def build_circuit(self, circ_fps):
+        return '1', None
+
+    async def connect(self, dest, circ_id):
+        return True, {'content_length': 1 << 30}
+
+    async def measure_rtt(self, dest, usable_data):
+        return self.rtts
+
+    async def measure_bandwidth(self, dest, usable_data, initial_amount):
+        return [{'duration': 6, 'amount': initial_amount}], \
+            {'attempts': 1, 'stop_reason': 'num_downloads'}
+
+    def close(self, usable_data):
+        self.closed.append(usable_data)
+
+
+@pytest.mark.parametrize('run', [_run_sync, asyncio.run])
+def test_measure_relay_with(conf, monkeypatch, run):
+    """Both engines run the same steps, with their own I/O."""
+    dest = Destination('https://example.com/sbws.bin', 1000, True)
+    monkeypatch.setattr(scanner, 'pick_measurement_path', lambda *args: (
+        dest, ['A' * 40, 'B' * 40], ['a', 'b'], None))
+    cb = MagicMock()
+    # Without circuits built in advance.
+    cb.take_prefetched_circuit.return_value = None
+    relay = MagicMock(fingerprint='A' * 40, nickname='a')
+    io = _FakeIO()
+    result = run(measure_relay_with(io, conf, None, cb, None, relay,
+                                    initial_amount=1000))
+    assert isinstance(result[0], ResultSuccess)
+    assert result[0].downloads == [{'duration': 6, 'amount': 1000}]
+    assert len(io.closed) == 1
+    cb.close_circuit.assert_called_once_with('1')
+
+    # The connection and the circuit are also closed when it fails.
+    cb.close_circuit.reset_mock()
+    io = _FakeIO(rtts=(None, Exception('Range not supported')))
+    result = run(measure_relay_with(io, conf, None, cb, None, relay))
+    assert isinstance(result[0], ResultErrorStream)
+    assert len(io.closed) == 1
+    cb.close_circuit.assert_called_once_with('1')
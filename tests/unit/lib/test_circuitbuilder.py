@@ -0,0 +1,112 @@
+"""Unit tests for circuitbuilder.py"""
+import itertools
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from stem import CircStatus
+
+from sbws.lib.circuitbuilder import GapsCircuitBuilder
+
+PATH = ['A' * 40, 'B' * 40]
+
+
+@pytest.fixture
+def controller():
+    controller = MagicMock()
+    ids = itertools.count(1)
+    controller.new_circuit.side_effect = lambda *a, **kw: str(next(ids))
+    controller.get_circuit.return_value = MagicMock(status=CircStatus.BUILT)
+    return controller
+
+
+@pytest.fixture
+def cb(conf, controller):
+    conf['scanner']['circuit_prefetch'] = '2'
+    cb = GapsCircuitBuilder(None, conf, controller)
+    yield cb
+    cb.stop_prefetching()
+
+
+def _prefetch(cb, key):
+    assert cb.prefetch_circuit(key, PATH, data=key)
+    # Wait for the thread that builds it.
+    for _ in range(500):
+        if key in cb._prefetched:
+            return cb._prefetched[key][0]
+        time.sleep(0.01)
+    raise AssertionError('{} was not prefetched'.format(key))
+
+
+def test_can_prefetch(conf, controller, cb):
+    conf['scanner']['circuit_prefetch'] = '0'
+    assert not GapsCircuitBuilder(None, conf, controller).can_prefetch('a')
+    assert cb.can_prefetch('a')
+    _prefetch(cb, 'a')
+    assert not cb.can_prefetch('a')
+    _prefetch(cb, 'b')
+    # There are already ``circuit_prefetch`` circuits.
+    assert not cb.can_prefetch('c')
+
+
+def test_take_prefetched_circuit(cb, controller):
+    circ_id = _prefetch(cb, 'a')
+    assert cb.take_prefetched_circuit('a') == (circ_id, PATH, 'a')
+    # It can only be taken once.
+    assert cb.take_prefetched_circuit('a') is None
+    assert cb.take_prefetched_circuit('b') is None
+    controller.close_circuit.assert_not_called()
+
+
+def test_take_prefetched_circuit_being_built(cb, controller):
+    def new_circuit(*args, **kwargs):
+        time.sleep(0.2)
+        return '1'
+
+    controller.new_circuit.side_effect = new_circuit
+    assert cb.prefetch_circuit('a', PATH, data='a')
+    # It waits for the circuit instead of returning None.
+    assert cb.take_prefetched_circuit('a') == ('1', PATH, 'a')
+    assert controller.new_circuit.call_count == 1
+
+
+def test_take_prefetched_circuit_failed(cb, controller):
+    controller.new_circuit.side_effect = RuntimeError
+    assert cb.prefetch_circuit('a', PATH)
+    assert cb.take_prefetched_circuit('a') is None
+    assert cb.can_prefetch('a')
+
+
+def test_take_prefetched_circuit_stale(cb, controller):
+    circ_id = _prefetch(cb, 'a')
+    # Tor closed the circuit meanwhile.
+    controller.get_circuit.return_value = None
+    assert cb.take_prefetched_circuit('a') is None
+    controller.close_circuit.assert_called_once_with(circ_id)
+    assert circ_id not in cb.built_circuits
+
+
+def test_take_prefetched_circuit_not_built(cb, controller):
+    circ_id = _prefetch(cb, 'a')
+    controller.get_circuit.return_value = MagicMock(
+        status=CircStatus.EXTENDED)
+    assert cb.take_prefetched_circuit('a') is None
+    controller.close_circuit.assert_called_once_with(circ_id)
+
+
+def test_take_prefetched_circuit_expired(cb, controller):
+    circ_id = _prefetch(cb, 'a')
+    cb.prefetch_ttl = -1
+    assert cb.take_prefetched_circuit('a') is None
+    controller.close_circuit.assert_called_once_with(circ_id)
+    # The expired circuit does not count anymore.
+    assert cb.can_prefetch('a')
+
+
+def test_stop_prefetching(cb, controller):
+    circ_id = _prefetch(cb, 'a')
+    cb.stop_prefetching()
+    controller.close_circuit.assert_called_once_with(circ_id)
+    assert not cb.can_prefetch('b')
+    assert not cb.prefetch_circuit('b', PATH)
+    assert cb.take_prefetched_circuit('a') is None
@@ -0,0 +1,58 @@
+"""Unit tests for consensus.py."""
+import os
+import shutil
+from unittest import mock
+
+from sbws.lib import consensus
+
+
+def test_read_router_statuses(root_data_path, router_statuses, tmpdir):
+    consensus_path = str(tmpdir.join('cached-consensus'))
+    cache_fname = str(tmpdir.join('consensus.cache'))
+    shutil.copy(os.path.join(root_data_path, '2020-02-29-10-00-00-consensus'),
+                consensus_path)
+    with mock.patch.object(consensus, 'parse_file',
+                           wraps=consensus.parse_file) as parse_file:
+        router_statuses_d = consensus.read_router_statuses(
+            consensus_path, cache_fname)
+        assert len(router_statuses_d) == len(router_statuses)
+        for rs in router_statuses:
+            cached = router_statuses_d[rs.fingerprint]
+            assert cached.bandwidth == rs.bandwidth
+            assert cached.is_unmeasured == rs.is_unmeasured
+            assert cached.flags == frozenset(rs.flags)
+        # It is not parsed again in the same process, nor in other process
+        # with the cache file.
+        assert consensus.read_router_statuses(
+            consensus_path, cache_fname) is router_statuses_d
+        consensus._router_statuses.clear()
+        assert consensus.read_router_statuses(
+            consensus_path, cache_fname) == router_statuses_d
+        assert parse_file.call_count == 1
+        # Until the consensus changes.
+        shutil.copy(
+            os.path.join(root_data_path, '2020-02-29-11-00-00-consensus'),
+            consensus_path)
+        assert consensus.read_router_statuses(
+            consensus_path, cache_fname) != router_statuses_d
+        assert parse_file.call_count == 2
+    assert consensus.consensus_key(consensus_path)[0] == '2020-02-29 11:00:00'
+
+
+def test_read_router_statuses_bad_cache(root_data_path, tmpdir):
+    consensus_path = os.path.join(root_data_path,
+                                  '2020-02-29-10-00-00-consensus')
+    cache_fname = str(tmpdir.join('consensus.cache'))
+    with open(cache_fname, 'wt') as fd:
+        fd.write('{"version": 1, "key"')
+    consensus._router_statuses.clear()
+    router_statuses_d = consensus.read_router_statuses(consensus_path,
+                                                       cache_fname)
+    assert router_statuses_d == consensus._parse_router_statuses(
+        consensus_path)
+    # And it is replaced.
+    consensus._router_statuses.clear()
+    with mock.patch.object(consensus, 'parse_file') as parse_file:
+        assert consensus.read_router_statuses(
+            consensus_path, cache_fname) == router_statuses_d
+        parse_file.assert_not_called()
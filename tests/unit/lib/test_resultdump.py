@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
 """Unit tests for resultdump."""
 
+import bz2
 import datetime
+import glob
+import gzip
+import hashlib
+import json
 import logging
+import os
+import time
 
 from sbws.lib.relaylist import Relay
 from sbws.lib.resultdump import (
+    Result,
+    ResultWriter,
     ResultError,
     ResultErrorStream,
     ResultSuccess,
     trim_results_ip_changed,
-    load_result_file
+    load_recent_results_in_datadir,
+    load_result_db,
+    load_result_file,
+    load_results_snapshot,
+    RESULTS_SNAPSHOT_VERSION,
+    write_result_to_datadir,
+    write_results_snapshot,
 )
 
 
@@ -72,6 +87,7 @@ def test_resultdump(
         relay, ["A", "B"], "http://localhost/bw", "scanner_nick",
     )
     rd.store_result(r)
+    results = rd.results_for_relay(relay)
     assert 2 == len(results)
     assert 1 == len(results[1].relay_recent_priority_list)
     settings.set_end_event()
@@ -96,3 +112,161 @@ def test_load(datadir):
     assert 2 == len(r2.relay_recent_measurement_attempt)
     assert 3 == len(r2.relay_recent_priority_list)
     assert 3 == len(r2.relay_in_recent_consensus)
+
+
+def test_resultdump_evicts_expired(rd, result_success):
+    from sbws import settings
+    fp = result_success.fingerprint
+    now = time.time()
+    with rd.data_lock:
+        rd._index_results({fp: [result_success]})
+        assert list(rd.expiry_queue) == [(result_success.time, fp)]
+        rd._evict_expired(result_success.time)
+        assert list(rd.data[fp]) == [result_success]
+        # It is only removed once it is older than the oldest allowed.
+        rd._evict_expired(result_success.time + 1)
+        assert fp not in rd.data
+        assert not rd.expiry_queue
+        # Results that are already expired are not stored.
+        rd.store_result(result_success)
+        assert fp not in rd.data
+        fresh_result = Result.from_dict(
+            dict(result_success.to_dict(), time=now))
+        rd.store_result(fresh_result)
+        assert list(rd.data[fp]) == [fresh_result]
+    settings.set_end_event()
+
+
+def test_load_results_sqlite(tmpdir, result_success, result_error_stream):
+    now = time.time()
+    success = Result.from_dict(dict(result_success.to_dict(), time=now))
+    error = Result.from_dict(dict(result_error_stream.to_dict(), time=now))
+    old = Result.from_dict(dict(result_success.to_dict(), time=now - 60))
+    datadir = str(tmpdir)
+    for result in [success, error, old]:
+        write_result_to_datadir(result, datadir, 'sqlite')
+    fname = glob.glob(os.path.join(datadir, '*.db'))[0]
+    results = load_result_db(fname, oldest_allowed=now - 1)
+    assert [r.type for r in results[success.fingerprint]] == \
+        [success.type, error.type]
+    results = load_result_db(fname, success_only=True)
+    assert sorted(r.time for r in results[success.fingerprint]) == \
+        [now - 60, now]
+    assert str(success) in [str(r) for r in results[success.fingerprint]]
+    # The results in text files are loaded too.
+    write_result_to_datadir(success, datadir)
+    results = load_recent_results_in_datadir(1, datadir, success_only=True)
+    assert len(results[success.fingerprint]) == 3
+
+
+def test_load_recent_results_in_datadir_processes(tmpdir, result_success):
+    now = time.time()
+    datadir = str(tmpdir)
+    for days in range(3):
+        result = Result.from_dict(
+            dict(result_success.to_dict(), time=now - days * 24 * 60 * 60))
+        write_result_to_datadir(result, datadir)
+    results = load_recent_results_in_datadir(5, datadir)
+    parallel_results = load_recent_results_in_datadir(5, datadir, processes=2)
+    assert [str(r) for r in parallel_results[result_success.fingerprint]] == \
+        [str(r) for r in results[result_success.fingerprint]]
+    assert len(results[result_success.fingerprint]) == 3
+
+
+def test_results_snapshot(tmpdir, result_success):
+    now = time.time()
+    datadir = str(tmpdir.mkdir('datadir'))
+    snapshot_fname = str(tmpdir.join('results.snapshot'))
+    results = [Result.from_dict(dict(result_success.to_dict(), time=now - i))
+               for i in range(4)]
+    fp = result_success.fingerprint
+    write_result_to_datadir(results[0], datadir)
+    write_result_to_datadir(results[1], datadir, 'sqlite')
+    # The results in the files before the snapshot are not read again.
+    write_results_snapshot(snapshot_fname, 5, datadir, {fp: results[1:2]})
+    write_result_to_datadir(results[2], datadir)
+    write_result_to_datadir(results[3], datadir, 'sqlite')
+    loaded = load_results_snapshot(snapshot_fname, 5, datadir)
+    assert [str(r) for r in loaded[fp]] == [str(r) for r in results[1:]]
+    # A results file that is smaller than in the snapshot.
+    txt_fname = glob.glob(os.path.join(datadir, '*.txt'))[0]
+    with open(txt_fname, 'w') as fd:
+        fd.write('')
+    assert load_results_snapshot(snapshot_fname, 5, datadir) is None
+    # A snapshot that was modified.
+    write_results_snapshot(snapshot_fname, 5, datadir, {fp: results[1:2]})
+    assert load_results_snapshot(snapshot_fname, 5, datadir) is not None
+    with open(snapshot_fname, 'ab') as fd:
+        fd.write(b'x')
+    assert load_results_snapshot(snapshot_fname, 5, datadir) is None
+    # A snapshot in a format that is not known, with a valid checksum.
+    header = json.dumps({'version': RESULTS_SNAPSHOT_VERSION,
+                         'datadir': datadir, 'fresh_days': 5, 'offsets': {}})
+    for data in [b'\x80\x05\x95', b'{"version": 2}',
+                 header.encode() + b'\n{"type": "success"}']:
+        with open(snapshot_fname, 'wb') as fd:
+            fd.write(hashlib.sha256(data).hexdigest().encode('ascii') + b'\n')
+            fd.write(data)
+        assert load_results_snapshot(snapshot_fname, 5, datadir) is None
+
+
+def test_result_writer(tmpdir, result_success, result_error_stream):
+    datadir = str(tmpdir)
+    writer = ResultWriter(datadir)
+    writer.write([result_success, result_error_stream])
+    fname = writer._fname
+    # The file is kept open between batches.
+    writer.write([result_success])
+    assert writer._fname == fname
+    with open(fname) as fd:
+        assert fd.read().splitlines() == [
+            str(result_success), str(result_error_stream),
+            str(result_success)]
+    # It is opened again when it is removed.
+    os.remove(fname)
+    writer.write([result_error_stream])
+    writer.close()
+    with open(fname) as fd:
+        assert fd.read().splitlines() == [str(result_error_stream)]
+    writer = ResultWriter(datadir, 'sqlite', 'fsync')
+    writer.write([result_success, result_error_stream])
+    # FULL
+    assert writer._file.execute('PRAGMA synchronous').fetchone() == (2, )
+    writer.close()
+    # The default policy does not risk corrupting the file either.
+    writer = ResultWriter(datadir, 'sqlite')
+    writer._open(fname[:-len('.txt')] + '.db')
+    # NORMAL
+    assert writer._file.execute('PRAGMA synchronous').fetchone() == (1, )
+    writer.close()
+    results = load_result_db(fname[:-len('.txt')] + '.db')
+    assert [str(r) for r in results[result_success.fingerprint]] == \
+        [str(result_success), str(result_error_stream)]
+
+
+def test_load_compressed_results(tmpdir, result_success):
+    now = time.time()
+    datadir = str(tmpdir.mkdir('datadir'))
+    snapshot_fname = str(tmpdir.join('results.snapshot'))
+    # The last one of the previous day.
+    results = [Result.from_dict(dict(result_success.to_dict(), time=t))
+               for t in [now, now + 1, now - 24 * 60 * 60]]
+    fp = result_success.fingerprint
+    write_result_to_datadir(results[0], datadir)
+    write_results_snapshot(snapshot_fname, 5, datadir, {fp: results[:1]})
+    write_result_to_datadir(results[1], datadir)
+    write_result_to_datadir(results[2], datadir)
+    for fname, opener in zip(sorted(glob.glob(os.path.join(datadir, '*'))),
+                             [bz2.open, gzip.open]):
+        with open(fname, 'rb') as in_fd:
+            with opener(fname + '.compressed', 'wb') as out_fd:
+                out_fd.write(in_fd.read())
+        os.remove(fname)
+        ext = '.bz2' if opener is bz2.open else '.gz'
+        os.rename(fname + '.compressed', fname + ext)
+    expected = sorted(str(r) for r in results)
+    loaded = load_recent_results_in_datadir(5, datadir)
+    assert sorted(str(r) for r in loaded[fp]) == expected
+    # Only the results after the snapshot are read from the compressed file.
+    loaded = load_results_snapshot(snapshot_fname, 5, datadir)
+    assert sorted(str(r) for r in loaded[fp]) == expected
@@ -1,3 +1,6 @@
+import datetime
+import json
+import tracemalloc
 from unittest.mock import patch
 from sbws.globals import RESULT_VERSION
 from sbws.lib.resultdump import Result
@@ -7,6 +10,7 @@ from sbws.lib.resultdump import ResultErrorAuth
 from sbws.lib.resultdump import ResultErrorCircuit
 from sbws.lib.resultdump import ResultErrorStream
 from sbws.lib.resultdump import _ResultType
+from sbws.util.json import CustomEncoder, ResultDecoder
 from tests.unit.globals import monotonic_time
 
 from sbws.lib.relaylist import Relay
@@ -56,6 +60,17 @@ def test_ResultSuccess_from_dict(result_success, result_success_dict):
     assert str(result_success) == str(r2)
 
 
+def test_ResultSuccess_download_stop_reason(result_success_dict):
+    r = Result.from_dict(result_success_dict)
+    assert r.download_stop_reason is None
+    assert 'download_stop_reason' not in r.to_dict()
+    d = dict(result_success_dict, download_attempts=7,
+             download_stop_reason='stable')
+    r = Result.from_dict(d)
+    assert r.download_attempts == 7
+    assert r.to_dict()['download_stop_reason'] == 'stable'
+
+
 def test_ResultError_from_dict(result_error_stream, result_error_stream_dict):
     r2 = Result.from_dict(result_error_stream_dict)
     assert isinstance(r2, ResultError)
@@ -291,3 +306,43 @@ def test_relay_recent_priority_list_count(
         [], 2000, relay, ["A", "B"], "http://localhost/bw", "scanner_nick",
     )
     assert 2 == len(r.relay_recent_priority_list)
+
+
+def test_result_success_memory(result_success):
+    """The results of 5 days take much less memory than the dictionaries
+    they are decoded from."""
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    consensuses = [now - datetime.timedelta(hours=h) for h in range(120)]
+    lines = []
+    for i in range(100):
+        d = result_success.to_dict()
+        d.update({
+            'fingerprint': '{:040X}'.format(i),
+            'relay_in_recent_consensus': consensuses,
+            'relay_recent_measurement_attempt': consensuses[:5],
+            'relay_recent_priority_list': consensuses[:5],
+        })
+        line = json.dumps(d, cls=CustomEncoder)
+        # About two measurements per relay per day.
+        lines.extend([line] * 10)
+
+    def allocated(function):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            objects = function()
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        assert len(objects) == len(lines)
+        return sum(s.size_diff for s in after.compare_to(before, 'filename'))
+
+    dicts = allocated(
+        lambda: [json.loads(line, cls=ResultDecoder) for line in lines])
+    results = allocated(
+        lambda: [Result.from_dict(json.loads(line, cls=ResultDecoder))
+                 for line in lines])
+    assert results < dicts * 0.4
+    result = Result.from_dict(json.loads(lines[0], cls=ResultDecoder))
+    assert result.downloads == result_success.downloads
+    assert result.rtts == result_success.rtts
@@ -5,14 +5,19 @@ import logging
 import math
 import os.path
 import pytest
+import random
+import time
 from unittest import mock
 
 from sbws import __version__ as version
 from sbws.globals import (SPEC_VERSION, SBWS_SCALING, TORFLOW_SCALING,
-                          MIN_REPORT, TORFLOW_ROUND_DIG, PROP276_ROUND_DIG)
-from sbws.lib.resultdump import Result, load_result_file, ResultSuccess
+                          MIN_REPORT, TORFLOW_ROUND_DIG, PROP276_ROUND_DIG,
+                          TORFLOW_OBS_LAST, TORFLOW_OBS_MEAN)
+from sbws.lib.resultdump import (
+    Result, ResultSuccess, load_recent_results_in_datadir, load_result_file,
+    load_results_snapshot, write_result_to_datadir, write_results_snapshot)
 from sbws.lib.v3bwfile import (
-    V3BWHeader, V3BWLine, TERMINATOR, LINE_SEP,
+    V3BWHeader, V3BWLine, TERMINATOR, LINE_SEP, BWLINE_KEYS_V1,
     KEYVALUE_SEP_V1, num_results_of_type,
     V3BWFile, round_sig_dig,
     HEADER_RECENT_MEASUREMENTS_EXCLUDED_KEYS
@@ -453,6 +458,28 @@ def test_results_away_each_other(datadir):
     assert len(success_results) < min_num
 
 
+def test_from_results_same_as_from_results_methods(datadir):
+    results = load_result_file(str(datadir.join("results_away.txt")))
+    for values in results.values():
+        bwl, reason = V3BWLine.from_results(values)
+        if reason is not None:
+            continue
+        assert bwl.time == V3BWLine.last_time_from_results(values)
+        for key, num in V3BWLine.result_types_from_results(values).items():
+            if key in BWLINE_KEYS_V1:
+                assert getattr(bwl, key) == num
+        success_results = [r for r in values if isinstance(r, ResultSuccess)]
+        assert bwl.bw == V3BWLine.bw_median_from_results(success_results)
+        assert bwl.bw_mean == V3BWLine.bw_mean_from_results(success_results)
+        assert bwl.rtt == V3BWLine.rtt_from_results(success_results)
+        assert bwl.desc_bw_avg == \
+            V3BWLine.desc_bw_avg_from_results(success_results)
+        assert bwl.desc_bw_obs_last == \
+            V3BWLine.desc_bw_obs_last_from_results(success_results)
+        assert bwl.desc_bw_obs_mean == \
+            V3BWLine.desc_bw_obs_mean_from_results(success_results)
+
+
 def test_measured_progress_stats(datadir):
     number_consensus_relays = 3
     bw_lines_raw = []
@@ -640,3 +667,90 @@ def test_relay_in_recent_consensus_count(root_data_path, datadir):
     for fp, values in results.items():
         line = V3BWLine.from_results(values)
     assert "3" == line[0].relay_in_recent_consensus_count
+
+
+def test_from_results_generate_snapshot(datadir, tmpdir):
+    """The bandwidth file generated from the generate snapshot is the same
+    as the one generated reading all the results files."""
+    results_dir = str(tmpdir.mkdir('results'))
+    snapshot_fname = str(tmpdir.join('generate.snapshot'))
+    results = load_result_file(str(datadir.join("results_away.txt")))
+    results = sorted([r for values in results.values() for r in values],
+                     key=lambda r: r.time)
+    # Keep how far away from each other they are, but make them recent.
+    offset = time.time() - 60 - results[-1].time
+    results = [Result.from_dict(dict(r.to_dict(), time=r.time + offset))
+               for r in results]
+    # The nickname of the line is the one of the first result.
+    results[0] = Result.from_dict(dict(results[0].to_dict(), nickname='A0'))
+    for r in results[1:4]:
+        write_result_to_datadir(r, results_dir)
+    snapshot = {}
+    for r in results[1:4]:
+        snapshot.setdefault(r.fingerprint, []).append(r)
+    write_results_snapshot(snapshot_fname, 28, results_dir, snapshot)
+    # The oldest result goes to the file of a previous day after the snapshot.
+    for r in results[4:] + results[:1]:
+        write_result_to_datadir(r, results_dir)
+
+    def bw_file_str(results):
+        bw_file = V3BWFile.from_results(results, secs_away=86400, min_num=2)
+        return [line for line in str(bw_file).splitlines()
+                if not line.startswith('file_created')]
+
+    expected = bw_file_str(load_recent_results_in_datadir(28, results_dir))
+    assert bw_file_str(
+        load_results_snapshot(snapshot_fname, 28, results_dir)) == expected
+    # A snapshot of less days than the ones needed is not used.
+    assert load_results_snapshot(snapshot_fname, 29, results_dir) is None
+
+
+def test_from_results_processes(datadir):
+    """The bandwidth file created in several processes is the same as the
+    one created in one."""
+    results = load_result_file(str(datadir.join("results_away.txt")))
+
+    def bw_file_str(processes):
+        bw_file = V3BWFile.from_results(results, secs_away=86400, min_num=2,
+                                        processes=processes)
+        return [line for line in str(bw_file).splitlines()
+                if not line.startswith('file_created')]
+
+    expected = bw_file_str(1)
+    assert bw_file_str(2) == expected
+    assert bw_file_str(len(results) + 1) == expected
+
+
+def test_torflow_scale_arrays(router_statuses):
+    """Scaling the lines with NumPy gives the same lines as scaling them one
+    by one."""
+    pytest.importorskip('numpy')
+    rnd = random.Random(1)
+    router_statuses_d = dict((rs.fingerprint, rs) for rs in router_statuses)
+
+    def maybe(value):
+        return rnd.choice([value] * 8 + [None, 0])
+
+    bw_lines = []
+    # And some relays that are not in the consensus.
+    for rs in router_statuses + [None] * 50:
+        fp = rs.fingerprint if rs else '{:040X}'.format(len(bw_lines))
+        bw_mean = rnd.randint(0, 10 ** 8)
+        bw_lines.append(V3BWLine(
+            '$' + fp, rnd.randint(1, 10 ** 8), bw_mean=bw_mean,
+            bw_filt=bw_mean + rnd.randint(0, 10 ** 6),
+            desc_bw_avg=maybe(rnd.randint(1, 10 ** 9)),
+            desc_bw_bur=maybe(rnd.randint(1, 10 ** 9)),
+            desc_bw_obs_last=maybe(rnd.randint(1, 10 ** 8)),
+            desc_bw_obs_mean=maybe(rnd.randint(1, 10 ** 8)),
+            consensus_bandwidth=maybe(rs.bandwidth * 1000 if rs else 1000),
+            consensus_bandwidth_is_unmeasured=rs.is_unmeasured if rs
+            else None))
+    for obs in [TORFLOW_OBS_LAST, TORFLOW_OBS_MEAN]:
+        for statuses in [router_statuses_d, None]:
+            for cap in [0.05, 1]:
+                args = (bw_lines, obs, cap, PROP276_ROUND_DIG, statuses)
+                expected = V3BWFile._bw_torflow_scale_lines(*args)
+                scaled = V3BWFile._bw_torflow_scale_arrays(*args)
+                assert [str(line) for line in expected] == \
+                    [str(line) for line in scaled]
@@ -0,0 +1,106 @@
+"""Unit tests for aio.py"""
+import asyncio
+import struct
+
+from sbws.util.aio import HTTPConnection, CircuitEventDispatcher
+
+CONTENT_LENGTH = 200 * 1024
+
+
+async def _fake_socks5_http_server(reader, writer):
+    """Reply as a SOCKS5 proxy without auth, then as an HTTP server that
+    supports Range requests."""
+    await reader.readexactly(3)
+    writer.write(b'\x05\x00')
+    _, _, _, atyp, length = await reader.readexactly(5)
+    assert atyp == 3
+    await reader.readexactly(length + 2)
+    writer.write(b'\x05\x00\x00\x01' + bytes(4) + struct.pack('>H', 0))
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            break
+        method = request_line.split()[0]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            k, _, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        if method == b'HEAD':
+            writer.write('HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n'
+                         .format(CONTENT_LENGTH).encode())
+        else:
+            start, end = headers['range'].split('=')[1].split('-')
+            size = int(end) - int(start) + 1
+            writer.write('HTTP/1.1 206 Partial Content\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(size).encode())
+            writer.write(b'x' * size)
+        await writer.drain()
+    writer.close()
+
+
+def test_http_connection_head_and_get():
+    loop = asyncio.new_event_loop()
+
+    handlers = []
+
+    def handle(reader, writer):
+        handlers.append(asyncio.ensure_future(
+            _fake_socks5_http_server(reader, writer)))
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        socks_addr = server.sockets[0].getsockname()
+        conn = await HTTPConnection.open(
+            'http://example.com/sbws.bin', socks_addr, timeout=5)
+        head = await conn.head()
+        assert head.status_code == 200
+        assert int(head.headers['content-length']) == CONTENT_LENGTH
+        # Bigger than the read chunk size, to read it in several chunks.
+        response = await conn.get(headers={'Range': 'bytes=0-99999'})
+        assert response.status_code == 206
+        assert response.num_bytes == 100000
+        assert 0 <= response.ttfb <= response.duration
+        # The connection is persistent.
+        response = await conn.get(headers={'Range': 'bytes=10-19'})
+        assert response.num_bytes == 10
+        conn.close()
+        server.close()
+        await server.wait_closed()
+        # The handler returns when the connection is closed.
+        await asyncio.wait_for(asyncio.gather(*handlers), 5)
+
+    loop.run_until_complete(run())
+    loop.close()
+
+
+class _CircEvent:
+    def __init__(self, circ_id, status, reason=None):
+        self.id = circ_id
+        self.status = status
+        self.reason = reason
+
+
+def test_circuit_event_dispatcher():
+    loop = asyncio.new_event_loop()
+    dispatcher = CircuitEventDispatcher(None, loop)
+
+    async def run():
+        # The event arrives before waiting for it.
+        dispatcher._listener(_CircEvent('1', 'BUILT'))
+        await asyncio.sleep(0)
+        assert await dispatcher.wait_for_circuit('1', 1) == (True, None)
+        # The event arrives while waiting for it.
+        loop.call_later(0.01, dispatcher._listener,
+                        _CircEvent('2', 'FAILED', 'TIMEOUT'))
+        built, reason = await dispatcher.wait_for_circuit('2', 1)
+        assert not built
+        assert 'TIMEOUT' in reason
+        # The event does not arrive.
+        built, reason = await dispatcher.wait_for_circuit('3', 0.01)
+        assert not built
+
+    loop.run_until_complete(run())
+    loop.close()
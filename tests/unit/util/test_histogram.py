@@ -0,0 +1,39 @@
+"""Unit tests for histogram.py"""
+from unittest.mock import patch
+
+from sbws.util.histogram import Histogram, PhaseHistograms, PhaseTimer
+from tests.unit.globals import incrementing_time
+
+
+def test_histogram():
+    histogram = Histogram([1, 5, 10])
+    assert histogram.quantile(0.5) is None
+    for value in [0.5, 1, 2, 3, 20]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 5
+    assert histogram.quantile(0.2) == 1
+    # In the ``+Inf`` bucket.
+    assert histogram.quantile(1) == 10
+    assert histogram.to_dict() == {
+        'buckets': {'1': 2, '5': 4, '10': 4, '+Inf': 5},
+        'count': 5, 'sum': 26.5,
+    }
+
+
+@patch('time.monotonic')
+def test_phase_timer(monotonic_mock):
+    monotonic_mock.side_effect = incrementing_time(start=100, increment=2)
+    histograms = PhaseHistograms()
+    timer = PhaseTimer(histograms)
+    with timer.phase('build_circuit'):
+        pass
+    with timer.phase('connect'):
+        pass
+    # Nothing is observed until the outcome is known.
+    assert histograms.to_dict() == {}
+    timer.finish('success')
+    phases = histograms.to_dict()
+    assert set(phases) == {'build_circuit', 'connect'}
+    assert phases['connect']['success']['count'] == 1
+    assert phases['connect']['success']['sum'] == 2
+    histograms.log_summary()
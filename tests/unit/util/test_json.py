@@ -1,7 +1,8 @@
 """json.py unit tests."""
 import json
+import os
 
-from sbws.util.json import CustomDecoder, CustomEncoder
+from sbws.util.json import CustomDecoder, CustomEncoder, ResultDecoder
 
 STATE = """{
     "min_perc_reached": null,
@@ -52,3 +53,16 @@ def test_decode_encode_roundtrip():
     d = json.loads(STATE, cls=CustomDecoder)
     s = json.dumps(d, cls=CustomEncoder, indent=4, sort_keys=True)
     assert s == STATE
+
+
+def test_result_decoder():
+    assert json.loads(STATE, cls=ResultDecoder) == \
+        json.loads(STATE, cls=CustomDecoder)
+    data_dir = os.path.join(os.path.dirname(__file__), '..', 'lib', 'data')
+    with open(os.path.join(data_dir, 'results.txt')) as fd:
+        for line in fd:
+            assert json.loads(line, cls=ResultDecoder) == \
+                json.loads(line, cls=CustomDecoder)
+    # Strings that are not in the known keys are not deserialized.
+    d = json.loads('{"nickname": "2020-03-04T10:00:00"}', cls=ResultDecoder)
+    assert d['nickname'] == '2020-03-04T10:00:00'
@@ -0,0 +1,79 @@
+"""Unit tests for metrics.py"""
+import socket
+import urllib.request
+
+import pytest
+
+from sbws.util.histogram import PhaseHistograms
+from sbws.util.metrics import Metrics, MetricsServer
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.inc('sbws_results_total', type='success')
+    metrics.inc('sbws_results_total', type='success')
+    metrics.inc('sbws_downloaded_bytes_total', 1024)
+    metrics.set_gauge('sbws_measurements_pending', lambda: 3)
+    metrics.set_gauge('sbws_measurement_workers',
+                      lambda: {('state', 'busy'): 3, ('state', 'idle'): 1})
+    # A gauge that fails is not rendered.
+    metrics.set_gauge('sbws_result_queue_size', lambda: 1 / 0)
+    metrics.phase_histograms = PhaseHistograms()
+    metrics.phase_histograms.observe('connect', 'success', 0.3)
+    text = metrics.render()
+    assert '# TYPE sbws_results_total counter\n' \
+        'sbws_results_total{type="success"} 2\n' in text
+    assert 'sbws_downloaded_bytes_total 1024\n' in text
+    assert 'sbws_measurements_pending 3\n' in text
+    assert 'sbws_measurement_workers{state="idle"} 1\n' in text
+    assert 'sbws_result_queue_size' not in text
+    assert 'sbws_measurement_phase_seconds_bucket{le="0.25",' \
+        'outcome="success",phase="connect"} 0\n' in text
+    assert 'sbws_measurement_phase_seconds_bucket{le="+Inf",' \
+        'outcome="success",phase="connect"} 1\n' in text
+
+
+def test_metrics_server_tcp():
+    metrics = Metrics()
+    metrics.inc('sbws_results_total', type='success')
+    server = MetricsServer(metrics, port=0)
+    server.start()
+    try:
+        url = 'http://{}:{}/metrics'.format(*server.address)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.status == 200
+            assert b'sbws_results_total{type="success"} 1' in response.read()
+    finally:
+        server.stop()
+
+
+def test_metrics_server_unix(tmpdir):
+    path = str(tmpdir.join('metrics.sock'))
+    server = MetricsServer(Metrics(), socket_path=path)
+    server.start()
+    try:
+        with socket.socket(socket.AF_UNIX) as s:
+            s.settimeout(5)
+            s.connect(path)
+            s.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            assert s.recv(1024).startswith(b'HTTP/1.0 200')
+    finally:
+        server.stop()
+
+
+def test_metrics_server_unix_not_socket(tmpdir):
+    path = tmpdir.join('metrics.sock')
+    path.write('not a socket')
+    with pytest.raises(FileExistsError):
+        MetricsServer(Metrics(), socket_path=str(path))
+    assert path.read() == 'not a socket'
+
+
+def test_metrics_server_unix_stale_socket(tmpdir):
+    path = str(tmpdir.join('metrics.sock'))
+    # A socket left by a previous run.
+    with socket.socket(socket.AF_UNIX) as s:
+        s.bind(path)
+    server = MetricsServer(Metrics(), socket_path=path)
+    server.start()
+    server.stop()
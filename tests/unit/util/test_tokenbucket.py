@@ -0,0 +1,33 @@
+"""Unit tests for tokenbucket.py"""
+from unittest.mock import patch
+
+from sbws.util.tokenbucket import TokenBucket
+from tests.unit.globals import static_time
+
+
+@patch('time.monotonic')
+def test_token_bucket(monotonic_mock):
+    monotonic_mock.side_effect = static_time(1000)
+    bucket = TokenBucket(100, window=10)
+    # The first download does not wait, even if it takes more tokens than
+    # the bucket has.
+    assert bucket.reserve(300) == 0
+    assert bucket.wait_time() == 2
+    # The next one waits until the debt is paid.
+    assert bucket.reserve(100) == 2
+    assert bucket.wait_time() == 3
+    # Only the bytes of the downloads that started count.
+    assert bucket.utilization() == 0.3
+
+
+@patch('time.monotonic')
+def test_token_bucket_refill(monotonic_mock):
+    times = iter([1000, 1000, 1001, 1100, 1100])
+    monotonic_mock.side_effect = lambda: next(times)
+    bucket = TokenBucket(100, window=10)
+    assert bucket.reserve(200) == 0
+    # 1 second later, the debt is paid.
+    assert bucket.wait_time() == 0
+    # It does not accumulate more than the capacity.
+    assert bucket.reserve(200) == 0
+    assert bucket.wait_time() == 1